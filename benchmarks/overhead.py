@@ -0,0 +1,287 @@
+''' Benchmark suite of carpy's tracing hot paths.
+
+Stats are sent to carpy.statsd_server, a local stand-in for statsd, so no
+outside services are needed. Every benchmark prints one JSON object per line, so results of
+different versions can be saved and compared:
+
+	python benchmarks/overhead.py --output before.json
+	python benchmarks/overhead.py --compare before.json
+
+Reported per benchmark:
+
+- ns_per_call: wall time per call, minus the cost of an untraced call where
+  it applies
+- peak_bytes_per_call: memory allocated at the peak of a single call
+- retained_blocks_per_call: memory blocks still allocated after the calls
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import carpy
+import carpy.statsd_client
+import carpy.statsd_server
+import carpy.transaction
+import carpy.wrapper
+
+
+def time_calls(func, number):
+	''' Returns nanoseconds per call of func. '''
+	gc.disable()
+	try:
+		start = time.perf_counter_ns()
+		for _ in range(number):
+			func()
+		return (time.perf_counter_ns() - start) / float(number)
+	finally:
+		gc.enable()
+
+
+def measure_memory(func, number):
+	''' Returns peak bytes of a single call and blocks retained per call. '''
+	func()
+
+	tracemalloc.start()
+	try:
+		func()
+		peak_bytes = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+	gc.collect()
+	blocks = sys.getallocatedblocks()
+	for _ in range(number):
+		func()
+	gc.collect()
+	retained_blocks = (sys.getallocatedblocks() - blocks) / float(number)
+
+	return peak_bytes, retained_blocks
+
+
+def run_benchmark(name, func, number, baseline=None):
+	ns_per_call = min(time_calls(func, number) for _ in range(3))
+	if baseline is not None:
+		ns_per_call -= min(time_calls(baseline, number) for _ in range(3))
+
+	peak_bytes, retained_blocks = measure_memory(func, min(number, 1000))
+
+	return {
+		'benchmark': name,
+		'calls': number,
+		'ns_per_call': round(ns_per_call, 1),
+		'peak_bytes_per_call': peak_bytes,
+		'retained_blocks_per_call': round(retained_blocks, 3),
+	}
+
+
+def empty():
+	pass
+
+
+def bench_transaction_trace(number):
+	traced = carpy.wrapper.transaction_trace(empty, 'bench_transaction')
+	return run_benchmark('transaction_trace', traced, number, baseline=empty)
+
+
+def bench_function_trace(number):
+	traced = carpy.wrapper.function_trace(empty, 'bench_function')
+
+	def calls():
+		for _ in range(100):
+			traced()
+
+	def baseline():
+		for _ in range(100):
+			empty()
+
+	with carpy.transaction.Transaction('bench_root'):
+		result = run_benchmark('function_trace', calls, number // 100, baseline=baseline)
+
+	result['ns_per_call'] = round(result['ns_per_call'] / 100, 1)
+	result['calls'] = number
+	return result
+
+
+def bench_function_trace_no_transaction(number):
+	traced = carpy.wrapper.function_trace(empty, 'bench_function')
+	return run_benchmark('function_trace_no_transaction', traced, number, baseline=empty)
+
+
+def bench_get_stat_name(number):
+	with carpy.transaction.Transaction('bench_root') as root:
+		with carpy.transaction.Transaction('bench_child', parent=root) as child:
+			return run_benchmark('get_stat_name', child.get_stat_name, number)
+
+
+def bench_get_thread_id_threads(number, num_threads=4):
+	results = []
+
+	def run():
+		results.append(time_calls(carpy.transaction.get_thread_id, number))
+
+	threads = [threading.Thread(target=run) for _ in range(num_threads)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	return {
+		'benchmark': 'get_thread_id_threads',
+		'calls': number * num_threads,
+		'threads': num_threads,
+		'ns_per_call': round(sum(results) / len(results), 1),
+	}
+
+
+def bench_get_thread_id_greenlet(number):
+	try:
+		import greenlet
+	except ImportError:
+		return {'benchmark': 'get_thread_id_greenlet', 'skipped': 'greenlet is not installed'}
+
+	results = []
+	glet = greenlet.greenlet(lambda: results.append(
+		run_benchmark('get_thread_id_greenlet', carpy.transaction.get_thread_id, number)))
+	glet.switch()
+	return results[0]
+
+
+def build_tree(depth, width):
+	''' Returns a traced request handler with a tree of traced functions. '''
+	leaf = carpy.wrapper.function_trace(empty, 'leaf')
+
+	def node(level):
+		def func():
+			if level == depth:
+				for _ in range(width):
+					leaf()
+			else:
+				children[level + 1]()
+		return carpy.wrapper.function_trace(func, 'level%d' % level)
+
+	children = {}
+	for level in range(depth, 0, -1):
+		children[level] = node(level)
+
+	return carpy.wrapper.transaction_trace(children[1], 'tree_%dx%d' % (depth, width))
+
+
+def count_tree_stats(depth, width):
+	''' Returns the number of stats a request of build_tree sends: a timing of
+	every transaction, and a `self` timing of the root and of every level,
+	which all have children.
+	'''
+	transactions = 1 + depth + width
+	parents = 1 + depth
+	return transactions + parents
+
+
+def bench_tree(server, depth, width, number):
+	handler = build_tree(depth, width)
+	result = run_benchmark('tree_depth%d_width%d' % (depth, width), handler, number)
+	result['transactions_per_call'] = depth + width + 1
+	return result
+
+
+def bench_packets(server, duration=2.0):
+	''' End-to-end throughput of requests with 10 children and the fraction of
+	their stats which arrived.
+	'''
+	depth, width = 1, 10
+	handler = build_tree(depth, width)
+
+	server.wait()
+	server.reset()
+
+	requests = 0
+	start = time.time()
+	while time.time() - start < duration:
+		for _ in range(100):
+			handler()
+		requests += 100
+	elapsed = time.time() - start
+
+	server.wait()
+
+	return {
+		'benchmark': 'packets',
+		'requests_per_sec': round(requests / elapsed),
+		'packets_per_sec': round(server.packets / elapsed),
+		'stats_per_sec': round(server.lines / elapsed),
+		'received_ratio': round(server.lines / float(requests * count_tree_stats(depth, width)), 4),
+	}
+
+
+def compare(results, filename):
+	with open(filename) as f:
+		previous = dict((result['benchmark'], result) for result in map(json.loads, f))
+
+	for result in results:
+		old = previous.get(result['benchmark'], {})
+		if 'ns_per_call' in result and old.get('ns_per_call'):
+			sys.stderr.write('%-35s %10.1f -> %10.1f ns/call (%+.1f%%)\n' % (
+				result['benchmark'], old['ns_per_call'], result['ns_per_call'],
+				(result['ns_per_call'] / old['ns_per_call'] - 1) * 100))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--number', type=int, default=100000, help='number of calls per benchmark')
+	parser.add_argument('--output', help='file to write the results to, stdout by default')
+	parser.add_argument('--compare', help='results of a previous run to compare with')
+	args = parser.parse_args()
+
+	server = carpy.statsd_server.StatsdServer().start()
+
+	carpy.config.update({
+		'APP_NAME': 'benchmark',
+		'STATSD_HOST': '127.0.0.1',
+		'STATSD_PORT': server.port,
+	})
+	carpy.statsd_client.statsd_client_singleton = None
+	carpy.wrapper.refresh()
+
+	number = args.number
+	results = [
+		bench_transaction_trace(number),
+		bench_function_trace(number),
+		bench_function_trace_no_transaction(number),
+		bench_get_stat_name(number),
+		bench_get_thread_id_threads(number),
+		bench_get_thread_id_greenlet(number),
+		bench_tree(server, 20, 1, number // 20),
+		bench_tree(server, 1, 200, number // 200),
+		bench_packets(server),
+	]
+
+	server.close()
+
+	environment = {
+		'python': platform.python_version(),
+		'implementation': platform.python_implementation(),
+	}
+
+	output = open(args.output, 'w') if args.output else sys.stdout
+	try:
+		for result in results:
+			result.update(environment)
+			output.write(json.dumps(result, sort_keys=True) + '\n')
+	finally:
+		if args.output:
+			output.close()
+
+	if args.compare:
+		compare(results, args.compare)
+
+
+if __name__ == '__main__':
+	main()
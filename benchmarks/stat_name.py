@@ -0,0 +1,65 @@
+''' Benchmark of Transaction.get_stat_name(), comparing the cached stat names
+with the previous implementation which built the name on every exit.
+
+Usage:
+
+	python benchmarks/stat_name.py
+'''
+
+import os
+import socket
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import carpy
+from carpy.transaction import Transaction
+
+
+NUMBER = 200000
+
+
+def uncached_get_stat_name(self):
+	''' Previous implementation of Transaction.get_stat_name() '''
+	parts = []
+
+	transaction = self
+	while transaction:
+		parts.append(self.sanitize_name(transaction.name))
+		transaction = transaction.parent
+		if transaction:
+			parts.append('children')
+
+	parts.extend([
+		self.sanitize_name(socket.gethostname()),
+		self.sanitize_name(self.app_name),
+		'carpy',
+	])
+
+	parts.reverse()
+	parts.append('err' if self.is_error else 'ok')
+
+	return '.'.join(parts)
+
+
+def run(depth):
+	transaction = Transaction('root.handler')
+	for i in range(depth - 1):
+		transaction = Transaction('child.function%d' % i, parent=transaction.__enter__())
+	transaction.__enter__()
+
+	assert uncached_get_stat_name(transaction) == transaction.get_stat_name()
+
+	before = min(timeit.repeat(lambda: uncached_get_stat_name(transaction), number=NUMBER, repeat=3))
+	after = min(timeit.repeat(transaction.get_stat_name, number=NUMBER, repeat=3))
+
+	print('depth %d: before %.0f ns/exit, after %.0f ns/exit' % (
+		depth, before / NUMBER * 1e9, after / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+	carpy.config['APP_NAME'] = 'benchmark.app'
+
+	for depth in (1, 2, 4):
+		run(depth)
@@ -0,0 +1,360 @@
+__all__ = ['Aggregator', 'Histogram', 'get_aggregator', 'get_apdex_index', 'get_apdex_thresholds']
+
+import array
+import os
+import random
+import threading
+import time
+
+import carpy
+
+from .statsd_client import get_statsd_client
+
+
+APDEX_SATISFIED = 0
+APDEX_TOLERATING = 1
+APDEX_FRUSTRATED = 2
+
+aggregator_singleton = None
+
+# Taken while an aggregator starts, so that threads which record their first
+# stats at once do not start more flush threads.
+start_lock = threading.Lock()
+
+
+class Histogram(object):
+	''' Compact histogram of timings of a single stat.
+
+	Keeps the exact count, sum, minimum and maximum and a fixed size reservoir
+	of samples (reservoir sampling), so memory per stat name does not grow with
+	the number of timings.
+	'''
+
+	__slots__ = ('count', 'scaled_count', 'total', 'lower', 'upper', 'samples')
+
+	def __init__(self, size):
+		self.count = 0
+		self.scaled_count = 0.0
+		self.total = 0.0
+		self.lower = None
+		self.upper = None
+		self.samples = array.array('d', [0.0]) * size
+
+	def add(self, value, rate=1):
+		''' Adds a timing to the histogram.
+
+		:param value:
+			Timing in milliseconds.
+		:param rate:
+			Rate at which the timing was sampled.
+		'''
+		self.count += 1
+		self.scaled_count += 1.0 / rate
+		self.total += value
+
+		if self.lower is None or value < self.lower:
+			self.lower = value
+		if self.upper is None or value > self.upper:
+			self.upper = value
+
+		size = len(self.samples)
+		if self.count <= size:
+			self.samples[self.count - 1] = value
+		else:
+			index = random.randrange(self.count)
+			if index < size:
+				self.samples[index] = value
+
+	def get_summary(self):
+		''' Returns the summary of the histogram with the same semantics as
+		statsd timers.
+
+		:returns:
+			dict with mean, median, upper, upper_95, lower and count.
+		'''
+		if not self.count:
+			return {'count': 0}
+
+		values = sorted(self.samples[:min(self.count, len(self.samples))])
+		num_values = len(values)
+
+		middle = num_values // 2
+		if num_values % 2:
+			median = values[middle]
+		else:
+			median = (values[middle - 1] + values[middle]) / 2.0
+
+		num_in_threshold = max(int(round(0.95 * num_values)), 1)
+
+		return {
+			'mean': self.total / self.count,
+			'median': median,
+			'upper': self.upper,
+			'upper_95': values[num_in_threshold - 1],
+			'lower': self.lower,
+			'count': int(round(self.scaled_count)),
+		}
+
+
+class Aggregator(object):
+	''' Aggregates timings in-process and periodically sends their summaries
+	(mean, median, upper, upper_95, lower as gauges and count as a counter)
+	to statsd, instead of sending every timing.
+
+	It has the same `timing` and `incr` methods as the statsd client, so it
+	can be used in place of it.
+	'''
+
+	def __init__(self, interval=10, reservoir_size=1024, autostart=True):
+		'''
+		:param interval:
+			Seconds between flushes.
+		:param reservoir_size:
+			Number of samples kept per stat for percentiles.
+		:param autostart:
+			Start the flush thread on the first recorded stat. If `False`,
+			flush has to be called explicitly.
+		'''
+		self.interval = interval
+		self.reservoir_size = reservoir_size
+		self.autostart = autostart
+
+		self.histograms = {}
+		self.counters = {}
+		self.gauges = {}
+
+		# Satisfied, tolerating and frustrated counts by stat prefix.
+		self.apdex_counts = {}
+
+		self._lock = threading.Lock()
+		self._thread = None
+		self._pid = None
+
+	def timing(self, stat, delta, rate=1):
+		''' Records the timing.
+
+		:param stat:
+			Name of the stat.
+		:param delta:
+			Timing in milliseconds.
+		:param rate:
+			Rate at which the timing was sampled.
+		'''
+		if self.autostart and self._pid != os.getpid():
+			self.start()
+
+		with self._lock:
+			histogram = self.histograms.get(stat)
+			if histogram is None:
+				histogram = self.histograms[stat] = Histogram(self.reservoir_size)
+			histogram.add(delta, rate)
+
+	def apdex(self, stat_prefix, duration, is_error, thresholds, rate=1):
+		''' Counts the transaction as satisfied, tolerating or frustrated.
+		Failed transactions are always frustrated.
+
+		:param stat_prefix:
+			Common prefix of the transaction's stats.
+		:param duration:
+			Duration of the transaction in seconds.
+		:param is_error:
+			Whether the transaction failed.
+		:param thresholds:
+			Tuple of the satisfied and tolerating thresholds in seconds.
+		:param rate:
+			Rate at which the transaction was sampled.
+		'''
+		self.add_apdex(stat_prefix, get_apdex_index(duration, is_error, thresholds), rate)
+
+	def add_apdex(self, stat_prefix, index, rate=1):
+		''' Counts the already classified transaction for its Apdex score.
+
+		:param stat_prefix:
+			Common prefix of the transaction's stats.
+		:param index:
+			APDEX_SATISFIED, APDEX_TOLERATING or APDEX_FRUSTRATED.
+		:param rate:
+			Rate at which the transaction was sampled.
+		'''
+		if self.autostart and self._pid != os.getpid():
+			self.start()
+
+		with self._lock:
+			counts = self.apdex_counts.get(stat_prefix)
+			if counts is None:
+				counts = self.apdex_counts[stat_prefix] = [0.0, 0.0, 0.0]
+			counts[index] += 1.0 / rate
+
+	def incr(self, stat, count=1, rate=1):
+		''' Increments the counter.
+
+		:param stat:
+			Name of the stat.
+		:param count:
+			Value the counter is incremented by.
+		:param rate:
+			Rate at which the increment was sampled.
+		'''
+		if self.autostart and self._pid != os.getpid():
+			self.start()
+
+		with self._lock:
+			self.counters[stat] = self.counters.get(stat, 0.0) + count / float(rate)
+
+	def gauge(self, stat, value):
+		''' Sets the gauge, which is sent on the next flush.
+
+		:param stat:
+			Name of the stat.
+		:param value:
+			Value of the gauge.
+		'''
+		if self.autostart and self._pid != os.getpid():
+			self.start()
+
+		with self._lock:
+			self.gauges[stat] = value
+
+	def reset(self):
+		''' Drops all the stats recorded since the last flush. Called in the
+		child process after fork, the parent process sends them.
+		'''
+		self._lock = threading.Lock()
+		self.histograms = {}
+		self.counters = {}
+		self.gauges = {}
+		self.apdex_counts = {}
+		self._pid = None
+
+	def start(self):
+		''' Starts the flush thread. Called automatically on the first timing
+		and after fork, since threads do not survive it. Does nothing if it
+		already runs in this process.
+		'''
+		with start_lock:
+			if self._pid == os.getpid():
+				return
+
+			self._thread = threading.Thread(target=self._run, name='carpy-aggregator')
+			self._thread.daemon = True
+			self._thread.start()
+			self._pid = os.getpid()
+
+	def _run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.flush()
+			except Exception:
+				pass
+
+	def flush(self, statsd_client=None):
+		''' Sends summaries of all the timings, the counters and the Apdex
+		scores recorded since the last flush.
+
+		:param statsd_client:
+			Statsd client to send the summaries with. Defaults to the
+			configured client.
+		'''
+		with self._lock:
+			histograms, self.histograms = self.histograms, {}
+			counters, self.counters = self.counters, {}
+			gauges, self.gauges = self.gauges, {}
+			apdex_counts, self.apdex_counts = self.apdex_counts, {}
+
+		if not histograms and not counters and not gauges and not apdex_counts:
+			return
+
+		statsd_client = statsd_client or get_statsd_client()
+
+		with statsd_client.pipeline() as pipeline:
+			for stat, histogram in histograms.items():
+				for key, value in histogram.get_summary().items():
+					if key == 'count':
+						pipeline.incr('%s.%s' % (stat, key), value)
+					else:
+						pipeline.gauge('%s.%s' % (stat, key), value)
+
+			for stat, count in counters.items():
+				pipeline.incr(stat, int(round(count)))
+
+			for stat, value in gauges.items():
+				pipeline.gauge(stat, value)
+
+			for stat_prefix, (satisfied, tolerating, frustrated) in apdex_counts.items():
+				score = (satisfied + tolerating / 2.0) / (satisfied + tolerating + frustrated)
+				pipeline.gauge('%s.apdex.score' % stat_prefix, round(score, 3))
+				pipeline.incr('%s.apdex.satisfied' % stat_prefix, int(round(satisfied)))
+				pipeline.incr('%s.apdex.tolerating' % stat_prefix, int(round(tolerating)))
+				pipeline.incr('%s.apdex.frustrated' % stat_prefix, int(round(frustrated)))
+
+
+def get_aggregator():
+	''' Returns the aggregator configured with AGGREGATE_INTERVAL and
+	AGGREGATE_RESERVOIR_SIZE.
+	'''
+	global aggregator_singleton
+
+	if aggregator_singleton is None:
+		aggregator_singleton = Aggregator(
+			interval=carpy.config.get('AGGREGATE_INTERVAL', 10),
+			reservoir_size=carpy.config.get('AGGREGATE_RESERVOIR_SIZE', 1024),
+		)
+
+	return aggregator_singleton
+
+
+def get_apdex_thresholds(name):
+	''' Returns the Apdex thresholds of the transaction configured with
+	APDEX_THRESHOLDS or APDEX_T.
+
+	A threshold is either the satisfied threshold T in seconds, in which case
+	the tolerating threshold is 4T, or a tuple of both thresholds.
+
+	:param name:
+		Name of the transaction.
+	:returns:
+		Tuple of the satisfied and tolerating thresholds in seconds or None
+		if Apdex is not computed for the transaction.
+	'''
+	thresholds = (carpy.config.get('APDEX_THRESHOLDS') or {}).get(name)
+	if thresholds is None:
+		thresholds = carpy.config.get('APDEX_T')
+		if thresholds is None:
+			return None
+
+	if isinstance(thresholds, (tuple, list)):
+		return tuple(thresholds)
+
+	return (thresholds, thresholds * 4)
+
+
+def get_apdex_index(duration, is_error, thresholds):
+	''' Returns APDEX_SATISFIED, APDEX_TOLERATING or APDEX_FRUSTRATED for the
+	transaction. Failed transactions are always frustrated.
+
+	:param duration:
+		Duration of the transaction in seconds.
+	:param is_error:
+		Whether the transaction failed.
+	:param thresholds:
+		Tuple of the satisfied and tolerating thresholds in seconds.
+	'''
+	if is_error or duration > thresholds[1]:
+		return APDEX_FRUSTRATED
+	if duration > thresholds[0]:
+		return APDEX_TOLERATING
+	return APDEX_SATISFIED
+
+
+def _after_fork_in_child():
+	global start_lock
+
+	# Another thread of the parent may have held it.
+	start_lock = threading.Lock()
+
+	if aggregator_singleton is not None:
+		aggregator_singleton.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,153 @@
+__all__ = ['CapturedTransaction', 'TransactionStore', 'get_capture_threshold', 'get_transaction_store']
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+import carpy
+
+from .request_log import decode_record, encode_record
+
+
+transaction_store_singleton = None
+
+
+class CapturedTransaction(object):
+	''' Complete tree of a slow or failed root transaction, kept as a compact
+	request log record until it is queried.
+	'''
+
+	__slots__ = ('name', 'start_time', 'duration', 'is_error', 'record')
+
+	def __init__(self, transaction):
+		self.name = transaction.name
+		self.start_time = time.time() - transaction.duration
+		self.duration = transaction.duration
+		self.is_error = transaction.is_error
+		self.record = encode_record(transaction)
+
+	def get_tree(self):
+		''' Returns the transaction tree in the format of
+		carpy.request_log.decode_record.
+		'''
+		return decode_record(self.record)
+
+
+class TransactionStore(object):
+	''' Bounded store of the slowest and the most recent failed captured
+	transaction trees.
+	'''
+
+	def __init__(self, size=100):
+		'''
+		:param size:
+			Maximum number of kept slowest trees and of kept failed trees.
+			The fastest one is dropped when a slower one is added to a full
+			store, and the oldest failed one when a new one fails.
+		'''
+		self.size = size
+
+		# Min-heap of (duration, sequence number, CapturedTransaction), so
+		# that the fastest kept tree is replaced.
+		self.slowest = []
+		self.errors = collections.deque(maxlen=size)
+		self.sequence = itertools.count()
+		self.lock = threading.Lock()
+
+	def add(self, transaction):
+		''' Captures the tree of the finished root transaction.
+
+		:param transaction:
+			Root transaction with the log of its finished transactions.
+		'''
+		with self.lock:
+			is_slow = len(self.slowest) < self.size or (self.slowest and transaction.duration > self.slowest[0][0])
+			if not is_slow and not transaction.is_error:
+				return
+
+			captured = CapturedTransaction(transaction)
+			if is_slow:
+				item = (captured.duration, next(self.sequence), captured)
+				if len(self.slowest) < self.size:
+					heapq.heappush(self.slowest, item)
+				else:
+					heapq.heapreplace(self.slowest, item)
+			if captured.is_error:
+				self.errors.append(captured)
+
+	def get_slowest(self, n=10, name=None):
+		''' Returns the slowest captured transactions, slowest first.
+
+		:param n:
+			Maximum number of returned transactions.
+		:param name:
+			Name of the root transactions. All are returned if not set.
+		:returns:
+			List of CapturedTransaction.
+		'''
+		captured = [item[2] for item in list(self.slowest)]
+		if name is not None:
+			captured = [c for c in captured if c.name == name]
+		return heapq.nlargest(n, captured, key=lambda c: c.duration)
+
+	def get_errors(self, name=None):
+		''' Returns the captured failed transactions, most recent first.
+
+		:param name:
+			Name of the root transactions. All are returned if not set.
+		:returns:
+			List of CapturedTransaction.
+		'''
+		return [c for c in reversed(self.errors) if name is None or c.name == name]
+
+	def clear(self):
+		''' Drops all the captured transactions. '''
+		with self.lock:
+			self.slowest = []
+			self.errors.clear()
+
+
+def is_capture_enabled():
+	''' Returns true if slow or failed transaction trees are captured. '''
+	return carpy.config.get('CAPTURE_THRESHOLD') is not None or bool(carpy.config.get('CAPTURE_THRESHOLDS'))
+
+
+def get_capture_threshold(name):
+	''' Returns the duration in seconds above which the tree of the root
+	transaction is captured, configured with CAPTURE_THRESHOLDS or
+	CAPTURE_THRESHOLD, or None if only failed trees are captured.
+
+	:param name:
+		Name of the transaction.
+	'''
+	threshold = (carpy.config.get('CAPTURE_THRESHOLDS') or {}).get(name)
+	if threshold is None:
+		threshold = carpy.config.get('CAPTURE_THRESHOLD')
+	return threshold
+
+
+def is_captured(transaction):
+	''' Returns true if the tree of the finished root transaction is
+	captured, because it failed or was slower than its threshold.
+	'''
+	if transaction.is_error:
+		return True
+
+	threshold = get_capture_threshold(transaction.name)
+	return threshold is not None and transaction.duration > threshold
+
+
+def get_transaction_store():
+	''' Returns the store of captured transactions configured with
+	CAPTURE_STORE_SIZE.
+	'''
+	global transaction_store_singleton
+
+	if transaction_store_singleton is None:
+		transaction_store_singleton = TransactionStore(
+			size=carpy.config.get('CAPTURE_STORE_SIZE', 100),
+		)
+
+	return transaction_store_singleton
@@ -0,0 +1,225 @@
+__all__ = ['CarbonClient', 'CarbonPipeline']
+
+import os
+import pickle
+import queue
+import socket
+import struct
+import threading
+import time
+
+
+# Length prefix of the frames of Carbon's pickle protocol.
+FRAME_HEADER = struct.Struct('!L')
+
+# Seconds between reconnects grow up to this limit while Carbon is down.
+MAX_BACKOFF = 10.0
+
+
+def is_background_thread():
+	''' Returns true in the background threads of carpy, which may wait for
+	the queue. Other threads may serve requests.
+	'''
+	return threading.current_thread().name.startswith('carpy-')
+
+
+class CarbonClientBase(object):
+	''' Methods of the statsd client which add datapoints. '''
+
+	def timing(self, stat, delta, rate=1):
+		''' Adds the timing in milliseconds as a datapoint. Carbon keeps only
+		the last datapoint of a stat per retention period, so timings should
+		be aggregated first, e.g. with SENDER_MODE 'aggregate' or 'shared'.
+		'''
+		self._add(stat, delta)
+
+	def incr(self, stat, count=1, rate=1):
+		''' Adds the count, scaled by the sample rate, as a datapoint. '''
+		self._add(stat, count / float(rate))
+
+	def decr(self, stat, count=1, rate=1):
+		self.incr(stat, -count, rate)
+
+	def gauge(self, stat, value, rate=1, delta=False):
+		''' Adds the gauge as a datapoint. Carbon has no delta gauges, so
+		delta is ignored.
+		'''
+		self._add(stat, value)
+
+
+class CarbonClient(CarbonClientBase):
+	''' Sends datapoints directly to Carbon with the pickle protocol.
+
+	Datapoints are queued in batches and sent from a pool of threads, each
+	with its own persistent TCP connection. A batch which fails to send is
+	retried on a new connection, so it is not lost while Carbon restarts.
+	When the queue is full the batch is dropped and counted in `dropped`.
+	Only the background threads of carpy, e.g. the flush thread of the
+	aggregator, wait up to put_timeout seconds for a free place first, the
+	threads serving requests never wait.
+	'''
+
+	def __init__(self, host, port=2004, pool_size=2, queue_size=1000, batch_size=500, timeout=5.0, put_timeout=1.0):
+		'''
+		:param host:
+			Host of Carbon's pickle receiver.
+		:param port:
+			Port of Carbon's pickle receiver.
+		:param pool_size:
+			Number of connections and sender threads.
+		:param queue_size:
+			Maximum number of queued batches.
+		:param batch_size:
+			Maximum number of datapoints in a pickle frame.
+		:param timeout:
+			Socket timeout in seconds.
+		:param put_timeout:
+			Seconds a full queue is waited on by the background threads
+			before a batch is dropped.
+		'''
+		self.host = host
+		self.port = port
+		self.pool_size = pool_size
+		self.batch_size = batch_size
+		self.timeout = timeout
+		self.put_timeout = put_timeout
+
+		self.queue = queue.Queue(queue_size)
+
+		self.sent = 0
+		self.dropped = 0
+		self.errors = 0
+
+		self._threads = []
+		self._pid = None
+
+	def pipeline(self):
+		return CarbonPipeline(self)
+
+	def _add(self, stat, value):
+		self.send_datapoints([(stat, (int(time.time()), value))])
+
+	def send_datapoints(self, datapoints):
+		''' Queues the datapoints to be sent in batches of at most batch_size.
+
+		:param datapoints:
+			List of (path, (timestamp, value)) tuples.
+		'''
+		if self._pid != os.getpid():
+			self.start()
+
+		timeout = self.put_timeout if is_background_thread() else None
+		for i in range(0, len(datapoints), self.batch_size):
+			batch = datapoints[i:i + self.batch_size]
+			try:
+				if timeout is None:
+					self.queue.put_nowait(batch)
+				else:
+					self.queue.put(batch, timeout=timeout)
+			except queue.Full:
+				self.dropped += len(batch)
+
+	def start(self):
+		''' Starts the sender threads. Called automatically on the first send
+		and after fork, since neither the threads nor the connections of the
+		parent are used in the child.
+		'''
+		self._pid = os.getpid()
+		self.queue = queue.Queue(self.queue.maxsize)
+		self._threads = []
+		for _ in range(self.pool_size):
+			thread = threading.Thread(target=self._run, name='carpy-carbon')
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def connect(self):
+		''' Returns a new connection to Carbon. '''
+		return socket.create_connection((self.host, self.port), self.timeout)
+
+	def _run(self):
+		pid = os.getpid()
+		sock = None
+		backoff = 0.1
+
+		while self._pid == pid:
+			batch = self.queue.get()
+			try:
+				frame = pickle.dumps(batch, protocol=2)
+				frame = FRAME_HEADER.pack(len(frame)) + frame
+
+				while self._pid == pid:
+					try:
+						if sock is None:
+							sock = self.connect()
+						sock.sendall(frame)
+					except (OSError, socket.timeout):
+						self.errors += 1
+						if sock is not None:
+							sock.close()
+							sock = None
+						time.sleep(backoff)
+						backoff = min(backoff * 2, MAX_BACKOFF)
+					else:
+						self.sent += len(batch)
+						backoff = 0.1
+						break
+			finally:
+				self.queue.task_done()
+
+	def flush(self, timeout=None):
+		''' Waits until all the queued datapoints are sent.
+
+		:param timeout:
+			Maximum number of seconds to wait.
+		:returns:
+			bool. `False` if the timeout expired.
+		'''
+		deadline = time.time() + timeout if timeout is not None else None
+		while self.queue.unfinished_tasks:
+			if deadline is not None and time.time() >= deadline:
+				return False
+			time.sleep(0.01)
+		return True
+
+	def get_stats(self):
+		''' Returns counters of the client.
+
+		:returns:
+			dict with the number of queued batches, sent and dropped
+			datapoints and the number of failed sends.
+		'''
+		return {
+			'queued': self.queue.qsize(),
+			'sent': self.sent,
+			'dropped': self.dropped,
+			'errors': self.errors,
+		}
+
+
+class CarbonPipeline(CarbonClientBase):
+	''' Collects datapoints and queues them together when the pipeline is
+	sent, like the statsd client's pipeline.
+	'''
+
+	def __init__(self, client):
+		self._client = client
+		self._datapoints = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.send()
+
+	def pipeline(self):
+		return CarbonPipeline(self._client)
+
+	def _add(self, stat, value):
+		self._datapoints.append((stat, (int(time.time()), value)))
+
+	def send(self):
+		if not self._datapoints:
+			return
+		datapoints, self._datapoints = self._datapoints, []
+		self._client.send_datapoints(datapoints)
@@ -0,0 +1,118 @@
+__all__ = ['CardinalityLimiter', 'get_cardinality_limiter', 'clear_cardinality_limiter']
+
+import collections
+import threading
+
+import carpy
+
+
+# Name of the bucket which replaces the names over the limit.
+OTHER = '_other'
+
+cardinality_limiter_singleton = None
+
+
+class CardinalityLimiter(object):
+	''' Limits the number of distinct transaction names per subtree, i.e. the
+	names of root transactions or the names of the children of a transaction.
+
+	The first `limit` names seen in a subtree are kept, later new names are
+	replaced with `_other`. Subtrees are kept in a bounded LRU, so a subtree
+	which was not used for a long time is forgotten and counted from scratch.
+
+	It is only consulted when the stat names of a path are not cached yet.
+	'''
+
+	def __init__(self, limit=1000, max_subtrees=10000):
+		'''
+		:param limit:
+			Maximum number of distinct names per subtree.
+		:param max_subtrees:
+			Maximum number of subtrees whose names are remembered.
+		'''
+		self.limit = limit
+		self.max_subtrees = max_subtrees
+
+		# Known names by subtree, least recently used subtree first.
+		self.subtrees = collections.OrderedDict()
+
+		# Number of times a new name was replaced with `_other` by subtree.
+		self.overflows = collections.Counter()
+
+		self._lock = threading.Lock()
+
+	def limit_path(self, app_name, path):
+		''' Returns the path with the names over the limit replaced.
+
+		:param app_name:
+			Name of the application.
+		:param path:
+			Names of the transaction's ancestors and the transaction itself.
+		:returns:
+			Tuple of the limited path and the index of the first replaced name
+			or None if no name was replaced.
+		'''
+		limited = ()
+		overflow_index = None
+
+		with self._lock:
+			for index, name in enumerate(path):
+				key = (app_name, limited)
+				known = self.subtrees.get(key)
+				if known is None:
+					known = self.subtrees[key] = set()
+					if len(self.subtrees) > self.max_subtrees:
+						self.subtrees.popitem(last=False)
+				else:
+					self.subtrees.move_to_end(key)
+
+				if name not in known:
+					if len(known) < self.limit:
+						known.add(name)
+					elif name != OTHER:
+						self.overflows[key] += 1
+						name = OTHER
+						if overflow_index is None:
+							overflow_index = index
+
+				limited += (name,)
+
+		return limited, overflow_index
+
+	def get_stats(self):
+		''' Returns counters of the limiter.
+
+		:returns:
+			dict with the number of remembered subtrees and the number of
+			times a new name was replaced with `_other`.
+		'''
+		return {
+			'subtrees': len(self.subtrees),
+			'overflows': sum(self.overflows.values()),
+		}
+
+
+def get_cardinality_limiter():
+	''' Returns the cardinality limiter configured with CARDINALITY_LIMIT and
+	CARDINALITY_MAX_SUBTREES, or None if CARDINALITY_LIMIT is set to None.
+	'''
+	global cardinality_limiter_singleton
+
+	limit = carpy.config.get('CARDINALITY_LIMIT', 1000)
+	if limit is None:
+		return None
+
+	if cardinality_limiter_singleton is None:
+		cardinality_limiter_singleton = CardinalityLimiter(
+			limit=limit,
+			max_subtrees=carpy.config.get('CARDINALITY_MAX_SUBTREES', 10000),
+		)
+
+	return cardinality_limiter_singleton
+
+
+def clear_cardinality_limiter():
+	''' Forgets all the known names. '''
+	global cardinality_limiter_singleton
+
+	cardinality_limiter_singleton = None
@@ -0,0 +1,303 @@
+''' Propagation of the current transaction into thread and process pools.
+
+Functions submitted to a TracedThreadPoolExecutor run as children of the
+transaction which was current when they were submitted:
+
+	with carpy.futures.TracedThreadPoolExecutor(8) as executor:
+		users = list(executor.map(fetch_user, user_ids))
+
+Functions submitted to a TracedProcessPoolExecutor run as a transaction in
+the worker process. Its finished tree is returned together with the result
+and merged into the transaction the function was submitted from.
+
+Tasks run concurrently with the transaction they were submitted from, so
+their durations are not subtracted from its exclusive time. The time a task
+waited for a worker is reported as its `queued` timing.
+'''
+
+__all__ = [
+	'PoolTransaction',
+	'ProcessTask',
+	'TracedThreadPoolExecutor',
+	'TracedProcessPoolExecutor',
+	'wrap',
+	'wrap_process',
+]
+
+import concurrent.futures
+import contextvars
+import functools
+import time
+
+import carpy
+
+from .request_log import get_transaction_log
+from .transaction import FinishedTransaction, FinishedTransactions, Transaction, get_transaction, send_tree_stats
+
+
+# Types of the config values carried to worker processes. Other values, e.g.
+# a callable BACKEND, may not be picklable.
+TASK_CONFIG_TYPES = (str, int, float, bool, type(None), tuple, list, dict)
+
+
+def get_name(func):
+	''' Returns the name of the function, or of the function wrapped by a
+	functools.partial.
+	'''
+	while isinstance(func, functools.partial):
+		func = func.func
+	return getattr(func, '__name__', None) or type(func).__name__
+
+
+class PoolTransaction(Transaction):
+	''' Child transaction which runs in a pool concurrently with its parent.
+	'''
+
+	__slots__ = ()
+
+	concurrent = True
+
+
+def _run_in_pool(parent, name, submit_time, func, args, kwargs):
+	with PoolTransaction(name, parent=parent) as transaction:
+		transaction.add_timing('queued', max(transaction.start_time - submit_time, 0) / 1e6)
+		return func(*args, **kwargs)
+
+
+def wrap(func, name=None):
+	''' Returns a function which runs func as a child of the current
+	transaction in another thread. Wrap it right before it is submitted, the
+	time until it starts is reported as the `queued` timing of the child.
+
+	Tasks have to finish before the root transaction, stats of later tasks
+	are lost.
+
+	:param func:
+		Function to wrap.
+	:param name:
+		Name of the child transaction. Defaults to the name of the function.
+	:returns:
+		Wrapped function, or func if there is no current transaction.
+	'''
+	transaction = get_transaction()
+	if transaction is None:
+		return func
+
+	name = name or get_name(func)
+	context = contextvars.copy_context()
+	submit_time = time.perf_counter_ns()
+
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		# Every call runs in its own copy, a context can not be entered by
+		# more threads at once.
+		return context.copy().run(_run_in_pool, transaction, name, submit_time, func, args, kwargs)
+	return wrapper
+
+
+class TracedThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+	''' ThreadPoolExecutor which runs the submitted functions as children of
+	the transaction current in the submitting thread.
+	'''
+
+	def submit(self, fn, /, *args, **kwargs):
+		return super(TracedThreadPoolExecutor, self).submit(wrap(fn), *args, **kwargs)
+
+
+class RemoteResult(object):
+	''' Result of a ProcessTask with the finished tree of its transaction. '''
+
+	__slots__ = ('value', 'error', 'finished', 'log')
+
+	def __init__(self, value, error, finished, log):
+		self.value = value
+		self.error = error
+		self.finished = finished
+		self.log = log
+
+
+class RemoteTransaction(Transaction):
+	''' Transaction of a task in a worker process. Its stats are not sent,
+	the summaries of the whole tree are kept for the result of the task.
+	'''
+
+	__slots__ = ()
+
+	def __init__(self, task):
+		super(RemoteTransaction, self).__init__(task.name, sample_rate=task.sample_rate, app_name=task.app_name)
+
+		# Stat names continue the path of the transaction the task was
+		# submitted from.
+		self.path = task.path + (task.name,)
+		self.finished = FinishedTransactions(task.sample_rate)
+		self.log = get_transaction_log() if task.log else None
+
+	def send_stats(self):
+		self.finished.append(FinishedTransaction(self))
+		if self.log is not None:
+			self.log.finish(self)
+
+
+class ProcessTask(object):
+	''' Function wrapped to run in a worker process. Calling it returns the
+	result of the function together with the finished tree of its
+	transaction, which merge adds to the transaction it was wrapped in.
+
+	Only the function, the path of the transaction and the plain values of
+	the config are pickled, so the task can be sent to the worker process.
+	Workers started with `spawn` or `forkserver` do not inherit the config,
+	they get the carried one.
+	'''
+
+	def __init__(self, func, name, parent):
+		'''
+		:param func:
+			Function to run. It has to be picklable.
+		:param name:
+			Name of the transaction.
+		:param parent:
+			Transaction the tree is merged into.
+		'''
+		self.func = func
+		self.name = name
+		self.parent = parent
+		self.app_name = parent.app_name
+		self.config = {key: value for key, value in carpy.config.items() if isinstance(value, TASK_CONFIG_TYPES)}
+		self.path = parent.get_path()
+		self.sample_rate = parent.sample_rate
+		self.log = (parent.root or parent).log is not None
+		self.submit_time = time.perf_counter_ns()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['parent'] = None
+		return state
+
+	def __call__(self, *args, **kwargs):
+		# Tracing never stops the function from running, if it fails the
+		# result is returned without the tree.
+		transaction = None
+		try:
+			if 'APP_NAME' not in carpy.config:
+				carpy.config.update(self.config)
+			transaction = RemoteTransaction(self).__enter__()
+			# The monotonic clock is shared by the processes of the host.
+			transaction.add_timing('queued', max(transaction.start_time - self.submit_time, 0) / 1e6)
+		except Exception:
+			transaction = None
+
+		value = error = None
+		try:
+			value = self.func(*args, **kwargs)
+		except Exception as e:
+			error = e
+
+		if transaction is None:
+			return RemoteResult(value, error, [], None)
+
+		try:
+			if error is not None:
+				transaction.error()
+			transaction.__exit__()
+			return RemoteResult(value, error, list(transaction.finished), transaction.log)
+		except Exception:
+			return RemoteResult(value, error, [], None)
+
+	def merge(self, result):
+		''' Adds the finished tree of the task to the transaction it was
+		wrapped in.
+
+		:param result:
+			RemoteResult returned by the task.
+		:returns:
+			Result of the function. Its exception is raised instead if it
+			failed.
+		'''
+		parent = self.parent
+		root = parent.root or parent
+
+		# Root transactions which already finished, or retain their whole
+		# tree, have no summaries to add to.
+		finished = root.finished
+		if finished is None or root.duration:
+			tree = FinishedTransactions(root.sample_rate)
+			tree.extend(result.finished)
+			send_tree_stats(tree)
+		else:
+			finished.extend(result.finished)
+
+		# The request log is in the order the transactions finished, so the
+		# task is logged only while the transaction it was wrapped in is open.
+		if result.log and root.log is not None and not parent.duration:
+			root.log.merge(result.log, parent)
+
+		if result.error is not None:
+			raise result.error
+		return result.value
+
+
+def wrap_process(func, name=None):
+	''' Wraps the function to run in a worker process as a child of the
+	current transaction, e.g. with multiprocessing.Pool:
+
+		task = carpy.futures.wrap_process(resize)
+		image = task.merge(pool.apply(task, (image,)))
+
+	:param func:
+		Function to wrap. It has to be picklable.
+	:param name:
+		Name of the transaction. Defaults to the name of the function.
+	:returns:
+		ProcessTask, or func if there is no current transaction.
+	'''
+	transaction = get_transaction()
+	if transaction is None:
+		return func
+
+	return ProcessTask(func, name or get_name(func), transaction)
+
+
+class MergedFuture(concurrent.futures.Future):
+	''' Future of a ProcessTask which resolves to the result of the function
+	once the tree of the task was merged.
+	'''
+
+	def __init__(self, future, task):
+		super(MergedFuture, self).__init__()
+		self._future = future
+		self._task = task
+		future.add_done_callback(self._done)
+
+	def cancel(self):
+		return self._future.cancel()
+
+	def _done(self, future):
+		if future.cancelled():
+			super(MergedFuture, self).cancel()
+			self.set_running_or_notify_cancel()
+			return
+
+		self.set_running_or_notify_cancel()
+		try:
+			self.set_result(self._task.merge(future.result()))
+		except BaseException as e:
+			self.set_exception(e)
+
+
+class TracedProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
+	''' ProcessPoolExecutor which runs the submitted functions as children of
+	the transaction current in the submitting thread.
+	'''
+
+	def submit(self, fn, /, *args, **kwargs):
+		task = wrap_process(fn)
+		future = super(TracedProcessPoolExecutor, self).submit(task, *args, **kwargs)
+		if not isinstance(task, ProcessTask):
+			return future
+		return MergedFuture(future, task)
+
+	def map(self, fn, *iterables, timeout=None, chunksize=1):
+		''' Like ProcessPoolExecutor.map, but every call is submitted on its
+		own to be traced, so chunksize is ignored.
+		'''
+		return concurrent.futures.Executor.map(self, fn, *iterables, timeout=timeout)
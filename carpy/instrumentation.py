@@ -0,0 +1,184 @@
+__all__ = ['register', 'trace_methods', 'install', 'uninstall', 'recipes']
+
+import importlib.abc
+import importlib.util
+import sys
+import threading
+
+from .wrapper import function_trace_wrap
+
+
+# Instrumentation recipes by the name of the module they instrument. Recipes
+# are functions which get the module once it is imported.
+recipes = {}
+
+finder_singleton = None
+
+_lock = threading.RLock()
+
+
+def trace_methods(*attrs):
+	''' Returns a recipe which traces the functions or methods of the module
+	with function_trace_wrap. Transactions are named by the module and the
+	attribute, e.g. `memcache.Client.get`.
+
+	:param attrs:
+		Names of the functions or methods, e.g. `'urlopen'` or
+		`'Client.get'`.
+	'''
+	def recipe(module):
+		for attr in attrs:
+			func_parent = module
+			parts = attr.split('.')
+			for part in parts[:-1]:
+				func_parent = getattr(func_parent, part, None)
+
+			if func_parent is None or not hasattr(func_parent, parts[-1]):
+				continue
+
+			function_trace_wrap(func_parent, parts[-1], '%s.%s' % (module.__name__, attr))
+	return recipe
+
+
+def register(module_name, recipe):
+	''' Registers the instrumentation recipe of the module. If the import hook
+	is installed and the module was already imported, the recipe is applied
+	immediately.
+
+	:param module_name:
+		Full name of the module, e.g. `'memcache'`.
+	:param recipe:
+		Function which gets the module and instruments it.
+	'''
+	with _lock:
+		recipes.setdefault(module_name, []).append(recipe)
+
+		module = sys.modules.get(module_name)
+		if finder_singleton is not None and module is not None:
+			if getattr(module, '__carpy_instrumented__', False):
+				recipe(module)
+			else:
+				instrument(module)
+
+
+def instrument(module):
+	''' Applies the recipes registered for the module, once. '''
+	with _lock:
+		if getattr(module, '__carpy_instrumented__', False):
+			return
+		module.__carpy_instrumented__ = True
+
+		for recipe in recipes.get(module.__name__, ()):
+			recipe(module)
+
+
+class InstrumentingLoader(importlib.abc.Loader):
+	''' Loader which applies the recipes after the original loader executes
+	the module.
+	'''
+
+	def __init__(self, loader):
+		self.loader = loader
+
+	def create_module(self, spec):
+		return self.loader.create_module(spec)
+
+	def exec_module(self, module):
+		module.__spec__.loader = self.loader
+		module.__loader__ = self.loader
+
+		self.loader.exec_module(module)
+		instrument(module)
+
+	def __getattr__(self, name):
+		return getattr(self.loader, name)
+
+
+class InstrumentingFinder(importlib.abc.MetaPathFinder):
+	''' Import hook which instruments modules with registered recipes when
+	they are first imported. Other imports pass straight through.
+	'''
+
+	def __init__(self):
+		self._finding = threading.local()
+
+	def find_spec(self, fullname, path=None, target=None):
+		if fullname not in recipes:
+			return None
+
+		finding = self._finding.__dict__.setdefault('names', set())
+		if fullname in finding:
+			return None
+
+		finding.add(fullname)
+		try:
+			spec = importlib.util.find_spec(fullname)
+		finally:
+			finding.discard(fullname)
+
+		if spec is None or spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+			return spec
+
+		spec.loader = InstrumentingLoader(spec.loader)
+		return spec
+
+
+def install():
+	''' Installs the import hook and instruments the already imported modules
+	which have recipes.
+	'''
+	global finder_singleton
+
+	with _lock:
+		if finder_singleton is None:
+			finder_singleton = InstrumentingFinder()
+			sys.meta_path.insert(0, finder_singleton)
+
+		for module_name in list(recipes):
+			module = sys.modules.get(module_name)
+			if module is not None:
+				instrument(module)
+
+
+def uninstall():
+	''' Removes the import hook. Already instrumented modules stay
+	instrumented, use carpy.wrapper.disable() to stop tracing them.
+	'''
+	global finder_singleton
+
+	with _lock:
+		if finder_singleton is not None:
+			sys.meta_path.remove(finder_singleton)
+			finder_singleton = None
+
+
+register('urllib.request', trace_methods('urlopen'))
+register('MySQLdb.cursors', trace_methods('BaseCursor.execute', 'BaseCursor.executemany'))
+register('pymysql.cursors', trace_methods('Cursor.execute', 'Cursor.executemany'))
+register('pycassa.columnfamily', trace_methods(
+	'ColumnFamily.get',
+	'ColumnFamily.multiget',
+	'ColumnFamily.get_count',
+	'ColumnFamily.get_range',
+	'ColumnFamily.insert',
+	'ColumnFamily.batch_insert',
+	'ColumnFamily.remove',
+))
+register('memcache', trace_methods(
+	'Client.get',
+	'Client.get_multi',
+	'Client.set',
+	'Client.set_multi',
+	'Client.delete',
+	'Client.incr',
+	'Client.decr',
+))
+register('pymemcache.client.base', trace_methods(
+	'Client.get',
+	'Client.get_many',
+	'Client.set',
+	'Client.set_many',
+	'Client.delete',
+	'Client.incr',
+	'Client.decr',
+))
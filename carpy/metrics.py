@@ -0,0 +1,183 @@
+__all__ = ['Metrics', 'add_collector', 'get_metrics']
+
+import os
+import threading
+import time
+
+import carpy
+
+from .statsd_client import get_statsd_client
+
+
+metrics_singleton = None
+
+# Taken while metrics start, so that threads which record their first stats
+# at once do not start more flush threads.
+start_lock = threading.Lock()
+
+# Functions called with the metrics before every flush.
+collectors = []
+
+
+class Metrics(object):
+	''' Counters and gauges recorded in-process and sent every interval, so
+	that recording them costs a dict update instead of a packet.
+
+	Counters are summed between flushes. Gauges keep their last value, which
+	is sent on every flush until the gauge is removed.
+	'''
+
+	def __init__(self, interval=10, autostart=True):
+		'''
+		:param interval:
+			Seconds between flushes.
+		:param autostart:
+			Start the flush thread on the first recorded stat. If `False`,
+			flush has to be called explicitly.
+		'''
+		self.interval = interval
+		self.autostart = autostart
+
+		self.counters = {}
+		self.gauges = {}
+
+		self._lock = threading.Lock()
+		self._thread = None
+		self._pid = None
+
+	def incr(self, stat, count=1, rate=1):
+		''' Increments the counter.
+
+		:param stat:
+			Name of the stat.
+		:param count:
+			Value the counter is incremented by.
+		:param rate:
+			Rate at which the increment was sampled.
+		'''
+		self.ensure_started()
+
+		with self._lock:
+			self.counters[stat] = self.counters.get(stat, 0.0) + count / float(rate)
+
+	def gauge(self, stat, value, delta=False):
+		''' Sets the gauge.
+
+		:param stat:
+			Name of the stat.
+		:param value:
+			Value of the gauge.
+		:param delta:
+			Whether value is added to the current value of the gauge.
+		'''
+		self.ensure_started()
+
+		with self._lock:
+			if delta:
+				value += self.gauges.get(stat, 0)
+			self.gauges[stat] = value
+
+	def remove_gauge(self, stat):
+		''' Stops sending the gauge. '''
+		with self._lock:
+			self.gauges.pop(stat, None)
+
+	def ensure_started(self):
+		''' Starts the flush thread if autostart is enabled and it does not
+		run in this process yet.
+		'''
+		if self.autostart and self._pid != os.getpid():
+			self.start()
+
+	def reset(self):
+		''' Drops all the recorded stats. Called in the child process after
+		fork, the parent process sends them.
+		'''
+		self._lock = threading.Lock()
+		self.counters = {}
+		self.gauges = {}
+		self._pid = None
+
+	def start(self):
+		''' Starts the flush thread. Called automatically on the first stat
+		and after fork, since threads do not survive it. Does nothing if it
+		already runs in this process.
+		'''
+		with start_lock:
+			if self._pid == os.getpid():
+				return
+
+			self._thread = threading.Thread(target=self._run, name='carpy-metrics')
+			self._thread.daemon = True
+			self._thread.start()
+			self._pid = os.getpid()
+
+	def _run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.flush()
+			except Exception:
+				pass
+
+	def flush(self, statsd_client=None):
+		''' Sends the counters recorded since the last flush and the current
+		values of the gauges.
+
+		:param statsd_client:
+			Statsd client to send the stats with. Defaults to the configured
+			client.
+		'''
+		for collector in collectors:
+			collector(self)
+
+		with self._lock:
+			counters, self.counters = self.counters, {}
+			gauges = dict(self.gauges)
+
+		if not counters and not gauges:
+			return
+
+		statsd_client = statsd_client or get_statsd_client()
+
+		with statsd_client.pipeline() as pipeline:
+			for stat, count in counters.items():
+				pipeline.incr(stat, int(round(count)))
+
+			for stat, value in gauges.items():
+				pipeline.gauge(stat, value)
+
+
+def add_collector(collector):
+	''' Registers a function which records stats right before every flush,
+	e.g. gauges of values which change too often to be set on every change.
+
+	:param collector:
+		Function called with the Metrics instance.
+	'''
+	collectors.append(collector)
+
+
+def get_metrics():
+	''' Returns the metrics configured with METRICS_INTERVAL. '''
+	global metrics_singleton
+
+	if metrics_singleton is None:
+		metrics_singleton = Metrics(
+			interval=carpy.config.get('METRICS_INTERVAL', 10),
+		)
+
+	return metrics_singleton
+
+
+def _after_fork_in_child():
+	global start_lock
+
+	# Another thread of the parent may have held it.
+	start_lock = threading.Lock()
+
+	if metrics_singleton is not None:
+		metrics_singleton.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
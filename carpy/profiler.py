@@ -0,0 +1,206 @@
+__all__ = ['StackSampler', 'get_stack_sampler']
+
+import collections
+import os
+import sys
+import threading
+import time
+
+import carpy
+
+from . import transaction as transaction_module
+
+
+# Stacks of a transaction name beyond the limit are counted here.
+TRUNCATED = '[truncated]'
+
+stack_sampler_singleton = None
+
+
+def _get_original(module_name, attr):
+	''' Returns the attribute of the module as it was before gevent monkey
+	patched it, so that the sampler runs in a native thread.
+	'''
+	monkey = sys.modules.get('gevent.monkey')
+	if monkey is not None:
+		return monkey.get_original(module_name, attr)
+	return getattr(__import__(module_name), attr)
+
+
+class StackSampler(object):
+	''' Statistical profiler which periodically samples the stacks of the
+	threads and greenlets with an open root transaction and counts them as
+	folded stacks by the name of the transaction.
+
+	Only the stacks of traced requests are walked, so idle threads cost
+	nothing. The sampler runs in a native thread even if gevent monkey
+	patched threading, so it keeps sampling while greenlets block the hub.
+	The interval is stretched if a sample takes longer than max_overhead of
+	the interval.
+	'''
+
+	def __init__(self, interval=0.01, max_depth=64, max_stacks=10000, max_overhead=0.01):
+		'''
+		:param interval:
+			Seconds between samples.
+		:param max_depth:
+			Maximum number of frames of a sampled stack, the innermost ones
+			are kept.
+		:param max_stacks:
+			Maximum number of distinct stacks counted per transaction name.
+		:param max_overhead:
+			Maximum fraction of the time spent sampling.
+		'''
+		self.interval = interval
+		self.max_depth = max_depth
+		self.max_stacks = max_stacks
+		self.max_overhead = max_overhead
+
+		self.stacks = {}
+		self.samples = 0
+		self.sampling_time = 0.0
+
+		# Frame labels by code object.
+		self._labels = {}
+		self._lock = threading.Lock()
+		self._pid = None
+		self._running = False
+
+	def start(self):
+		''' Starts the sampler thread unless it already runs in this process.
+		It is restarted in child processes after fork.
+		'''
+		if self._pid == os.getpid():
+			return
+
+		with self._lock:
+			if self._pid == os.getpid():
+				return
+			self._pid = os.getpid()
+			self._running = True
+			self.stacks = {}
+			_get_original('_thread', 'start_new_thread')(self._run, ())
+
+	def stop(self):
+		''' Stops the sampler thread. '''
+		self._running = False
+		self._pid = None
+
+	def _run(self):
+		sleep = _get_original('time', 'sleep')
+		pid = os.getpid()
+
+		while self._running and self._pid == pid:
+			start = time.perf_counter()
+			try:
+				self.sample()
+			except Exception:
+				pass
+			elapsed = time.perf_counter() - start
+			self.sampling_time += elapsed
+
+			sleep(max(self.interval, elapsed / self.max_overhead))
+
+	def sample(self):
+		''' Samples the stacks of all the open root transactions. '''
+		frames = sys._current_frames()
+
+		for transaction in list(transaction_module.transactions_cache.values()):
+			frame = None
+			greenlet = transaction.greenlet
+			if greenlet is not None:
+				# The frame of a running greenlet is the frame of its thread.
+				frame = greenlet.gr_frame
+			if frame is None:
+				frame = frames.get(transaction.thread_ident)
+			if frame is None:
+				continue
+
+			self.add_stack(transaction.name, self.get_stack(frame))
+
+		self.samples += 1
+
+	def get_stack(self, frame):
+		''' Returns the folded stack of the frame, outermost frame first. '''
+		labels = self._labels
+		stack = []
+		while frame is not None and len(stack) < self.max_depth:
+			code = frame.f_code
+			label = labels.get(code)
+			if label is None:
+				label = labels[code] = '%s:%s' % (code.co_filename, code.co_name)
+			stack.append(label)
+			frame = frame.f_back
+
+		stack.reverse()
+		return ';'.join(stack)
+
+	def add_stack(self, name, stack):
+		''' Counts the folded stack of the transaction. '''
+		counts = self.stacks.get(name)
+		if counts is None:
+			counts = self.stacks[name] = collections.Counter()
+
+		if stack not in counts and len(counts) >= self.max_stacks:
+			stack = TRUNCATED
+		counts[stack] += 1
+
+	def get_folded(self, name=None):
+		''' Returns the counted stacks in the folded format of flame graph
+		tools, `name;outer frame;...;inner frame count` per line.
+
+		:param name:
+			Name of the transaction. All the transactions are returned if not
+			set.
+		'''
+		lines = []
+		for transaction_name, counts in list(self.stacks.items()):
+			if name is not None and transaction_name != name:
+				continue
+			for stack, count in list(counts.items()):
+				lines.append('%s;%s %d' % (transaction_name, stack, count))
+		return '\n'.join(lines)
+
+	def clear(self):
+		''' Drops the counted stacks. '''
+		self.stacks = {}
+		self.samples = 0
+		self.sampling_time = 0.0
+
+	def get_stats(self):
+		''' Returns counters of the sampler.
+
+		:returns:
+			dict with the number of samples taken and the seconds spent
+			taking them.
+		'''
+		return {
+			'samples': self.samples,
+			'sampling_time': self.sampling_time,
+		}
+
+
+def get_stack_sampler():
+	''' Returns the stack sampler configured with PROFILER_INTERVAL,
+	PROFILER_MAX_DEPTH, PROFILER_MAX_STACKS and PROFILER_MAX_OVERHEAD.
+	'''
+	global stack_sampler_singleton
+
+	if stack_sampler_singleton is None:
+		stack_sampler_singleton = StackSampler(
+			interval=carpy.config.get('PROFILER_INTERVAL', 0.01),
+			max_depth=carpy.config.get('PROFILER_MAX_DEPTH', 64),
+			max_stacks=carpy.config.get('PROFILER_MAX_STACKS', 10000),
+			max_overhead=carpy.config.get('PROFILER_MAX_OVERHEAD', 0.01),
+		)
+
+	return stack_sampler_singleton
+
+
+def _after_fork_in_child():
+	if stack_sampler_singleton is not None and stack_sampler_singleton._running:
+		stack_sampler_singleton._lock = threading.Lock()
+		stack_sampler_singleton.start()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,446 @@
+''' Request log of complete transaction trees.
+
+Finished root transactions are encoded into compact binary records in a
+per-process ring buffer, which a background thread appends to a rotating
+file. Records are read back as JSON lines with
+
+	python -m carpy.request_log requests.log [requests.log.1 ...]
+'''
+
+__all__ = ['RequestLog', 'TransactionLog', 'get_request_log', 'read_records', 'decode_record']
+
+import argparse
+import itertools
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import carpy
+
+
+# Length of the record which follows.
+RECORD_LENGTH = struct.Struct('<I')
+
+# Wall clock start time of the root transaction in seconds, the number of
+# transactions in the record and the number of transactions left out of it.
+RECORD_HEADER = struct.Struct('<dHI')
+
+# Index of the parent in the record, start in microseconds after the root
+# started, duration in microseconds, flags and length of the name, followed by
+# the name. Start and duration are capped at about 71 minutes. The
+# transactions are in the order they finished, so the root is the last one
+# and is its own parent.
+NODE = struct.Struct('<HIIBH')
+
+# Maximum number of children in a record, the root is the last node.
+MAX_CHILDREN = 65534
+
+FLAG_ERROR = 1
+
+request_log_singleton = None
+
+
+class TransactionLog(list):
+	''' ID, parent ID, name, start time, duration and error flag of the
+	finished transactions of a tree, kept on the root transaction for the
+	request log and the capture of slow trees.
+
+	Children get their ID when they start, the root has ID 0. Children are
+	nested by the ID of their parent, since concurrent children, e.g. in
+	asyncio tasks or thread pools, do not finish in the order they started.
+
+	Only the first max_children children are kept, the later ones are
+	counted in `truncated` unless they are ancestors of kept children, so
+	that kept children stay in their place in the tree. The root
+	transaction is appended when it finishes.
+	'''
+
+	__slots__ = ('max_children', 'truncated', 'ids', 'counter', 'kept_parents')
+
+	def __init__(self, max_children=1000):
+		'''
+		:param max_children:
+			Maximum number of children kept. Records hold at most
+			MAX_CHILDREN of them.
+		'''
+		super(TransactionLog, self).__init__()
+		self.max_children = max_children
+		self.truncated = 0
+
+		# IDs of the open children by their object ID.
+		self.ids = {}
+		self.counter = itertools.count(1)
+
+		# IDs of the parents of kept children which did not finish yet.
+		self.kept_parents = set()
+
+	def __reduce__(self):
+		# Logs of tasks in worker processes are pickled without the IDs of
+		# open children.
+		return (_restore_transaction_log, (list(self), self.max_children, self.truncated))
+
+	def add_entry(self, entry):
+		''' Adds the entry of a finished child, or counts it as truncated if
+		the log is full and it is not an ancestor of a kept child.
+		'''
+		node_id, parent_id = entry[:2]
+		if node_id in self.kept_parents:
+			self.kept_parents.discard(node_id)
+		elif len(self) >= self.max_children:
+			self.truncated += 1
+			return
+		self.kept_parents.add(parent_id)
+		self.append(entry)
+
+	def start(self, transaction):
+		''' Assigns an ID to the started child transaction. '''
+		self.ids[id(transaction)] = next(self.counter)
+
+	def add(self, transaction):
+		''' Adds the finished child transaction. Children of a parent which
+		already finished are added as children of the root.
+		'''
+		node_id = self.ids.pop(id(transaction), None)
+		if node_id is None:
+			node_id = next(self.counter)
+		parent_id = self.ids.get(id(transaction.parent), 0)
+		self.add_entry((node_id, parent_id, transaction.name, transaction.start_time, transaction.duration, transaction.is_error))
+
+	def finish(self, transaction):
+		''' Adds the finished root transaction. '''
+		self.append((0, 0, transaction.name, transaction.start_time, transaction.duration, transaction.is_error))
+
+	def merge(self, log, parent):
+		''' Adds the finished transactions of another tree, e.g. of a task
+		run in a worker process, as descendants of the parent.
+
+		:param log:
+			TransactionLog to add, including its root.
+		:param parent:
+			Open transaction of this tree the root of the log is a child of.
+		'''
+		parent_id = self.ids.get(id(parent), 0)
+		ids = {}
+		for entry in log:
+			ids[entry[0]] = next(self.counter)
+
+		for node_id, node_parent_id, name, start_time, duration, is_error in log:
+			node_parent_id = parent_id if node_id == 0 else ids.get(node_parent_id, parent_id)
+			self.add_entry((ids[node_id], node_parent_id, name, start_time, duration, is_error))
+		self.truncated += log.truncated
+
+
+def _restore_transaction_log(entries, max_children, truncated):
+	log = TransactionLog(max_children)
+	log.extend(entries)
+	log.truncated = truncated
+	return log
+
+
+def get_transaction_log():
+	''' Returns an empty transaction log limited by MAX_LOGGED_CHILDREN. '''
+	return TransactionLog(carpy.config.get('MAX_LOGGED_CHILDREN', 1000))
+
+
+class RequestLog(object):
+	''' Writes finished transaction trees to a rotating, append-only file.
+
+	Records are appended to a fixed size ring buffer on the request thread,
+	which takes only a short lock. A daemon thread moves them to the file
+	every interval, or sooner when the buffer is half full. Records which do
+	not fit into the buffer are dropped and counted in `dropped`.
+	'''
+
+	def __init__(self, path, buffer_size=1048576, max_bytes=104857600, backup_count=5, interval=1.0):
+		'''
+		:param path:
+			Path of the log file. `{pid}` in it is replaced with the process
+			ID, so that every process writes its own file.
+		:param buffer_size:
+			Size of the ring buffer in bytes.
+		:param max_bytes:
+			Size of the file after which it is rotated.
+		:param backup_count:
+			Number of rotated files kept, as path.1, path.2, ...
+		:param interval:
+			Seconds between writes to the file.
+		'''
+		self.path = path
+		self.buffer_size = buffer_size
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self.interval = interval
+
+		self.written = 0
+		self.dropped = 0
+		self.errors = 0
+
+		self.reset()
+
+	def reset(self):
+		''' Empties the ring buffer. Called in the child process after fork,
+		the parent process writes the buffered records.
+		'''
+		self.buffer = bytearray(self.buffer_size)
+		self.write_pos = 0
+		self.read_pos = 0
+
+		self._lock = threading.Lock()
+		self._flush_lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._thread = None
+		self._pid = None
+
+	def get_path(self):
+		''' Returns the path of the log file of the process. '''
+		return self.path.replace('{pid}', str(os.getpid()))
+
+	def start(self):
+		''' Starts the flush thread. Called automatically on the first record
+		and after fork, since threads do not survive it.
+		'''
+		self._pid = os.getpid()
+		self._thread = threading.Thread(target=self._run, name='carpy-request-log')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			self._wakeup.wait(self.interval)
+			self._wakeup.clear()
+			try:
+				self.flush()
+			except Exception:
+				self.errors += 1
+
+	def write(self, transaction):
+		''' Appends the record of the finished root transaction to the
+		buffer.
+
+		:param transaction:
+			Root transaction with the log of its finished transactions.
+		'''
+		record = encode_record(transaction)
+		record = RECORD_LENGTH.pack(len(record)) + record
+
+		if self._pid != os.getpid():
+			self.start()
+
+		buffer_size = self.buffer_size
+		with self._lock:
+			write_pos = self.write_pos
+			used = write_pos - self.read_pos
+			if used + len(record) > buffer_size:
+				self.dropped += 1
+				return
+
+			start = write_pos % buffer_size
+			end = start + len(record)
+			if end <= buffer_size:
+				self.buffer[start:end] = record
+			else:
+				split = buffer_size - start
+				self.buffer[start:] = record[:split]
+				self.buffer[:end - buffer_size] = record[split:]
+			self.write_pos = write_pos + len(record)
+
+		if used + len(record) > buffer_size // 2 and not self._wakeup.is_set():
+			self._wakeup.set()
+
+	def flush(self):
+		''' Appends the buffered records to the file and rotates it if it is
+		too big.
+		'''
+		with self._flush_lock:
+			buffer_size = self.buffer_size
+			with self._lock:
+				read_pos, write_pos = self.read_pos, self.write_pos
+				start = read_pos % buffer_size
+				end = start + write_pos - read_pos
+				if end <= buffer_size:
+					data = bytes(self.buffer[start:end])
+				else:
+					data = bytes(self.buffer[start:]) + bytes(self.buffer[:end - buffer_size])
+				self.read_pos = write_pos
+
+			if not data:
+				return
+
+			path = self.get_path()
+			with open(path, 'ab') as f:
+				f.write(data)
+				size = f.tell()
+			self.written += len(data)
+
+			if self.max_bytes and size >= self.max_bytes:
+				self.rotate(path)
+
+	def rotate(self, path):
+		''' Renames path to path.1, path.1 to path.2 and so on, dropping the
+		oldest file.
+		'''
+		for i in range(self.backup_count - 1, 0, -1):
+			source = '%s.%d' % (path, i)
+			if os.path.exists(source):
+				os.replace(source, '%s.%d' % (path, i + 1))
+
+		if self.backup_count:
+			os.replace(path, '%s.1' % path)
+		else:
+			os.remove(path)
+
+	def get_stats(self):
+		''' Returns counters of the request log.
+
+		:returns:
+			dict with the number of buffered and written bytes, dropped
+			records and failed flushes.
+		'''
+		return {
+			'buffered': self.write_pos - self.read_pos,
+			'written': self.written,
+			'dropped': self.dropped,
+			'errors': self.errors,
+		}
+
+
+def encode_record(transaction):
+	''' Returns the binary record of the finished root transaction. '''
+	# The root transaction is the last one. Ancestors finish after their
+	# descendants, so the last entries are kept if there are too many.
+	log = transaction.log
+	truncated = getattr(log, 'truncated', 0) + max(len(log) - MAX_CHILDREN - 1, 0)
+	log = log[-MAX_CHILDREN - 1:]
+	start_time = transaction.start_time
+	wall_start_time = time.time() - transaction.duration
+
+	# Children whose parent is not in the record are added to the root.
+	root_index = len(log) - 1
+	indexes = {entry[0]: index for index, entry in enumerate(log)}
+
+	parts = [RECORD_HEADER.pack(wall_start_time, len(log), min(truncated, 0xffffffff))]
+	for node_id, parent_id, name, node_start_time, duration, is_error in log:
+		name = name.encode('utf-8')[:65535]
+		parts.append(NODE.pack(
+			indexes.get(parent_id, root_index),
+			min(max(node_start_time - start_time, 0) // 1000, 0xffffffff),
+			min(int(duration * 1e6), 0xffffffff),
+			FLAG_ERROR if is_error else 0,
+			len(name),
+		))
+		parts.append(name)
+
+	return b''.join(parts)
+
+
+def decode_record(data):
+	''' Returns the transaction tree of the binary record.
+
+	:param data:
+		Record without the length prefix.
+	:returns:
+		dict with the name, start time in seconds, duration in milliseconds
+		and error flag of the root transaction and the list of its children
+		in the same format. The root has the number of children left out of
+		the record as `truncated`.
+	'''
+	wall_start_time, count, truncated = RECORD_HEADER.unpack_from(data, 0)
+	position = RECORD_HEADER.size
+
+	nodes = []
+	parents = []
+	for _ in range(count):
+		parent, start, duration, flags, name_length = NODE.unpack_from(data, position)
+		position += NODE.size
+		name = data[position:position + name_length].decode('utf-8', 'replace')
+		position += name_length
+
+		nodes.append({
+			'name': name,
+			'start': round(wall_start_time + start / 1e6, 6),
+			'duration': duration / 1e3,
+			'error': bool(flags & FLAG_ERROR),
+			'children': [],
+		})
+		parents.append(parent)
+
+	if not nodes:
+		return None
+
+	root = nodes[-1]
+	for index, node in enumerate(nodes[:-1]):
+		parent = parents[index]
+		parent = nodes[parent] if parent < count and parent != index else root
+		parent['children'].append(node)
+
+	for node in nodes:
+		node['children'].sort(key=lambda child: child['start'])
+
+	root['truncated'] = truncated
+	return root
+
+
+def read_records(f):
+	''' Yields the transaction trees of the records in the file.
+
+	:param f:
+		File opened in binary mode.
+	'''
+	while True:
+		length = f.read(RECORD_LENGTH.size)
+		if len(length) < RECORD_LENGTH.size:
+			return
+
+		data = f.read(RECORD_LENGTH.unpack(length)[0])
+		if len(data) < RECORD_LENGTH.unpack(length)[0]:
+			return
+
+		yield decode_record(data)
+
+
+def get_request_log():
+	''' Returns the request log configured with REQUEST_LOG_PATH,
+	REQUEST_LOG_BUFFER_SIZE, REQUEST_LOG_MAX_BYTES, REQUEST_LOG_BACKUP_COUNT
+	and REQUEST_LOG_INTERVAL.
+	'''
+	global request_log_singleton
+
+	if request_log_singleton is None:
+		request_log_singleton = RequestLog(
+			carpy.config['REQUEST_LOG_PATH'],
+			buffer_size=carpy.config.get('REQUEST_LOG_BUFFER_SIZE', 1048576),
+			max_bytes=carpy.config.get('REQUEST_LOG_MAX_BYTES', 104857600),
+			backup_count=carpy.config.get('REQUEST_LOG_BACKUP_COUNT', 5),
+			interval=carpy.config.get('REQUEST_LOG_INTERVAL', 1.0),
+		)
+
+	return request_log_singleton
+
+
+def _after_fork_in_child():
+	if request_log_singleton is not None:
+		request_log_singleton.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Prints the records of carpy request logs as JSON lines.')
+	parser.add_argument('paths', nargs='+', help='request log files, oldest first')
+	args = parser.parse_args()
+
+	try:
+		for path in args.paths:
+			with open(path, 'rb') as f:
+				for record in read_records(f):
+					sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+	except BrokenPipeError:
+		pass
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,122 @@
+__all__ = ['Sampler', 'get_sampler']
+
+import random
+import threading
+import time
+
+import carpy
+
+
+# Adaptive sampling never lowers the sample rates below this fraction.
+MIN_ADAPTIVE_FACTOR = 0.001
+
+sampler_singleton = None
+
+
+class Sampler(object):
+	''' Decides which transactions are traced.
+
+	Each transaction name can have its own sample rate. With an overhead budget
+	set, the sample rates are adaptively lowered so that the time carpy spends
+	finishing transactions stays under the budget.
+	'''
+
+	def __init__(self, sample_rates=None, default_sample_rate=1.0, overhead_budget=None, window=1.0):
+		'''
+		:param sample_rates:
+			Dict of sample rates by transaction name.
+		:param default_sample_rate:
+			Sample rate of transactions which are not in sample_rates.
+		:param overhead_budget:
+			Seconds per second carpy can spend finishing transactions. If not
+			set, sample rates are not adapted.
+		:param window:
+			Seconds between adjustments of the adaptive sample rates.
+		'''
+		self.sample_rates = sample_rates or {}
+		self.default_sample_rate = default_sample_rate
+		self.overhead_budget = overhead_budget
+		self.window = window
+
+		self.adaptive_factor = 1.0
+
+		self._overhead = 0
+		self._window_start = time.monotonic()
+		self._lock = threading.Lock()
+
+	def get_sample_rate(self, name):
+		''' Returns the current sample rate of the transaction.
+
+		:param name:
+			Name of the transaction.
+		'''
+		sample_rate = self.sample_rates.get(name, self.default_sample_rate)
+		return min(sample_rate * self.adaptive_factor, 1.0)
+
+	def sample(self, name):
+		''' Decides whether the transaction is traced.
+
+		:param name:
+			Name of the transaction.
+		:returns:
+			The sample rate if the transaction should be traced, 0 otherwise.
+		'''
+		sample_rate = self.get_sample_rate(name)
+		if sample_rate >= 1.0:
+			return 1.0
+		if random.random() < sample_rate:
+			return sample_rate
+		return 0
+
+	def add_overhead(self, overhead):
+		''' Records the time carpy spent finishing a transaction and adapts
+		the sample rates once per window.
+
+		:param overhead:
+			Overhead in nanoseconds.
+		'''
+		self._overhead += overhead
+
+		now = time.monotonic()
+		if now - self._window_start >= self.window:
+			with self._lock:
+				if now - self._window_start >= self.window:
+					self.adapt(now)
+
+	def adapt(self, now):
+		''' Adapts the sample rates to the overhead measured in the last
+		window.
+
+		:param now:
+			Current time of time.monotonic().
+		'''
+		elapsed = now - self._window_start
+		overhead = self._overhead / 1e9 / elapsed
+
+		self._overhead = 0
+		self._window_start = now
+
+		if overhead > self.overhead_budget:
+			self.adaptive_factor *= self.overhead_budget / overhead
+		elif overhead < self.overhead_budget / 2:
+			self.adaptive_factor *= 2
+
+		self.adaptive_factor = min(max(self.adaptive_factor, MIN_ADAPTIVE_FACTOR), 1.0)
+
+
+def get_sampler():
+	''' Returns the sampler configured with SAMPLE_RATES, DEFAULT_SAMPLE_RATE
+	and OVERHEAD_BUDGET.
+	'''
+	global sampler_singleton
+
+	if sampler_singleton is None:
+		overhead_budget = carpy.config.get('OVERHEAD_BUDGET')
+
+		sampler_singleton = Sampler(
+			sample_rates=dict(carpy.config.get('SAMPLE_RATES') or {}),
+			default_sample_rate=float(carpy.config.get('DEFAULT_SAMPLE_RATE', 1.0)),
+			overhead_budget=float(overhead_budget) if overhead_budget is not None else None,
+		)
+
+	return sampler_singleton
@@ -0,0 +1,180 @@
+__all__ = ['BackgroundSender', 'get_sender']
+
+import collections
+import os
+import threading
+
+import carpy
+
+from .statsd_client import get_statsd_client
+
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+# Number of transactions sent in one pipeline. statsd's pipeline gets slow
+# with a large number of stats so big queues are sent in chunks.
+BATCH_SIZE = 100
+
+sender_singleton = None
+
+# Taken while a sender starts, so that threads which put their first
+# transactions at once do not start more sender threads.
+start_lock = threading.Lock()
+
+
+class SenderConfigError(ValueError):
+	pass
+
+
+class BackgroundSender(object):
+	''' Sends finished transactions to statsd from a daemon thread so that the
+	socket calls are not made on the request thread.
+
+	Transactions are put on a bounded queue. When the queue is full either
+	the oldest queued transaction or the new one is dropped, depending on the
+	drop policy. Dropped transactions are counted in `dropped`.
+
+	Works with both native threads and gevent monkey patched threads.
+	'''
+
+	def __init__(self, queue_size=10000, drop_policy=DROP_OLDEST):
+		if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+			raise SenderConfigError('Unknown drop policy %r' % drop_policy)
+
+		self.queue_size = queue_size
+		self.drop_policy = drop_policy
+
+		# deque's append and popleft are atomic, so the producers never take
+		# a lock. With maxlen set, append drops the oldest item by itself.
+		if drop_policy == DROP_OLDEST:
+			self.queue = collections.deque(maxlen=queue_size)
+		else:
+			self.queue = collections.deque()
+
+		self.sent = 0
+		self.dropped = 0
+		self.errors = 0
+
+		self._wakeup = threading.Event()
+		self._thread = None
+		self._pid = None
+
+	def put(self, transaction):
+		''' Queues the finished root transaction to be sent.
+
+		:param transaction:
+			Finished root transaction.
+		:returns:
+			bool. `False` if the transaction was dropped, `True` otherwise.
+		'''
+		queue = self.queue
+		if len(queue) >= self.queue_size:
+			self.dropped += 1
+			if self.drop_policy == DROP_NEWEST:
+				return False
+
+		queue.append(transaction)
+
+		if self._pid != os.getpid():
+			self.start()
+
+		# Setting the event takes a lock, so it is only done when the sender
+		# thread is sleeping.
+		if not self._wakeup.is_set():
+			self._wakeup.set()
+
+		return True
+
+	def reset(self):
+		''' Drops the queued transactions. Called in the child process after
+		fork, the parent process sends them.
+		'''
+		self.queue.clear()
+		self._wakeup = threading.Event()
+		self._pid = None
+
+	def start(self):
+		''' Starts the sender thread. Called automatically on first put and
+		after fork, since threads do not survive it. Does nothing if it
+		already runs in this process.
+		'''
+		with start_lock:
+			if self._pid == os.getpid():
+				return
+
+			self._wakeup = threading.Event()
+			self._thread = threading.Thread(target=self._run, name='carpy-sender')
+			self._thread.daemon = True
+			self._thread.start()
+			self._pid = os.getpid()
+
+	def _run(self):
+		while True:
+			self._wakeup.wait()
+			self._wakeup.clear()
+			self.flush()
+
+	def flush(self):
+		''' Sends all queued transactions. '''
+		queue = self.queue
+		while queue:
+			batch = []
+			while queue and len(batch) < BATCH_SIZE:
+				try:
+					batch.append(queue.popleft())
+				except IndexError:
+					break
+
+			try:
+				statsd_client = get_statsd_client()
+				with statsd_client.pipeline() as pipeline:
+					for transaction in batch:
+						transaction.add_tree_stats(pipeline)
+			except Exception:
+				self.errors += 1
+				self.dropped += len(batch)
+			else:
+				self.sent += len(batch)
+
+	def get_stats(self):
+		''' Returns counters of the sender.
+
+		:returns:
+			dict with the number of queued, sent and dropped transactions and
+			the number of failed sends.
+		'''
+		return {
+			'queued': len(self.queue),
+			'sent': self.sent,
+			'dropped': self.dropped,
+			'errors': self.errors,
+		}
+
+
+def get_sender():
+	''' Returns the background sender configured with SENDER_QUEUE_SIZE and
+	SENDER_DROP_POLICY.
+	'''
+	global sender_singleton
+
+	if sender_singleton is None:
+		sender_singleton = BackgroundSender(
+			queue_size=carpy.config.get('SENDER_QUEUE_SIZE', 10000),
+			drop_policy=carpy.config.get('SENDER_DROP_POLICY', DROP_OLDEST),
+		)
+
+	return sender_singleton
+
+
+def _after_fork_in_child():
+	global start_lock
+
+	# Another thread of the parent may have held it.
+	start_lock = threading.Lock()
+
+	if sender_singleton is not None:
+		sender_singleton.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
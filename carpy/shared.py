@@ -0,0 +1,466 @@
+__all__ = ['SharedAggregator', 'get_shared_aggregator']
+
+import fcntl
+import mmap
+import os
+import re
+import stat
+import struct
+import tempfile
+import threading
+import time
+
+import carpy
+
+from .aggregator import Aggregator, get_aggregator, get_apdex_index
+
+
+MAGIC = b'carpyshm'
+
+# Magic, number of slots and slot size at the start of the file. The rest of
+# the header is reserved, its first bytes are used for locks.
+FILE_HEADER = struct.Struct('<8sII')
+FILE_HEADER_SIZE = 64
+
+# Byte locked while the file header is initialized.
+INIT_LOCK = 0
+
+# Byte locked by the elected flusher process as long as it lives.
+FLUSHER_LOCK = 1
+
+# Write and read positions at the start of every slot. Positions only grow,
+# the data is at position % capacity.
+SLOT_HEADER = struct.Struct('<QQ')
+
+# Type, name length, value and sample rate of every record, followed by the
+# stat name.
+RECORD = struct.Struct('<cHdd')
+
+TIMING = b't'
+COUNTER = b'c'
+APDEX = b'a'
+GAUGE = b'g'
+
+shared_aggregator_singleton = None
+
+# Taken while a shared aggregator starts, so that threads which record their
+# first stats at once do not claim more slots.
+start_lock = threading.Lock()
+
+
+class SharedMemoryConfigError(ValueError):
+	pass
+
+
+class SharedAggregator(object):
+	''' Aggregates stats of all the processes of a host, e.g. pre-fork
+	workers of gunicorn or uwsgi, in a memory-mapped file and sends them to
+	statsd from a single process.
+
+	Every process claims a slot of the file by locking it and appends its
+	timings, counters and Apdex counts to the slot's ring buffer. The slot has
+	a single writer and a single reader, so no locks are shared between the
+	processes on the write path. Locks of a process are released by the
+	kernel when it exits, so the slots of restarted workers are reclaimed.
+
+	Every interval each process tries to become the flusher. The process
+	which holds the flusher lock reads the records of all the slots,
+	aggregates them like Aggregator and sends the summaries. If it exits,
+	another process takes over.
+
+	Gauges are summed over the processes, the flusher keeps the last value
+	of every process until the process exits.
+
+	If all the slots are taken, stats are aggregated in-process instead.
+	'''
+
+	def __init__(self, path, num_slots=64, slot_size=262144, interval=10, reservoir_size=1024):
+		'''
+		:param path:
+			Path of the memory-mapped file shared by the processes.
+		:param num_slots:
+			Maximum number of processes writing into the file.
+		:param slot_size:
+			Bytes of records buffered per process between flushes.
+		:param interval:
+			Seconds between flushes.
+		:param reservoir_size:
+			Number of samples kept per stat for percentiles.
+		'''
+		self.path = path
+		self.num_slots = num_slots
+		self.slot_size = slot_size
+		self.interval = interval
+		self.reservoir_size = reservoir_size
+
+		self.capacity = slot_size - SLOT_HEADER.size
+		self.dropped = 0
+
+		# Last values of the gauges by slot, kept by the flusher process.
+		self.gauges = {}
+
+		self._fd = None
+		self._mmap = None
+		self._slot = None
+		self._lock = threading.Lock()
+		self._thread = None
+		self._pid = None
+
+	def open(self):
+		''' Maps the file, creating it if needed, and checks that it has the
+		same layout as configured.
+		'''
+		size = FILE_HEADER_SIZE + self.num_slots * self.slot_size
+
+		# The file is never followed through a symlink, and it has to be
+		# private to the user, otherwise others could read or forge stats.
+		fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+		try:
+			check_private(self.path, os.fstat(fd), stat.S_ISREG)
+
+			fcntl.lockf(fd, fcntl.LOCK_EX, 1, INIT_LOCK)
+			try:
+				if os.fstat(fd).st_size < size:
+					os.ftruncate(fd, size)
+
+				header = os.pread(fd, FILE_HEADER.size, 0)
+				magic, num_slots, slot_size = FILE_HEADER.unpack(header)
+				if magic == MAGIC:
+					if (num_slots, slot_size) != (self.num_slots, self.slot_size):
+						raise SharedMemoryConfigError(
+							'%s has %d slots of %d bytes, configured %d slots of %d bytes' % (
+								self.path, num_slots, slot_size, self.num_slots, self.slot_size))
+				else:
+					os.pwrite(fd, FILE_HEADER.pack(MAGIC, self.num_slots, self.slot_size), 0)
+			finally:
+				fcntl.lockf(fd, fcntl.LOCK_UN, 1, INIT_LOCK)
+
+			self._mmap = mmap.mmap(fd, size)
+		except Exception:
+			os.close(fd)
+			raise
+
+		self._fd = fd
+
+	def close(self):
+		''' Unmaps the file and releases the slot and the flusher lock of the
+		process.
+		'''
+		if self._mmap is not None:
+			self._mmap.close()
+			os.close(self._fd)
+
+		self._mmap = None
+		self._fd = None
+		self._slot = None
+		self._pid = None
+
+	def start(self):
+		''' Claims a free slot and starts the flush thread. Called
+		automatically on the first recorded stat and after fork, since
+		neither the locks nor the threads survive it. Does nothing if it
+		already runs in this process.
+		'''
+		with start_lock:
+			if self._pid == os.getpid():
+				return
+
+			self._lock = threading.Lock()
+
+			if self._mmap is None:
+				self.open()
+
+			self._slot = None
+			for slot in range(self.num_slots):
+				try:
+					fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self._get_offset(slot))
+				except OSError:
+					continue
+				self._slot = slot
+				break
+
+			self._thread = threading.Thread(target=self._run, name='carpy-shared-aggregator')
+			self._thread.daemon = True
+			self._thread.start()
+
+			# Set last, other threads record stats once it is started.
+			self._pid = os.getpid()
+
+	def _get_offset(self, slot):
+		return FILE_HEADER_SIZE + slot * self.slot_size
+
+	def _run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				if self.elect():
+					self.flush()
+			except Exception:
+				pass
+
+	def elect(self):
+		''' Tries to become the flusher process.
+
+		:returns:
+			bool. `True` if this process is the flusher.
+		'''
+		try:
+			fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, FLUSHER_LOCK)
+		except OSError:
+			return False
+		return True
+
+	def timing(self, stat, delta, rate=1):
+		''' Records the timing.
+
+		:param stat:
+			Name of the stat.
+		:param delta:
+			Timing in milliseconds.
+		:param rate:
+			Rate at which the timing was sampled.
+		'''
+		self._write(TIMING, stat, delta, rate)
+
+	def incr(self, stat, count=1, rate=1):
+		''' Increments the counter.
+
+		:param stat:
+			Name of the stat.
+		:param count:
+			Value the counter is incremented by.
+		:param rate:
+			Rate at which the increment was sampled.
+		'''
+		self._write(COUNTER, stat, count, rate)
+
+	def gauge(self, stat, value):
+		''' Sets the gauge of the process. The sum over the processes is
+		sent.
+
+		:param stat:
+			Name of the stat.
+		:param value:
+			Value of the gauge.
+		'''
+		self._write(GAUGE, stat, value, 1)
+
+	def apdex(self, stat_prefix, duration, is_error, thresholds, rate=1):
+		''' Counts the transaction as satisfied, tolerating or frustrated, see
+		Aggregator.apdex.
+		'''
+		self._write(APDEX, stat_prefix, get_apdex_index(duration, is_error, thresholds), rate)
+
+	def _write(self, record_type, stat, value, rate):
+		if self._pid != os.getpid():
+			self.start()
+
+		if self._slot is None:
+			aggregator = get_aggregator()
+			if record_type == TIMING:
+				aggregator.timing(stat, value, rate)
+			elif record_type == COUNTER:
+				aggregator.incr(stat, value, rate)
+			elif record_type == GAUGE:
+				aggregator.gauge(stat, value)
+			else:
+				aggregator.add_apdex(stat, int(value), rate)
+			return
+
+		name = stat.encode('utf-8')
+		record = RECORD.pack(record_type, len(name), value, rate) + name
+
+		offset = self._get_offset(self._slot)
+		data_offset = offset + SLOT_HEADER.size
+		capacity = self.capacity
+		shared = self._mmap
+
+		with self._lock:
+			write_pos, read_pos = SLOT_HEADER.unpack_from(shared, offset)
+			if write_pos - read_pos + len(record) > capacity:
+				self.dropped += 1
+				return
+
+			start = write_pos % capacity
+			end = start + len(record)
+			if end <= capacity:
+				shared[data_offset + start:data_offset + end] = record
+			else:
+				split = capacity - start
+				shared[data_offset + start:data_offset + capacity] = record[:split]
+				shared[data_offset:data_offset + end - capacity] = record[split:]
+
+			# The position is written after the record, so the reader never
+			# sees a partially written record.
+			struct.pack_into('<Q', shared, offset, write_pos + len(record))
+
+	def read(self, aggregator):
+		''' Moves the records of all the slots into the aggregator. Only the
+		flusher process may call it.
+
+		:param aggregator:
+			Aggregator the records are replayed into.
+		'''
+		if self._mmap is None:
+			self.open()
+
+		shared = self._mmap
+		capacity = self.capacity
+
+		for slot in range(self.num_slots):
+			offset = self._get_offset(slot)
+			data_offset = offset + SLOT_HEADER.size
+
+			write_pos, read_pos = SLOT_HEADER.unpack_from(shared, offset)
+			if write_pos == read_pos:
+				continue
+
+			start = read_pos % capacity
+			end = start + write_pos - read_pos
+			if end <= capacity:
+				data = shared[data_offset + start:data_offset + end]
+			else:
+				data = shared[data_offset + start:data_offset + capacity] + shared[data_offset:data_offset + end - capacity]
+
+			struct.pack_into('<Q', shared, offset + 8, write_pos)
+
+			position = 0
+			while position < len(data):
+				record_type, name_length, value, rate = RECORD.unpack_from(data, position)
+				position += RECORD.size
+				stat = data[position:position + name_length].decode('utf-8')
+				position += name_length
+
+				if record_type == TIMING:
+					aggregator.timing(stat, value, rate)
+				elif record_type == COUNTER:
+					aggregator.incr(stat, value, rate)
+				elif record_type == APDEX:
+					aggregator.add_apdex(stat, int(value), rate)
+				elif record_type == GAUGE:
+					self.gauges.setdefault(slot, {})[stat] = value
+
+		totals = {}
+		for slot, gauges in list(self.gauges.items()):
+			if not self.is_claimed(slot):
+				del self.gauges[slot]
+				continue
+			for stat, value in gauges.items():
+				totals[stat] = totals.get(stat, 0) + value
+
+		for stat, value in totals.items():
+			aggregator.gauge(stat, value)
+			if not value:
+				# Zero in all the processes, it is not sent anymore.
+				for gauges in self.gauges.values():
+					gauges.pop(stat, None)
+
+	def is_claimed(self, slot):
+		''' Returns true if the slot is claimed by a running process.
+
+		:param slot:
+			Index of the slot.
+		'''
+		if slot == self._slot:
+			return True
+
+		offset = self._get_offset(slot)
+		try:
+			fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+		except OSError:
+			return True
+		fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+		return False
+
+	def flush(self, statsd_client=None):
+		''' Sends summaries of the stats of all the processes recorded since
+		the last flush. Only the flusher process may call it.
+
+		:param statsd_client:
+			Statsd client to send the summaries with. Defaults to the
+			configured client.
+		'''
+		aggregator = Aggregator(reservoir_size=self.reservoir_size, autostart=False)
+		self.read(aggregator)
+		aggregator.flush(statsd_client)
+
+	def get_stats(self):
+		''' Returns counters of the shared aggregator.
+
+		:returns:
+			dict with the claimed slot of the process and the number of
+			records dropped because the slot was full.
+		'''
+		return {
+			'slot': self._slot,
+			'dropped': self.dropped,
+		}
+
+
+def check_private(path, st, is_type):
+	''' Raises SharedMemoryConfigError unless the file is of the type and is
+	owned and accessible only by the user of the process.
+
+	:param path:
+		Path of the file, for the error message.
+	:param st:
+		Result of stat of the file.
+	:param is_type:
+		Function checking the type of the file, e.g. stat.S_ISREG.
+	'''
+	if not is_type(st.st_mode):
+		raise SharedMemoryConfigError('%s is not a %s' % (path, 'directory' if is_type is stat.S_ISDIR else 'regular file'))
+	if st.st_uid != os.geteuid():
+		raise SharedMemoryConfigError('%s is owned by another user' % path)
+	if st.st_mode & 0o077:
+		raise SharedMemoryConfigError('%s is accessible by other users, mode %o' % (path, stat.S_IMODE(st.st_mode)))
+
+
+def get_shared_memory_path():
+	''' Returns the path of the file configured with SHARED_MEMORY_PATH. It
+	defaults to a file named by APP_NAME in a directory private to the user
+	in the temporary directory, so all the processes of an application run by
+	the user on the host share it.
+	'''
+	path = carpy.config.get('SHARED_MEMORY_PATH')
+	if path:
+		return path
+
+	directory = os.path.join(tempfile.gettempdir(), 'carpy-%d' % os.geteuid())
+	try:
+		os.mkdir(directory, 0o700)
+	except FileExistsError:
+		pass
+	check_private(directory, os.lstat(directory), stat.S_ISDIR)
+
+	app_name = re.sub(r'[^\w.-]', '_', carpy.config['APP_NAME'])
+	return os.path.join(directory, '%s.shm' % app_name)
+
+
+def get_shared_aggregator():
+	''' Returns the shared aggregator configured with SHARED_MEMORY_PATH,
+	SHARED_MEMORY_SLOTS, SHARED_MEMORY_SLOT_SIZE, AGGREGATE_INTERVAL and
+	AGGREGATE_RESERVOIR_SIZE.
+	'''
+	global shared_aggregator_singleton
+
+	if shared_aggregator_singleton is None:
+		shared_aggregator_singleton = SharedAggregator(
+			get_shared_memory_path(),
+			num_slots=carpy.config.get('SHARED_MEMORY_SLOTS', 64),
+			slot_size=carpy.config.get('SHARED_MEMORY_SLOT_SIZE', 262144),
+			interval=carpy.config.get('AGGREGATE_INTERVAL', 10),
+			reservoir_size=carpy.config.get('AGGREGATE_RESERVOIR_SIZE', 1024),
+		)
+
+	return shared_aggregator_singleton
+
+
+def _after_fork_in_child():
+	global start_lock
+
+	# Another thread of the parent may have held it.
+	start_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,9 +1,13 @@
-__all__ = ['get_statsd_client']
+__all__ = ['StatsClient', 'get_statsd_client', 'is_backend_configured']
+
+import os
 
 import statsd
 
 import carpy
 
+from .carbon import CarbonClient
+
 
 statsd_client_singleton = None
 
@@ -12,6 +16,48 @@ class StatsDConfigError(AttributeError):
 	pass
 
 
+def format_rate(rate):
+	''' Formats the sample rate without an exponent, which statsd does not
+	parse, e.g. for tiny sample rates.
+	'''
+	return ('%.9f' % max(rate, 1e-9)).rstrip('0')
+
+
+class StatsClient(statsd.StatsClient):
+	''' Statsd client which sends timings with sub-millisecond precision. '''
+
+	def pipeline(self):
+		return Pipeline(self)
+
+	def timing(self, stat, delta, rate=1):
+		''' Sends new timing information. `delta` is in milliseconds and
+		can be a float.
+
+		Unlike in statsd.StatsClient, `rate` is the rate at which the timing
+		was already sampled. It is only reported to statsd so that it can
+		scale the counts.
+		'''
+		value = '%0.3f|ms' % delta
+		if rate < 1:
+			value = '%s|@%s' % (value, format_rate(rate))
+		self._send_stat(stat, value, 1)
+
+	def incr(self, stat, count=1, rate=1):
+		''' Increments a counter. Like in timing, `rate` is the rate at which
+		the increment was already sampled.
+		'''
+		value = '%s|c' % count
+		if rate < 1:
+			value = '%s|@%s' % (value, format_rate(rate))
+		self._send_stat(stat, value, 1)
+
+
+class Pipeline(statsd.client.Pipeline, StatsClient):
+	''' Pipeline of the statsd client which sends timings with
+	sub-millisecond precision.
+	'''
+
+
 def _init_statsd_client():
 	statsd_host = carpy.config.get('STATSD_HOST')
 	if not statsd_host:
@@ -21,7 +67,64 @@ def _init_statsd_client():
 	if not statsd_port:
 		raise StatsDConfigError('Missing STATSD_PORT config')
 
-	return statsd.StatsClient(statsd_host, statsd_port)
+	statsd_max_udp_size = carpy.config.get('STATSD_MAX_UDP_SIZE', 512)
+
+	return StatsClient(statsd_host, statsd_port, maxudpsize=statsd_max_udp_size)
+
+def _init_carbon_client():
+	carbon_host = carpy.config.get('CARBON_HOST')
+	if not carbon_host:
+		raise StatsDConfigError('Missing CARBON_HOST config')
+	if carpy.config.get('SENDER_MODE') not in CARBON_SENDER_MODES:
+		raise StatsDConfigError('BACKEND carbon requires SENDER_MODE aggregate or shared')
+
+	return CarbonClient(
+		carbon_host,
+		port=carpy.config.get('CARBON_PORT', 2004),
+		pool_size=carpy.config.get('CARBON_POOL_SIZE', 2),
+		queue_size=carpy.config.get('CARBON_QUEUE_SIZE', 1000),
+		batch_size=carpy.config.get('CARBON_BATCH_SIZE', 500),
+	)
+
+# Factories of the clients by the BACKEND config.
+backends = {
+	'statsd': _init_statsd_client,
+	'carbon': _init_carbon_client,
+}
+
+# Config which has to be set for the backend to be used.
+backend_hosts = {
+	'statsd': 'STATSD_HOST',
+	'carbon': 'CARBON_HOST',
+}
+
+# Carbon keeps only the last datapoint per retention period, so it is used
+# only with timings aggregated in-process.
+CARBON_SENDER_MODES = ('aggregate', 'shared')
+
+def _init_backend_client():
+	backend = carpy.config.get('BACKEND') or 'statsd'
+	if callable(backend):
+		return backend()
+
+	if backend not in backends:
+		raise StatsDConfigError('Unknown BACKEND %r' % backend)
+
+	return backends[backend]()
+
+def is_backend_configured():
+	''' Returns true if the host of the configured backend is set. Custom
+	backends are always configured, Carbon only with SENDER_MODE 'aggregate'
+	or 'shared'.
+	'''
+	backend = carpy.config.get('BACKEND') or 'statsd'
+	if callable(backend) or backend not in backend_hosts:
+		return True
+
+	if backend == 'carbon' and carpy.config.get('SENDER_MODE') not in CARBON_SENDER_MODES:
+		return False
+
+	return bool(carpy.config.get(backend_hosts[backend]))
 
 def is_client_initialized():
 	''' Returns true if statsd client is initialized.
@@ -30,12 +133,28 @@ def is_client_initialized():
 	return bool(statsd_client_singleton)
 
 def get_statsd_client():
-	''' Returns an instance of statsd client if STATSD_HOST and STATSD_PORT are configured.
-	Throws a StatsDConfigError exception othervwse.
+	''' Returns the client of the backend configured with BACKEND, the statsd
+	client by default. Throws a StatsDConfigError exception if the backend is
+	not configured.
+
+	BACKEND is 'statsd', 'carbon' or a function which returns a client. A
+	client has the timing, incr, decr and gauge methods of statsd.StatsClient
+	and a pipeline method which returns a context manager with the same
+	methods, which sends the stats when it exits.
 	'''
 	global statsd_client_singleton
 
 	if not is_client_initialized():
-		statsd_client_singleton = _init_statsd_client()
+		statsd_client_singleton = _init_backend_client()
 
 	return statsd_client_singleton
+
+
+def _after_fork_in_child():
+	# The child gets a socket of its own instead of sharing the parent's.
+	global statsd_client_singleton
+
+	statsd_client_singleton = None
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
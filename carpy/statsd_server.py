@@ -0,0 +1,326 @@
+''' Local stand-in for statsd which aggregates the stats it receives in memory,
+for tests and load runs without outside services.
+
+	python -m carpy.statsd_server --port 8125 --interval 10
+
+prints the summaries of every interval as JSON lines.
+'''
+
+__all__ = ['StatsdServer', 'parse_packet', 'summarize']
+
+import argparse
+import array
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def parse_packet(data):
+	''' Parses a statsd packet with one or more newline separated stats. A
+	line can also have more values of the same stat separated by colons.
+
+	:param data:
+		Packet as bytes or str.
+	:returns:
+		Tuple of the list of (name, value, type, sample rate) tuples and the
+		number of lines which could not be parsed. Values of gauges with a
+		sign are kept as strings, since they are deltas.
+	'''
+	if isinstance(data, bytes):
+		data = data.decode('utf-8', 'replace')
+
+	stats = []
+	errors = 0
+	for line in data.split('\n'):
+		if not line:
+			continue
+
+		name, _, values = line.partition(':')
+		if not name or not values:
+			errors += 1
+			continue
+
+		for value in values.split(':'):
+			fields = value.split('|')
+			try:
+				stat_type = fields[1]
+				rate = float(fields[2][1:]) if len(fields) > 2 and fields[2][:1] == '@' else 1.0
+				if stat_type == 'g' and fields[0][:1] in '+-':
+					value = fields[0]
+					float(value)
+				elif stat_type == 's':
+					value = fields[0]
+				else:
+					value = float(fields[0])
+			except (IndexError, ValueError):
+				errors += 1
+				continue
+
+			stats.append((name, value, stat_type, rate))
+
+	return stats, errors
+
+
+def summarize(values, count=None):
+	''' Returns the summary of timings with the same semantics as statsd timers
+	and carpy.aggregator.Histogram. Computed with numpy if it is installed.
+
+	:param values:
+		Timings in milliseconds, a sequence or an array('d').
+	:param count:
+		Number of timings scaled by their sample rates. Defaults to the
+		number of values.
+	:returns:
+		dict with mean, median, upper, upper_95, lower and count.
+	'''
+	num_values = len(values)
+	if not num_values:
+		return {'count': 0}
+
+	if count is None:
+		count = num_values
+
+	num_in_threshold = max(int(round(0.95 * num_values)), 1)
+	middle = num_values // 2
+
+	if numpy is not None:
+		values = numpy.sort(numpy.asarray(values, dtype=numpy.float64))
+		mean = float(values.mean())
+		lower = float(values[0])
+		upper = float(values[-1])
+		upper_95 = float(values[num_in_threshold - 1])
+		if num_values % 2:
+			median = float(values[middle])
+		else:
+			median = float(values[middle - 1] + values[middle]) / 2.0
+	else:
+		values = sorted(values)
+		mean = sum(values) / num_values
+		lower = values[0]
+		upper = values[-1]
+		upper_95 = values[num_in_threshold - 1]
+		if num_values % 2:
+			median = values[middle]
+		else:
+			median = (values[middle - 1] + values[middle]) / 2.0
+
+	return {
+		'mean': mean,
+		'median': median,
+		'upper': upper,
+		'upper_95': upper_95,
+		'lower': lower,
+		'count': int(round(count)),
+	}
+
+
+class StatsdServer(object):
+	''' UDP server which receives statsd packets and aggregates them in
+	memory: all the timings are kept for exact summaries, counters are scaled
+	by their sample rates, gauges and sets work as in statsd.
+
+	It can drop a part of the received packets on purpose to check how the
+	numbers hold up under packet loss.
+	'''
+
+	def __init__(self, host='127.0.0.1', port=0, drop_rate=0.0, seed=None):
+		'''
+		:param host:
+			Address to listen on.
+		:param port:
+			Port to listen on, a free port is picked by default.
+		:param drop_rate:
+			Fraction of the received packets which are dropped.
+		:param seed:
+			Seed of the random drops.
+		'''
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+		self.sock.bind((host, port))
+		self.sock.settimeout(0.1)
+		self.host, self.port = self.sock.getsockname()[:2]
+
+		self.drop_rate = drop_rate
+		self._random = random.Random(seed)
+
+		self._lock = threading.Lock()
+		self._thread = None
+		self._running = False
+
+		self.reset()
+
+	def reset(self):
+		''' Clears the aggregated stats and the counters. '''
+		with self._lock:
+			self.timers = {}
+			self.timer_counts = {}
+			self.counters = {}
+			self.gauges = {}
+			self.sets = {}
+
+			self.packets = 0
+			self.dropped_packets = 0
+			self.lines = 0
+			self.bad_lines = 0
+
+	def start(self):
+		''' Starts receiving in a daemon thread. '''
+		self._running = True
+		self._thread = threading.Thread(target=self._run, name='carpy-statsd-server')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def close(self):
+		''' Stops receiving and closes the socket. '''
+		self._running = False
+		if self._thread is not None:
+			self._thread.join()
+		self.sock.close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+	def _run(self):
+		while self._running:
+			try:
+				data = self.sock.recv(65535)
+			except socket.timeout:
+				continue
+			except OSError:
+				break
+			self.handle_packet(data)
+
+	def handle_packet(self, data):
+		''' Aggregates the stats of the packet.
+
+		:param data:
+			Packet as bytes.
+		'''
+		if self.drop_rate and self._random.random() < self.drop_rate:
+			self.dropped_packets += 1
+			return
+
+		stats, errors = parse_packet(data)
+
+		with self._lock:
+			self.packets += 1
+			self.lines += len(stats)
+			self.bad_lines += errors
+
+			for name, value, stat_type, rate in stats:
+				if stat_type == 'ms' or stat_type == 'h':
+					timer = self.timers.get(name)
+					if timer is None:
+						timer = self.timers[name] = array.array('d')
+					timer.append(value)
+					self.timer_counts[name] = self.timer_counts.get(name, 0.0) + 1.0 / rate
+				elif stat_type == 'c':
+					self.counters[name] = self.counters.get(name, 0.0) + value / rate
+				elif stat_type == 'g':
+					if isinstance(value, str):
+						value = self.gauges.get(name, 0.0) + float(value)
+					self.gauges[name] = value
+				elif stat_type == 's':
+					self.sets.setdefault(name, set()).add(value)
+				else:
+					self.bad_lines += 1
+
+	def wait(self, lines=None, timeout=5.0, idle=0.1):
+		''' Waits until the number of lines is received or, if not set, until
+		no packets arrive for a while.
+
+		:param lines:
+			Number of received lines to wait for.
+		:param timeout:
+			Maximum number of seconds to wait.
+		:param idle:
+			Seconds without packets after which the server is considered
+			idle.
+		:returns:
+			bool. `False` if the timeout expired.
+		'''
+		deadline = time.time() + timeout
+		last = -1
+		while time.time() < deadline:
+			received = self.packets + self.dropped_packets
+			if lines is not None:
+				if self.lines >= lines:
+					return True
+			elif received == last:
+				return True
+			last = received
+			time.sleep(idle)
+
+		return False
+
+	def get_timer(self, name):
+		''' Returns the summary of the timer.
+
+		:param name:
+			Name of the stat.
+		:returns:
+			dict with mean, median, upper, upper_95, lower and count.
+		'''
+		with self._lock:
+			values = self.timers.get(name, ())
+			count = self.timer_counts.get(name, 0.0)
+		return summarize(values, count)
+
+	def get_summary(self):
+		''' Returns the summaries of all the received stats.
+
+		:returns:
+			dict with the timers, counters, gauges and set sizes by stat name
+			and the packet counters.
+		'''
+		with self._lock:
+			timers = dict((name, summarize(values, self.timer_counts[name])) for name, values in self.timers.items())
+			return {
+				'timers': timers,
+				'counters': dict(self.counters),
+				'gauges': dict(self.gauges),
+				'sets': dict((name, len(values)) for name, values in self.sets.items()),
+				'packets': self.packets,
+				'dropped_packets': self.dropped_packets,
+				'lines': self.lines,
+				'bad_lines': self.bad_lines,
+			}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Local stand-in for statsd.')
+	parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+	parser.add_argument('--port', type=int, default=8125, help='port to listen on')
+	parser.add_argument('--interval', type=float, default=10, help='seconds between printed summaries')
+	parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of packets to drop')
+	args = parser.parse_args()
+
+	server = StatsdServer(args.host, args.port, drop_rate=args.drop_rate).start()
+	try:
+		while True:
+			time.sleep(args.interval)
+			summary = server.get_summary()
+			server.reset()
+			summary['time'] = int(time.time())
+			sys.stdout.write(json.dumps(summary, sort_keys=True) + '\n')
+			sys.stdout.flush()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
+
+
+if __name__ == '__main__':
+	main()
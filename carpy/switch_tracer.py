@@ -0,0 +1,71 @@
+''' Greenlet switch tracer which splits the wall time of root transactions
+running in greenlets into the time their greenlet ran (`oncpu` timer) and the
+time it was parked while other greenlets ran or the hub waited (`parked`
+timer). A high parked time of quick requests points to a saturated hub.
+
+While installed, it also keeps the current greenlet of the thread in
+carpy.transaction.switch_state, so that finding the current greenlet does not
+have to look up the greenlet module on every transaction.
+
+greenlet switch tracing is per thread, so install it in the thread which runs
+the gevent hub, usually the main thread:
+
+	carpy.switch_tracer.install()
+'''
+
+__all__ = ['install', 'uninstall']
+
+import time
+
+import greenlet
+
+from .transaction import switch_state, transactions_cache
+
+
+def _trace(event, args):
+	if event == 'switch' or event == 'throw':
+		origin, target = args
+		now = time.perf_counter_ns()
+
+		transaction = transactions_cache.get(id(origin))
+		if transaction is not None and transaction.on_cpu_time is not None:
+			resume_time = transaction.resume_time if transaction.resume_time is not None else transaction.start_time
+			transaction.on_cpu_time += now - resume_time
+
+		transaction = transactions_cache.get(id(target))
+		if transaction is not None:
+			transaction.resume_time = now
+
+		switch_state.greenlet = target if target.parent is not None else None
+
+	previous = switch_state.previous
+	if previous is not None:
+		previous(event, args)
+
+
+def install():
+	''' Installs the switch tracer in the current thread. A trace function
+	installed before, e.g. by gevent's monitoring, is still called.
+	'''
+	if switch_state.installed:
+		return
+
+	switch_state.previous = greenlet.settrace(_trace)
+
+	current_greenlet = greenlet.getcurrent()
+	switch_state.greenlet = current_greenlet if current_greenlet.parent is not None else None
+	switch_state.installed = True
+
+
+def uninstall():
+	''' Removes the switch tracer from the current thread. Transactions which
+	are open keep being measured until they finish, but their greenlet
+	switches are not counted anymore.
+	'''
+	if not switch_state.installed:
+		return
+
+	switch_state.installed = False
+	switch_state.greenlet = None
+	greenlet.settrace(switch_state.previous)
+	switch_state.previous = None
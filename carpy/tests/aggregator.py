@@ -0,0 +1,144 @@
+import threading
+from unittest import TestCase
+
+import carpy
+import carpy.aggregator
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class AggregatorTest(TestCase):
+
+	def test_histogram_summary(self):
+		histogram = carpy.aggregator.Histogram(100)
+		for value in range(1, 21):
+			histogram.add(value)
+
+		self.assertEqual(histogram.get_summary(), {
+			'mean': 10.5,
+			'median': 10.5,
+			'upper': 20,
+			'upper_95': 19,
+			'lower': 1,
+			'count': 20,
+		})
+
+	def test_histogram_fixed_size(self):
+		histogram = carpy.aggregator.Histogram(10)
+		for value in range(1000):
+			histogram.add(value)
+
+		self.assertEqual(len(histogram.samples), 10)
+
+		summary = histogram.get_summary()
+		self.assertEqual(summary['count'], 1000)
+		self.assertEqual(summary['lower'], 0)
+		self.assertEqual(summary['upper'], 999)
+		self.assertEqual(summary['mean'], 499.5)
+
+	def test_flush(self):
+		aggregator = carpy.aggregator.Aggregator()
+		aggregator.start = mock.Mock()
+		statsd_client = mock.MagicMock()
+		pipeline = statsd_client.pipeline.return_value.__enter__.return_value
+
+		aggregator.timing('stat', 10)
+		aggregator.timing('stat', 20)
+		aggregator.timing('stat2', 5)
+		aggregator.flush(statsd_client)
+
+		pipeline.incr.assert_any_call('stat.count', 2)
+		pipeline.incr.assert_any_call('stat2.count', 1)
+		pipeline.gauge.assert_any_call('stat.mean', 15.0)
+		pipeline.gauge.assert_any_call('stat.upper', 20)
+		pipeline.gauge.assert_any_call('stat2.upper_95', 5)
+		self.assertEqual(pipeline.gauge.call_count, 10)
+		self.assertEqual(aggregator.histograms, {})
+
+		statsd_client.reset_mock()
+		aggregator.flush(statsd_client)
+		self.assertFalse(statsd_client.pipeline.called)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'SENDER_MODE': 'aggregate'}, clear=True)
+	@mock.patch('carpy.transaction.get_statsd_client')
+	@mock.patch('carpy.transaction.get_aggregator')
+	def test_transaction_aggregate_mode(self, get_aggregator_mock, get_statsd_client_mock):
+		with carpy.transaction.Transaction('Test') as transaction:
+			with carpy.transaction.Transaction('Child', parent=transaction) as child:
+				pass
+
+		aggregator = get_aggregator_mock.return_value
+		aggregator.timing.assert_any_call(transaction.get_stat_name(), mock.ANY, 1.0)
+		aggregator.timing.assert_any_call(child.get_stat_name(), mock.ANY, 1.0)
+		self.assertFalse(get_statsd_client_mock.called)
+
+	def test_concurrent_start(self):
+		aggregator = carpy.aggregator.Aggregator(interval=3600)
+		barrier = threading.Barrier(8)
+
+		def run():
+			barrier.wait()
+			aggregator.timing('stat', 1)
+
+		with mock.patch('carpy.aggregator.threading.Thread', wraps=threading.Thread) as thread_mock:
+			threads = [threading.Thread(target=run) for _ in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		self.assertEqual(len([c for c in thread_mock.call_args_list if c[1].get('name') == 'carpy-aggregator']), 1)
+		self.assertEqual(aggregator.histograms['stat'].get_summary()['count'], 8)
+
+	def test_apdex(self):
+		aggregator = carpy.aggregator.Aggregator()
+		aggregator.start = mock.Mock()
+		statsd_client = mock.MagicMock()
+		pipeline = statsd_client.pipeline.return_value.__enter__.return_value
+
+		aggregator.apdex('prefix', 0.1, False, (0.5, 2.0))
+		aggregator.apdex('prefix', 0.4, False, (0.5, 2.0))
+		aggregator.apdex('prefix', 1.0, False, (0.5, 2.0))
+		aggregator.apdex('prefix', 3.0, False, (0.5, 2.0))
+		aggregator.apdex('prefix', 0.1, True, (0.5, 2.0))
+		aggregator.flush(statsd_client)
+
+		pipeline.gauge.assert_called_once_with('prefix.apdex.score', 0.5)
+		pipeline.incr.assert_any_call('prefix.apdex.satisfied', 2)
+		pipeline.incr.assert_any_call('prefix.apdex.tolerating', 1)
+		pipeline.incr.assert_any_call('prefix.apdex.frustrated', 2)
+		self.assertEqual(aggregator.apdex_counts, {})
+
+	def test_apdex_sample_rate(self):
+		aggregator = carpy.aggregator.Aggregator()
+		aggregator.start = mock.Mock()
+
+		aggregator.apdex('prefix', 0.1, False, (0.5, 2.0), 0.25)
+		self.assertEqual(aggregator.apdex_counts['prefix'], [4.0, 0.0, 0.0])
+
+	@mock.patch.dict('carpy.config', {'APDEX_T': 0.5, 'APDEX_THRESHOLDS': {'Export': (2.0, 10.0)}}, clear=True)
+	def test_apdex_thresholds(self):
+		self.assertEqual(carpy.aggregator.get_apdex_thresholds('Test'), (0.5, 2.0))
+		self.assertEqual(carpy.aggregator.get_apdex_thresholds('Export'), (2.0, 10.0))
+
+	@mock.patch.dict('carpy.config', {}, clear=True)
+	def test_apdex_thresholds_not_configured(self):
+		self.assertIsNone(carpy.aggregator.get_apdex_thresholds('Test'))
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'APDEX_THRESHOLDS': {'Test': 0.5}}, clear=True)
+	@mock.patch('carpy.transaction.get_statsd_client')
+	@mock.patch('carpy.transaction.get_aggregator')
+	def test_transaction_apdex(self, get_aggregator_mock, get_statsd_client_mock):
+		with carpy.transaction.Transaction('Test') as transaction:
+			with carpy.transaction.Transaction('Child', parent=transaction):
+				pass
+
+		with carpy.transaction.Transaction('Other'):
+			pass
+
+		get_aggregator_mock.return_value.apdex.assert_called_once_with(
+			transaction.get_stat_names()[2], transaction.duration, False, (0.5, 2.0), 1.0)
@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+import carpy
+import carpy.capture
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class CaptureTest(TestCase):
+
+	def setUp(self):
+		carpy.capture.transaction_store_singleton = None
+
+	def tearDown(self):
+		carpy.capture.transaction_store_singleton = None
+
+	def run_transaction(self, name, duration, error=False):
+		with mock.patch('carpy.transaction.time.perf_counter_ns', side_effect=[0, 0, 1000, int(duration * 1e9)]):
+			with mock.patch('carpy.transaction.send_tree_stats'):
+				try:
+					with carpy.transaction.Transaction(name) as transaction:
+						with carpy.transaction.Transaction('Child', parent=transaction):
+							if error:
+								raise ValueError()
+				except ValueError:
+					pass
+		return transaction
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'CAPTURE_THRESHOLD': 1.0, 'CAPTURE_THRESHOLDS': {'Fast': 0.1}}, clear=True)
+	def test_capture(self):
+		self.run_transaction('Test', 0.5)
+		self.run_transaction('Test', 2.0)
+		self.run_transaction('Test', 0.01, error=True)
+		self.run_transaction('Fast', 0.2)
+		self.run_transaction('Fast', 0.05)
+
+		store = carpy.capture.get_transaction_store()
+		self.assertEqual([(c.name, c.duration) for c in store.get_slowest()], [('Test', 2.0), ('Fast', 0.2), ('Test', 0.01)])
+		self.assertEqual([c.duration for c in store.get_slowest(1, name='Fast')], [0.2])
+		self.assertEqual([c.duration for c in store.get_errors()], [0.01])
+
+		tree = store.get_slowest(1)[0].get_tree()
+		self.assertEqual(tree['name'], 'Test')
+		self.assertEqual(tree['duration'], 2000.0)
+		self.assertEqual([child['name'] for child in tree['children']], ['Child'])
+
+		error_tree = store.get_errors()[0].get_tree()
+		self.assertTrue(error_tree['error'])
+		self.assertTrue(error_tree['children'][0]['error'])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	def test_disabled(self):
+		transaction = self.run_transaction('Test', 0.01, error=True)
+		self.assertIsNone(transaction.log)
+		self.assertIsNone(carpy.capture.transaction_store_singleton)
+
+	def test_bounded_store(self):
+		store = carpy.capture.TransactionStore(size=3)
+		for duration in (5, 1, 2, 3, 4):
+			store.add(mock.Mock(duration=duration, is_error=False, start_time=0, log=[(0, 0, 'Test', 0, duration, False)]))
+
+		self.assertEqual([c.duration for c in store.get_slowest()], [5, 4, 3])
+
+	def test_slowest_after_burst(self):
+		store = carpy.capture.TransactionStore(size=2)
+		for duration in (5, 4, 0.1, 0.2, 0.3):
+			store.add(mock.Mock(duration=duration, is_error=duration == 0.1, start_time=0, log=[(0, 0, 'Test', 0, duration, False)]))
+
+		self.assertEqual([c.duration for c in store.get_slowest()], [5, 4])
+		self.assertEqual([c.duration for c in store.get_errors()], [0.1])
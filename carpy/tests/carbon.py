@@ -0,0 +1,169 @@
+import pickle
+import socket
+import struct
+import threading
+import time
+from unittest import TestCase
+
+import carpy
+import carpy.carbon
+import carpy.statsd_client
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class CarbonReceiver(object):
+	''' Pickle protocol receiver which keeps the received datapoints. '''
+
+	def __init__(self):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(5)
+		self.port = self.sock.getsockname()[1]
+
+		self.datapoints = []
+		self.connections = 0
+
+		self.thread = threading.Thread(target=self._accept)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _accept(self):
+		while True:
+			try:
+				conn, _ = self.sock.accept()
+			except OSError:
+				return
+			self.connections += 1
+			thread = threading.Thread(target=self._handle, args=(conn,))
+			thread.daemon = True
+			thread.start()
+
+	def _read(self, conn, size):
+		data = b''
+		while len(data) < size:
+			chunk = conn.recv(size - len(data))
+			if not chunk:
+				raise EOFError()
+			data += chunk
+		return data
+
+	def _handle(self, conn):
+		with conn:
+			try:
+				while True:
+					size, = struct.unpack('!L', self._read(conn, 4))
+					self.datapoints.extend(pickle.loads(self._read(conn, size)))
+			except EOFError:
+				pass
+
+	def wait(self, count, timeout=5):
+		''' Waits until count datapoints are received. The client's flush
+		returns once the frames are sent, before they are unpickled here.
+		'''
+		deadline = time.time() + timeout
+		while len(self.datapoints) < count and time.time() < deadline:
+			time.sleep(0.01)
+		return len(self.datapoints) >= count
+
+	def close(self):
+		self.sock.close()
+
+
+class CarbonClientTest(TestCase):
+
+	def setUp(self):
+		self.receiver = CarbonReceiver()
+		self.addCleanup(self.receiver.close)
+
+	def test_pipeline(self):
+		client = carpy.carbon.CarbonClient('127.0.0.1', self.receiver.port, batch_size=2)
+		with client.pipeline() as pipeline:
+			pipeline.timing('a.mean', 1.5)
+			pipeline.incr('a.count', 2, 0.5)
+			pipeline.gauge('b', 3)
+
+		self.assertTrue(client.flush(timeout=5))
+		self.assertTrue(self.receiver.wait(3))
+		self.assertEqual(
+			sorted((path, value) for path, (timestamp, value) in self.receiver.datapoints),
+			[('a.count', 4.0), ('a.mean', 1.5), ('b', 3)])
+		self.assertEqual(client.get_stats()['sent'], 3)
+
+	def test_reconnect(self):
+		port = self.receiver.port
+		self.receiver.close()
+
+		client = carpy.carbon.CarbonClient('127.0.0.1', port, pool_size=1)
+		client.incr('a')
+		for _ in range(100):
+			if client.errors:
+				break
+			time.sleep(0.01)
+		self.assertTrue(client.errors)
+
+		self.receiver = CarbonReceiver()
+		self.addCleanup(self.receiver.close)
+		client.port = self.receiver.port
+		self.assertTrue(client.flush(timeout=5))
+		self.assertTrue(self.receiver.wait(1))
+
+		self.assertEqual([path for path, _ in self.receiver.datapoints], ['a'])
+
+	def test_back_pressure(self):
+		client = carpy.carbon.CarbonClient('127.0.0.1', self.receiver.port, queue_size=1, put_timeout=60)
+		client.start = mock.Mock()
+		client._pid = None
+
+		# Requests never wait for a full queue.
+		start = time.time()
+		client.incr('a')
+		client.incr('b')
+		self.assertLess(time.time() - start, 1)
+
+		self.assertEqual(client.get_stats()['queued'], 1)
+		self.assertEqual(client.get_stats()['dropped'], 1)
+
+		client.put_timeout = 0.01
+		thread = threading.Thread(target=client.incr, args=('c',), name='carpy-aggregator')
+		thread.start()
+		thread.join()
+		self.assertEqual(client.get_stats()['dropped'], 2)
+
+
+class BackendTest(TestCase):
+
+	def setUp(self):
+		carpy.statsd_client.statsd_client_singleton = None
+		self.addCleanup(setattr, carpy.statsd_client, 'statsd_client_singleton', None)
+
+	@mock.patch.dict('carpy.config', {'BACKEND': 'carbon', 'CARBON_HOST': 'localhost', 'SENDER_MODE': 'aggregate'}, clear=True)
+	def test_carbon_backend(self):
+		client = carpy.statsd_client.get_statsd_client()
+		self.assertIsInstance(client, carpy.carbon.CarbonClient)
+		self.assertEqual(client.port, 2004)
+		self.assertTrue(carpy.statsd_client.is_backend_configured())
+
+	@mock.patch.dict('carpy.config', {'BACKEND': 'carbon', 'STATSD_HOST': 'localhost'}, clear=True)
+	def test_carbon_backend_not_configured(self):
+		self.assertFalse(carpy.statsd_client.is_backend_configured())
+		self.assertRaises(carpy.statsd_client.StatsDConfigError, carpy.statsd_client.get_statsd_client)
+
+	@mock.patch.dict('carpy.config', {'BACKEND': 'carbon', 'CARBON_HOST': 'localhost'}, clear=True)
+	def test_carbon_backend_not_aggregated(self):
+		self.assertFalse(carpy.statsd_client.is_backend_configured())
+		self.assertRaises(carpy.statsd_client.StatsDConfigError, carpy.statsd_client.get_statsd_client)
+
+	@mock.patch.dict('carpy.config', {'BACKEND': 'foo'}, clear=True)
+	def test_unknown_backend(self):
+		self.assertRaises(carpy.statsd_client.StatsDConfigError, carpy.statsd_client.get_statsd_client)
+
+	def test_custom_backend(self):
+		client = mock.Mock()
+		with mock.patch.dict('carpy.config', {'BACKEND': lambda: client}, clear=True):
+			self.assertIs(carpy.statsd_client.get_statsd_client(), client)
+			self.assertTrue(carpy.statsd_client.is_backend_configured())
@@ -0,0 +1,86 @@
+from unittest import TestCase
+
+import carpy
+import carpy.cardinality
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class CardinalityLimiterTest(TestCase):
+
+	def test_limit_path(self):
+		limiter = carpy.cardinality.CardinalityLimiter(limit=2)
+
+		self.assertEqual(limiter.limit_path('app', ('a',)), (('a',), None))
+		self.assertEqual(limiter.limit_path('app', ('b', 'x')), (('b', 'x'), None))
+		self.assertEqual(limiter.limit_path('app', ('c', 'x')), (('_other', 'x'), 0))
+		self.assertEqual(limiter.limit_path('app', ('a', 'x')), (('a', 'x'), None))
+		self.assertEqual(limiter.limit_path('app', ('b', 'y')), (('b', 'y'), None))
+		self.assertEqual(limiter.limit_path('app', ('b', 'z')), (('b', '_other'), 1))
+		self.assertEqual(limiter.limit_path('other app', ('c',)), (('c',), None))
+
+		self.assertEqual(limiter.get_stats(), {'subtrees': 5, 'overflows': 2})
+
+	def test_max_subtrees(self):
+		limiter = carpy.cardinality.CardinalityLimiter(limit=1, max_subtrees=2)
+
+		limiter.limit_path('app', ('a', 'x'))
+		limiter.limit_path('app', ('a', 'x', 'y'))
+		self.assertEqual(limiter.get_stats()['subtrees'], 2)
+		self.assertNotIn(('app', ()), limiter.subtrees)
+
+		# The root subtree was forgotten, so a new root name is accepted.
+		self.assertEqual(limiter.limit_path('app', ('b',)), (('b',), None))
+
+
+class CardinalityTransactionTest(TestCase):
+
+	def setUp(self):
+		carpy.transaction.clear_stat_names_cache()
+
+	def tearDown(self):
+		carpy.transaction.clear_stat_names_cache()
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app', 'CARDINALITY_LIMIT': 1}, clear=True)
+	def test_stat_names(self, get_hostname):
+		transaction = carpy.transaction.Transaction('a')
+		self.assertEqual(transaction.get_stat_names(), ('carpy.app.host.a.ok', 'carpy.app.host.a.err', 'carpy.app.host.a', None))
+
+		transaction = carpy.transaction.Transaction('b')
+		child = carpy.transaction.Transaction('c', parent=transaction)
+		self.assertEqual(child.get_stat_names(), (
+			'carpy.app.host._other.children.c.ok',
+			'carpy.app.host._other.children.c.err',
+			'carpy.app.host._other.children.c',
+			'carpy.app.host._overflow',
+		))
+
+		statsd_client = mock.Mock()
+		child.add_stats(statsd_client)
+		statsd_client.incr.assert_called_once_with('carpy.app.host._overflow', 1, 1)
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch('carpy.transaction.STAT_NAMES_CACHE_SIZE', 2)
+	@mock.patch('carpy.transaction.OVERFLOW_STAT_NAMES_CACHE_SIZE', 2)
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app', 'CARDINALITY_LIMIT': 1}, clear=True)
+	def test_overflow_not_cached(self, get_hostname):
+		carpy.transaction.Transaction('a').get_stat_names()
+		for i in range(5):
+			carpy.transaction.Transaction('flood%d' % i).get_stat_names()
+
+		self.assertEqual(list(carpy.transaction.stat_names_cache), [('app', ('a',))])
+		self.assertEqual(len(carpy.transaction.overflow_stat_names_cache), 2)
+		self.assertEqual(carpy.cardinality.get_cardinality_limiter().get_stats()['overflows'], 5)
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app', 'CARDINALITY_LIMIT': None}, clear=True)
+	def test_disabled(self, get_hostname):
+		for i in range(3):
+			transaction = carpy.transaction.Transaction('t%d' % i)
+			self.assertEqual(transaction.get_stat_names()[2:], ('carpy.app.host.t%d' % i, None))
+		self.assertIsNone(carpy.cardinality.get_cardinality_limiter())
@@ -0,0 +1,127 @@
+import concurrent.futures
+import multiprocessing
+import threading
+from unittest import TestCase
+
+import carpy
+import carpy.capture
+import carpy.futures
+import carpy.transaction
+import carpy.wrapper
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+@carpy.wrapper.function_trace
+def inner(value):
+	return value * 2
+
+
+def work(value):
+	return inner(value), carpy.transaction.get_transaction().name
+
+
+def fail():
+	raise ValueError('failed')
+
+
+@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost'}, clear=True)
+@mock.patch('carpy.wrapper.get_sampler')
+@mock.patch('carpy.transaction.send_tree_stats')
+class FuturesTest(TestCase):
+
+	def setUp(self):
+		carpy.transaction.clear_stat_names_cache()
+		carpy.transaction.current_transaction.set(None)
+
+	def get_stat_names(self, root):
+		return sorted(finished.stat_name.split('.', 3)[3] for finished in root.finished)
+
+	def test_thread_pool(self, send_tree_stats_mock, get_sampler_mock):
+		barrier = threading.Barrier(3)
+
+		def fetch(value):
+			# All the tasks run at the same time.
+			barrier.wait(1)
+			return work(value)
+
+		with carpy.transaction.Transaction('Root') as root:
+			with carpy.futures.TracedThreadPoolExecutor(3) as executor:
+				results = list(executor.map(fetch, range(3)))
+
+			self.assertEqual(results, [(0, 'fetch'), (2, 'fetch'), (4, 'fetch')])
+			self.assertEqual(self.get_stat_names(root), sorted(3 * [
+				'Root.children.fetch.children.inner.ok',
+				'Root.children.fetch.ok',
+			]))
+			self.assertEqual(root.children, [])
+
+			timings = dict(root.finished[-1].timings)
+			self.assertIn(root.finished[-1].stat_name[:-3] + '.queued', timings)
+			self.assertIn(root.finished[-1].stat_name[:-3] + '.self', timings)
+
+		# Concurrent children are not subtracted from the exclusive time.
+		self.assertIsNone(root.timings)
+
+	def test_untraced(self, send_tree_stats_mock, get_sampler_mock):
+		self.assertIs(carpy.futures.wrap(work), work)
+		self.assertIs(carpy.futures.wrap_process(work), work)
+
+		with carpy.futures.TracedThreadPoolExecutor(1) as executor:
+			self.assertEqual(executor.submit(inner, 1).result(), 2)
+
+	def test_process_pool(self, send_tree_stats_mock, get_sampler_mock):
+		with carpy.transaction.Transaction('Root') as root:
+			with carpy.futures.TracedProcessPoolExecutor(2) as executor:
+				self.assertEqual(list(executor.map(work, [1, 2])), [(2, 'work'), (4, 'work')])
+
+				future = executor.submit(fail)
+				self.assertRaises(ValueError, future.result)
+
+			self.assertEqual(self.get_stat_names(root), [
+				'Root.children.fail.err',
+				'Root.children.work.children.inner.ok',
+				'Root.children.work.children.inner.ok',
+				'Root.children.work.ok',
+				'Root.children.work.ok',
+			])
+
+	def test_process_pool_spawn(self, send_tree_stats_mock, get_sampler_mock):
+		# Spawned workers do not inherit the config.
+		context = multiprocessing.get_context('spawn')
+		with carpy.transaction.Transaction('Root') as root:
+			with carpy.futures.TracedProcessPoolExecutor(1, mp_context=context) as executor:
+				self.assertEqual(executor.submit(work, 3).result(), (6, 'work'))
+
+			self.assertEqual(self.get_stat_names(root), [
+				'Root.children.work.children.inner.ok',
+				'Root.children.work.ok',
+			])
+
+	def test_process_task_tracing_failure(self, send_tree_stats_mock, get_sampler_mock):
+		with carpy.transaction.Transaction('Root'):
+			task = carpy.futures.wrap_process(work)
+
+		with mock.patch('carpy.futures.RemoteTransaction', side_effect=KeyError('APP_NAME')):
+			with mock.patch('carpy.tests.futures.carpy.transaction.get_transaction') as get_transaction_mock:
+				get_transaction_mock.return_value.name = 'untraced'
+				result = task(3)
+
+		self.assertEqual(result.value, (6, 'untraced'))
+		self.assertEqual(result.finished, [])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'CAPTURE_THRESHOLD': 0.0}, clear=True)
+	def test_process_task_log(self, send_tree_stats_mock, get_sampler_mock):
+		with carpy.transaction.Transaction('Root') as root:
+			task = carpy.futures.wrap_process(work)
+			with concurrent.futures.ProcessPoolExecutor(1) as executor:
+				result = executor.submit(task, 3).result()
+			self.assertEqual(task.merge(result), (6, 'work'))
+
+		tree = carpy.capture.get_transaction_store().get_slowest(1)[0].get_tree()
+		self.assertEqual(tree['children'][0]['name'], 'work')
+		self.assertEqual(tree['children'][0]['children'][0]['name'], 'inner')
+		carpy.capture.transaction_store_singleton = None
@@ -0,0 +1,91 @@
+import os
+import shutil
+import sys
+import tempfile
+from unittest import TestCase
+
+import carpy
+import carpy.instrumentation
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+CLIENT_MODULE = '''
+class Client(object):
+	def get(self, key):
+		return 'value of %s' % key
+
+def connect():
+	return Client()
+'''
+
+
+class InstrumentationTest(TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.path)
+
+		package = os.path.join(self.path, 'carpy_test_clients')
+		os.mkdir(package)
+		with open(os.path.join(package, '__init__.py'), 'w') as f:
+			f.write('')
+		with open(os.path.join(package, 'client.py'), 'w') as f:
+			f.write(CLIENT_MODULE)
+
+		sys.path.insert(0, self.path)
+		self.addCleanup(sys.path.remove, self.path)
+
+		for name in ('carpy_test_clients', 'carpy_test_clients.client'):
+			self.addCleanup(sys.modules.pop, name, None)
+
+		self.addCleanup(carpy.instrumentation.uninstall)
+		self.addCleanup(carpy.instrumentation.recipes.pop, 'carpy_test_clients.client', None)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_instrument_on_import(self, send_tree_stats_mock):
+		recipe = carpy.instrumentation.trace_methods('Client.get', 'connect', 'missing')
+		recipe_mock = mock.Mock(side_effect=recipe)
+		carpy.instrumentation.register('carpy_test_clients.client', recipe_mock)
+		carpy.instrumentation.install()
+
+		self.assertFalse(recipe_mock.called)
+		self.assertFalse('carpy_test_clients.client' in sys.modules)
+
+		from carpy_test_clients import client
+
+		recipe_mock.assert_called_once_with(client)
+		self.assertIsInstance(client.__loader__, type(sys.modules['carpy_test_clients'].__loader__))
+
+		# no transaction, no tracing
+		self.assertEqual(client.connect().get('key'), 'value of key')
+
+		with carpy.transaction.Transaction('Root') as root:
+			self.assertEqual(client.connect().get('key'), 'value of key')
+
+		self.assertEqual(
+			[finished.stat_name.split('.')[-2] for finished in root.finished],
+			['carpy_test_clients_client_connect', 'carpy_test_clients_client_Client_get']
+		)
+
+	def test_instrument_imported_module(self):
+		from carpy_test_clients import client
+
+		recipe_mock = mock.Mock()
+		carpy.instrumentation.register('carpy_test_clients.client', recipe_mock)
+		self.assertFalse(recipe_mock.called)
+
+		carpy.instrumentation.install()
+		carpy.instrumentation.install()
+		recipe_mock.assert_called_once_with(client)
+
+	def test_other_imports(self):
+		carpy.instrumentation.install()
+
+		import carpy_test_clients
+		self.assertFalse(hasattr(carpy_test_clients, '__carpy_instrumented__'))
@@ -0,0 +1,207 @@
+from unittest import TestCase
+
+import threading
+
+import carpy
+import carpy.metrics
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class MetricsTest(TestCase):
+
+	def setUp(self):
+		carpy.transaction.clear_stat_names_cache()
+		carpy.transaction.reset_transaction_counts()
+
+	def tearDown(self):
+		carpy.transaction.clear_stat_names_cache()
+		carpy.transaction.reset_transaction_counts()
+
+	def test_flush(self):
+		metrics = carpy.metrics.Metrics(autostart=False)
+		statsd_client = mock.MagicMock()
+		pipeline = statsd_client.pipeline.return_value.__enter__.return_value
+
+		metrics.incr('counter', 2)
+		metrics.incr('counter', 1, 0.5)
+		metrics.gauge('gauge', 5)
+		metrics.gauge('gauge', -2, delta=True)
+		metrics.flush(statsd_client)
+
+		pipeline.incr.assert_called_once_with('counter', 4)
+		pipeline.gauge.assert_called_once_with('gauge', 3)
+
+		# Gauges are sent until they are removed, counters only once.
+		pipeline.reset_mock()
+		metrics.flush(statsd_client)
+		pipeline.incr.assert_not_called()
+		pipeline.gauge.assert_called_once_with('gauge', 3)
+
+		pipeline.reset_mock()
+		metrics.remove_gauge('gauge')
+		metrics.flush(statsd_client)
+		pipeline.gauge.assert_not_called()
+
+	def test_concurrent_start(self):
+		metrics = carpy.metrics.Metrics(interval=3600)
+		barrier = threading.Barrier(8)
+
+		def run():
+			barrier.wait()
+			metrics.incr('counter')
+
+		with mock.patch('carpy.metrics.threading.Thread', wraps=threading.Thread) as thread_mock:
+			threads = [threading.Thread(target=run) for _ in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		self.assertEqual(len([c for c in thread_mock.call_args_list if c[1].get('name') == 'carpy-metrics']), 1)
+		self.assertEqual(metrics.counters, {'counter': 8.0})
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app'}, clear=True)
+	def test_transaction_counts(self, send_tree_stats_mock, get_hostname):
+		metrics = carpy.metrics.Metrics(autostart=False)
+
+		root = carpy.transaction.Transaction('Root').__enter__()
+		for error in (False, True):
+			try:
+				with carpy.transaction.Transaction('Child', parent=root):
+					with carpy.transaction.Transaction('Child', parent=root):
+						if error:
+							raise ValueError()
+			except ValueError:
+				pass
+
+		carpy.transaction.collect_transaction_counts(metrics)
+		self.assertEqual(metrics.gauges, {
+			'carpy.app.host.Root.inflight': 1,
+			'carpy.app.host.Root.inflight_max': 1,
+			'carpy.app.host.Root.children.Child.inflight': 0,
+			'carpy.app.host.Root.children.Child.inflight_max': 2,
+		})
+		self.assertEqual(metrics.counters, {
+			'carpy.app.host.Root.children.Child.calls': 4,
+			'carpy.app.host.Root.children.Child.errors': 2,
+		})
+
+		with mock.patch('carpy.transaction.get_metrics', return_value=metrics):
+			root.__exit__()
+		metrics.counters.clear()
+
+		carpy.transaction.collect_transaction_counts(metrics)
+		self.assertEqual(metrics.gauges, {
+			'carpy.app.host.Root.inflight': 0,
+			'carpy.app.host.Root.inflight_max': 1,
+		})
+		self.assertEqual(metrics.counters, {'carpy.app.host.Root.calls': 1})
+
+		carpy.transaction.collect_transaction_counts(metrics)
+		self.assertEqual(metrics.gauges, {})
+		self.assertEqual(metrics.counters, {'carpy.app.host.Root.calls': 1})
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app'}, clear=True)
+	def test_threads(self, send_tree_stats_mock, get_hostname):
+		metrics = carpy.metrics.Metrics(autostart=False)
+		transactions = []
+
+		def start():
+			transactions.append(carpy.transaction.Transaction('Root').__enter__())
+
+		for i in range(2):
+			thread = threading.Thread(target=start)
+			thread.start()
+			thread.join()
+
+		# Started in a thread which ended, finished in another one.
+		transactions[0].__exit__()
+
+		carpy.transaction.collect_transaction_counts(metrics)
+		self.assertEqual(metrics.gauges, {
+			'carpy.app.host.Root.inflight': 1,
+			'carpy.app.host.Root.inflight_max': 2,
+		})
+		self.assertEqual(metrics.counters, {'carpy.app.host.Root.calls': 1})
+
+		metrics.counters.clear()
+		carpy.transaction.collect_transaction_counts(metrics)
+		self.assertEqual(metrics.gauges['carpy.app.host.Root.inflight_max'], 1)
+		self.assertEqual(metrics.counters, {})
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app', 'CARDINALITY_LIMIT': 1}, clear=True)
+	def test_cardinality_limit(self, send_tree_stats_mock, get_hostname):
+		metrics = carpy.metrics.Metrics(autostart=False)
+
+		transactions = [carpy.transaction.Transaction(name).__enter__() for name in ('first', 'second', 'third')]
+		carpy.transaction.collect_transaction_counts(metrics)
+		for transaction in reversed(transactions):
+			transaction.__exit__()
+
+		self.assertEqual(metrics.gauges, {
+			'carpy.app.host.first.inflight': 1,
+			'carpy.app.host.first.inflight_max': 1,
+			'carpy.app.host._other.inflight': 2,
+			'carpy.app.host._other.inflight_max': 2,
+		})
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch('carpy.transaction.get_shared_aggregator')
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app', 'SENDER_MODE': 'shared'}, clear=True)
+	def test_shared_mode(self, send_tree_stats_mock, get_shared_aggregator_mock, get_hostname):
+		metrics = carpy.metrics.Metrics(autostart=False)
+		shared = get_shared_aggregator_mock.return_value
+
+		with carpy.transaction.Transaction('Root'):
+			pass
+		carpy.transaction.collect_transaction_counts(metrics)
+
+		self.assertEqual(metrics.gauges, {})
+		self.assertEqual(metrics.counters, {})
+		shared.gauge.assert_any_call('carpy.app.host.Root.inflight', 0)
+		shared.gauge.assert_any_call('carpy.app.host.Root.inflight_max', 1)
+		shared.incr.assert_called_once_with('carpy.app.host.Root.calls', 1)
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app'}, clear=True)
+	def test_rename(self, send_tree_stats_mock, get_hostname):
+		metrics = carpy.metrics.Metrics(autostart=False)
+
+		with carpy.transaction.Transaction('Request') as transaction:
+			transaction.set_name('users')
+			carpy.transaction.collect_transaction_counts(metrics)
+
+		self.assertEqual(metrics.gauges, {
+			'carpy.app.host.users.inflight': 1,
+			'carpy.app.host.users.inflight_max': 1,
+		})
+
+	@mock.patch('carpy.transaction.get_hostname', return_value='host')
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'app'}, clear=True)
+	def test_custom_metrics(self, send_tree_stats_mock, get_hostname):
+		metrics = carpy.metrics.Metrics(autostart=False)
+
+		with mock.patch('carpy.transaction.get_metrics', return_value=metrics):
+			carpy.transaction.incr('outside')
+
+			with carpy.transaction.Transaction('Root', sample_rate=0.5):
+				carpy.transaction.incr('cache_misses')
+				carpy.transaction.incr('cache_misses', 2)
+				carpy.transaction.gauge('queue_size', 7)
+
+		self.assertEqual(metrics.counters, {'carpy.app.host.Root.cache_misses': 6})
+		self.assertEqual(metrics.gauges, {'carpy.app.host.Root.queue_size': 7})
@@ -0,0 +1,100 @@
+import threading
+import time
+from unittest import TestCase
+
+import carpy
+import carpy.profiler
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+def busy_request(started, done):
+	with carpy.transaction.Transaction('Busy'):
+		started.set()
+		done.wait(5)
+
+
+class StackSamplerTest(TestCase):
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_sample(self, send_tree_stats_mock):
+		sampler = carpy.profiler.StackSampler()
+
+		started, done = threading.Event(), threading.Event()
+		thread = threading.Thread(target=busy_request, args=(started, done))
+		thread.start()
+		try:
+			started.wait(5)
+			with carpy.transaction.Transaction('Test'):
+				sampler.sample()
+				sampler.sample()
+		finally:
+			done.set()
+			thread.join()
+
+		sampler.sample()
+
+		self.assertEqual(sampler.get_stats()['samples'], 3)
+		self.assertEqual(sorted(sampler.stacks), ['Busy', 'Test'])
+
+		busy_stack, = sampler.stacks['Busy']
+		self.assertIn('busy_request', busy_stack)
+		self.assertEqual(sampler.stacks['Busy'][busy_stack], 2)
+
+		folded = sampler.get_folded('Test')
+		self.assertTrue(folded.startswith('Test;'))
+		self.assertIn(':test_sample;', folded)
+		self.assertTrue(folded.endswith(':sample 2'))
+
+	def test_greenlet_frame(self):
+		sampler = carpy.profiler.StackSampler()
+
+		def parked():
+			return sys_frame
+
+		sys_frame = mock.Mock(f_code=parked.__code__, f_back=None)
+		transaction = mock.Mock(greenlet=mock.Mock(gr_frame=sys_frame), thread_ident=None)
+		transaction.name = 'Greenlet'
+
+		with mock.patch('carpy.profiler.transaction_module.transactions_cache', {1: transaction}):
+			sampler.sample()
+
+		self.assertEqual(list(sampler.stacks['Greenlet']), ['%s:parked' % __file__])
+
+	def test_max_stacks(self):
+		sampler = carpy.profiler.StackSampler(max_stacks=2)
+		for stack in ('a', 'b', 'c', 'd'):
+			sampler.add_stack('Test', stack)
+
+		self.assertEqual(dict(sampler.stacks['Test']), {'a': 1, 'b': 1, carpy.profiler.TRUNCATED: 2})
+
+	def test_max_depth(self):
+		sampler = carpy.profiler.StackSampler(max_depth=2)
+
+		def inner():
+			return sampler.get_stack(__import__('sys')._getframe())
+
+		self.assertEqual(inner().split(';')[-1], '%s:inner' % __file__)
+		self.assertEqual(len(inner().split(';')), 2)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'PROFILER_INTERVAL': 0.001}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_thread(self, send_tree_stats_mock):
+		carpy.profiler.stack_sampler_singleton = None
+		sampler = carpy.profiler.get_stack_sampler()
+		try:
+			sampler.start()
+			with carpy.transaction.Transaction('Test'):
+				for _ in range(500):
+					if 'Test' in sampler.stacks:
+						break
+					time.sleep(0.01)
+			self.assertIn('Test', sampler.stacks)
+		finally:
+			sampler.stop()
+			carpy.profiler.stack_sampler_singleton = None
@@ -0,0 +1,235 @@
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import carpy
+import carpy.capture
+import carpy.futures
+import carpy.request_log
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class RequestLogTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'requests.log')
+		carpy.request_log.request_log_singleton = None
+
+	def tearDown(self):
+		carpy.request_log.request_log_singleton = None
+		shutil.rmtree(self.directory)
+
+	def read(self, path=None):
+		with open(path or self.path, 'rb') as f:
+			return list(carpy.request_log.read_records(f))
+
+	def test_transaction_tree(self):
+		config = {'APP_NAME': 'Test App', 'REQUEST_LOG_PATH': self.path}
+		with mock.patch.dict('carpy.config', config, clear=True):
+			with mock.patch('carpy.transaction.send_tree_stats'):
+				with carpy.transaction.Transaction('Test') as transaction:
+					with carpy.transaction.Transaction('Child', parent=transaction) as child:
+						with carpy.transaction.Transaction('Grandchild', parent=child):
+							pass
+					try:
+						with carpy.transaction.Transaction('Child2', parent=transaction):
+							raise ValueError()
+					except ValueError:
+						pass
+
+			request_log = carpy.request_log.get_request_log()
+			request_log.flush()
+
+		record, = self.read()
+		self.assertEqual(record['name'], 'Test')
+		self.assertFalse(record['error'])
+		self.assertAlmostEqual(record['duration'], transaction.duration * 1000, places=2)
+		self.assertEqual([child['name'] for child in record['children']], ['Child', 'Child2'])
+		self.assertEqual(record['children'][0]['children'][0]['name'], 'Grandchild')
+		self.assertEqual(record['children'][0]['children'][0]['children'], [])
+		self.assertTrue(record['children'][1]['error'])
+		self.assertTrue(record['start'] <= record['children'][0]['start'] <= record['children'][1]['start'])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'CAPTURE_THRESHOLD': 0.0}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_concurrent_tasks(self, send_tree_stats_mock):
+		async def outer(name, delay_before, delay_after):
+			with carpy.transaction.Transaction(name, parent=carpy.transaction.get_transaction()) as transaction:
+				await asyncio.sleep(delay_before)
+				with carpy.transaction.Transaction('inner', parent=transaction):
+					pass
+				await asyncio.sleep(delay_after)
+
+		async def main():
+			# The first inner task finishes first, but its parent finishes
+			# last.
+			with carpy.transaction.Transaction('Test'):
+				await asyncio.gather(outer('outer_a', 0, 0.02), outer('outer_b', 0.005, 0))
+
+		asyncio.run(main())
+
+		tree = carpy.capture.get_transaction_store().get_slowest(1)[0].get_tree()
+		self.assertEqual([child['name'] for child in tree['children']], ['outer_a', 'outer_b'])
+		for child in tree['children']:
+			self.assertEqual([grandchild['name'] for grandchild in child['children']], ['inner'])
+		carpy.capture.transaction_store_singleton = None
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'CAPTURE_THRESHOLD': 0.0}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_thread_pool(self, send_tree_stats_mock):
+		inner_a_done = threading.Event()
+		outer_b_done = threading.Event()
+
+		def outer_a():
+			with carpy.transaction.Transaction('inner', parent=carpy.transaction.get_transaction()):
+				pass
+			inner_a_done.set()
+			outer_b_done.wait(5)
+
+		def outer_b():
+			inner_a_done.wait(5)
+			with carpy.transaction.Transaction('inner', parent=carpy.transaction.get_transaction()):
+				pass
+
+		with carpy.transaction.Transaction('Test'):
+			with carpy.futures.TracedThreadPoolExecutor(max_workers=2) as executor:
+				future_a = executor.submit(outer_a)
+				executor.submit(outer_b).result()
+				outer_b_done.set()
+				future_a.result()
+
+		tree = carpy.capture.get_transaction_store().get_slowest(1)[0].get_tree()
+		self.assertEqual([child['name'] for child in tree['children']], ['outer_a', 'outer_b'])
+		for child in tree['children']:
+			self.assertEqual([grandchild['name'] for grandchild in child['children']], ['inner'])
+		carpy.capture.transaction_store_singleton = None
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'CAPTURE_THRESHOLD': 0.0, 'MAX_LOGGED_CHILDREN': 2}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_truncated(self, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Batch') as transaction:
+			for i in range(5):
+				with carpy.transaction.Transaction('Step%d' % i, parent=transaction):
+					pass
+
+			remote = carpy.request_log.get_transaction_log()
+			remote.extend([(i, 0, 'Remote', 0, 0.0, False) for i in range(3)])
+			remote.truncated = 4
+			transaction.log.merge(remote, transaction)
+
+		self.assertEqual(len(transaction.log), 3)
+		tree = carpy.capture.get_transaction_store().get_slowest(1)[0].get_tree()
+		self.assertEqual([child['name'] for child in tree['children']], ['Step0', 'Step1'])
+		self.assertEqual(tree['truncated'], 3 + 3 + 4)
+		carpy.capture.transaction_store_singleton = None
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'CAPTURE_THRESHOLD': 0.0, 'MAX_LOGGED_CHILDREN': 2}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_truncated_ancestors(self, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Batch') as transaction:
+			with carpy.transaction.Transaction('A', parent=transaction) as child:
+				for i in range(3):
+					with carpy.transaction.Transaction('a%d' % i, parent=child):
+						pass
+
+		tree = carpy.capture.get_transaction_store().get_slowest(1)[0].get_tree()
+		self.assertEqual([child['name'] for child in tree['children']], ['A'])
+		self.assertEqual([child['name'] for child in tree['children'][0]['children']], ['a0', 'a1'])
+		self.assertEqual(tree['truncated'], 1)
+		carpy.capture.transaction_store_singleton = None
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'CAPTURE_THRESHOLD': 0.0}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_long_root(self, send_tree_stats_mock):
+		hour = 3600 * 10**9
+		# A child starting two hours after its root.
+		with mock.patch('carpy.transaction.time.perf_counter_ns', side_effect=[0, 2 * hour, 2 * hour + 1000, 3 * hour]):
+			with carpy.transaction.Transaction('Batch') as transaction:
+				with carpy.transaction.Transaction('Step', parent=transaction):
+					pass
+
+		tree = carpy.capture.get_transaction_store().get_slowest(1)[0].get_tree()
+		self.assertEqual(tree['children'][0]['name'], 'Step')
+		self.assertAlmostEqual(tree['children'][0]['start'] - tree['start'], 0xffffffff / 1e6, places=3)
+		carpy.capture.transaction_store_singleton = None
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'CAPTURE_THRESHOLD': 0.0}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch('carpy.transaction.get_transaction_store', side_effect=RuntimeError())
+	def test_capture_failure(self, get_transaction_store_mock, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Test'):
+			pass
+		self.assertTrue(get_transaction_store_mock.called)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	def test_disabled(self):
+		self.assertIsNone(carpy.transaction.Transaction('Test').log)
+
+	def get_transaction(self, name):
+		transaction = mock.Mock(start_time=0, duration=0.001)
+		transaction.log = [(0, 0, name, 0, 0.001, False)]
+		return transaction
+
+	def test_ring_buffer(self):
+		request_log = carpy.request_log.RequestLog(self.path, buffer_size=80)
+		request_log.start = mock.Mock()
+
+		for i in range(10):
+			request_log.write(self.get_transaction('t%d' % i))
+			if i % 2:
+				request_log.flush()
+
+		self.assertEqual([record['name'] for record in self.read()], ['t%d' % i for i in range(10)])
+		self.assertEqual(request_log.get_stats()['dropped'], 0)
+
+	def test_full_buffer(self):
+		request_log = carpy.request_log.RequestLog(self.path, buffer_size=64)
+		request_log.start = mock.Mock()
+
+		for i in range(10):
+			request_log.write(self.get_transaction('t%d' % i))
+		request_log.flush()
+
+		stats = request_log.get_stats()
+		self.assertTrue(stats['dropped'])
+		self.assertEqual(len(self.read()), 10 - stats['dropped'])
+
+	def test_rotate(self):
+		request_log = carpy.request_log.RequestLog(self.path, max_bytes=1, backup_count=2)
+		request_log.start = mock.Mock()
+
+		for i in range(3):
+			request_log.write(self.get_transaction('t%d' % i))
+			request_log.flush()
+
+		self.assertFalse(os.path.exists(self.path))
+		self.assertEqual(self.read(self.path + '.1')[0]['name'], 't2')
+		self.assertEqual(self.read(self.path + '.2')[0]['name'], 't1')
+		self.assertFalse(os.path.exists(self.path + '.3'))
+
+	def test_pid_path(self):
+		request_log = carpy.request_log.RequestLog(os.path.join(self.directory, 'requests-{pid}.log'))
+		self.assertEqual(request_log.get_path(), os.path.join(self.directory, 'requests-%d.log' % os.getpid()))
+
+	def test_main(self):
+		request_log = carpy.request_log.RequestLog(self.path)
+		request_log.start = mock.Mock()
+		request_log.write(self.get_transaction('t'))
+		request_log.flush()
+
+		stdout = io.StringIO()
+		with mock.patch('sys.argv', ['request_log', self.path]), mock.patch('sys.stdout', stdout):
+			carpy.request_log.main()
+
+		self.assertIn('"name": "t"', stdout.getvalue())
+		self.assertEqual(stdout.getvalue().count('\n'), 1)
@@ -0,0 +1,80 @@
+from unittest import TestCase
+
+import carpy
+import carpy.sampling
+import carpy.statsd_client
+import carpy.wrapper
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class SamplingTest(TestCase):
+
+	def test_sample_rates(self):
+		sampler = carpy.sampling.Sampler(sample_rates={'rare': 0.0, 'half': 0.5}, default_sample_rate=1.0)
+
+		self.assertEqual(sampler.sample('other'), 1.0)
+		self.assertEqual(sampler.sample('rare'), 0)
+
+		with mock.patch('carpy.sampling.random.random', return_value=0.4):
+			self.assertEqual(sampler.sample('half'), 0.5)
+		with mock.patch('carpy.sampling.random.random', return_value=0.6):
+			self.assertEqual(sampler.sample('half'), 0)
+
+	@mock.patch('carpy.sampling.time')
+	def test_adaptive_sampling(self, time_mock):
+		time_mock.monotonic.return_value = 0.0
+		sampler = carpy.sampling.Sampler(default_sample_rate=1.0, overhead_budget=0.01)
+
+		# 50ms of overhead per second is 5 times over the budget
+		time_mock.monotonic.return_value = 1.0
+		sampler.add_overhead(50 * 10**6)
+		self.assertAlmostEqual(sampler.get_sample_rate('name'), 0.2)
+
+		# no overhead lets the rate grow back
+		time_mock.monotonic.return_value = 2.0
+		sampler.add_overhead(0)
+		self.assertAlmostEqual(sampler.get_sample_rate('name'), 0.4)
+
+		time_mock.monotonic.return_value = 2.5
+		sampler.add_overhead(0)
+		self.assertAlmostEqual(sampler.get_sample_rate('name'), 0.4)
+
+	@mock.patch('carpy.wrapper.Transaction')
+	@mock.patch('carpy.wrapper.get_sampler')
+	def test_unsampled_transaction(self, get_sampler_mock, transaction_mock):
+		get_sampler_mock.return_value = carpy.sampling.Sampler(default_sample_rate=0.0)
+
+		@carpy.wrapper.transaction_trace
+		def handler():
+			return 'result'
+
+		self.assertEqual(handler(), 'result')
+		self.assertFalse(transaction_mock.called)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8000}, clear=True)
+	@mock.patch('carpy.statsd_client.is_client_initialized', new_callable=mock.PropertyMock, return_value=False)
+	@mock.patch('carpy.statsd_client.StatsClient._send')
+	@mock.patch('carpy.wrapper.get_sampler')
+	def test_sampled_transaction(self, get_sampler_mock, statsd_send_mock, _):
+		get_sampler_mock.return_value = carpy.sampling.Sampler(default_sample_rate=0.5)
+
+		@carpy.wrapper.function_trace
+		def function():
+			pass
+
+		@carpy.wrapper.transaction_trace
+		def handler():
+			function()
+
+		with mock.patch('carpy.sampling.random.random', return_value=0.1):
+			handler()
+
+		stats = statsd_send_mock.call_args[0][0].split('\n')
+		# Timings of both transactions and the exclusive time of the root.
+		self.assertEqual(len(stats), 3)
+		for stat in stats:
+			self.assertTrue(stat.endswith('|ms|@0.5'))
@@ -0,0 +1,103 @@
+import threading
+import time
+from unittest import TestCase
+
+import carpy
+import carpy.sender
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class FakeTransaction(object):
+
+	def __init__(self, name):
+		self.name = name
+
+	def add_tree_stats(self, pipeline):
+		pipeline.timing(self.name, 1)
+
+
+class SenderTest(TestCase):
+
+	def test_drop_oldest(self):
+		sender = carpy.sender.BackgroundSender(queue_size=2, drop_policy='oldest')
+		sender.start = mock.Mock()
+
+		self.assertTrue(sender.put(FakeTransaction('t1')))
+		self.assertTrue(sender.put(FakeTransaction('t2')))
+		self.assertTrue(sender.put(FakeTransaction('t3')))
+
+		self.assertEqual([t.name for t in sender.queue], ['t2', 't3'])
+		self.assertEqual(sender.get_stats()['dropped'], 1)
+
+	def test_drop_newest(self):
+		sender = carpy.sender.BackgroundSender(queue_size=2, drop_policy='newest')
+		sender.start = mock.Mock()
+
+		self.assertTrue(sender.put(FakeTransaction('t1')))
+		self.assertTrue(sender.put(FakeTransaction('t2')))
+		self.assertFalse(sender.put(FakeTransaction('t3')))
+
+		self.assertEqual([t.name for t in sender.queue], ['t1', 't2'])
+		self.assertEqual(sender.get_stats()['dropped'], 1)
+
+	def test_unknown_drop_policy(self):
+		self.assertRaises(carpy.sender.SenderConfigError, carpy.sender.BackgroundSender, drop_policy='foo')
+
+	@mock.patch('carpy.sender.get_statsd_client')
+	def test_background_thread(self, get_statsd_client_mock):
+		pipeline = get_statsd_client_mock.return_value.pipeline.return_value.__enter__.return_value
+
+		sender = carpy.sender.BackgroundSender(queue_size=10)
+		sender.put(FakeTransaction('t1'))
+		sender.put(FakeTransaction('t2'))
+
+		for _ in range(100):
+			if sender.get_stats()['sent'] == 2:
+				break
+			time.sleep(0.01)
+
+		self.assertEqual(sender.get_stats(), {'queued': 0, 'sent': 2, 'dropped': 0, 'errors': 0})
+		pipeline.timing.assert_any_call('t1', 1)
+		pipeline.timing.assert_any_call('t2', 1)
+
+	@mock.patch('carpy.sender.get_statsd_client')
+	def test_concurrent_start(self, get_statsd_client_mock):
+		sender = carpy.sender.BackgroundSender(queue_size=100)
+		barrier = threading.Barrier(8)
+
+		def run():
+			barrier.wait()
+			sender.put(FakeTransaction('t'))
+
+		with mock.patch('carpy.sender.threading.Thread', wraps=threading.Thread) as thread_mock:
+			threads = [threading.Thread(target=run) for _ in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		self.assertEqual(len([c for c in thread_mock.call_args_list if c[1].get('name') == 'carpy-sender']), 1)
+
+	@mock.patch('carpy.sender.get_statsd_client', side_effect=Exception)
+	def test_send_error(self, get_statsd_client_mock):
+		sender = carpy.sender.BackgroundSender(queue_size=10)
+		sender.queue.append(FakeTransaction('t1'))
+		sender.flush()
+
+		self.assertEqual(sender.get_stats(), {'queued': 0, 'sent': 0, 'dropped': 1, 'errors': 1})
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'SENDER_MODE': 'background'}, clear=True)
+	@mock.patch('carpy.transaction.get_statsd_client')
+	@mock.patch('carpy.transaction.get_sender')
+	def test_transaction_background_mode(self, get_sender_mock, get_statsd_client_mock):
+		with carpy.transaction.Transaction('Test') as transaction:
+			pass
+
+		get_sender_mock.return_value.put.assert_called_once_with(transaction)
+		self.assertFalse(get_statsd_client_mock.called)
+		self.assertIs(carpy.transaction.get_transaction(), None)
@@ -0,0 +1,188 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import carpy
+import carpy.aggregator
+import carpy.shared
+import carpy.statsd_client
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class SharedAggregatorTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'test.shm')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def get_shared_aggregator(self, **kwargs):
+		shared = carpy.shared.SharedAggregator(self.path, interval=3600, **kwargs)
+		self.addCleanup(shared.close)
+		return shared
+
+	def read(self, shared):
+		aggregator = carpy.aggregator.Aggregator(autostart=False)
+		shared.read(aggregator)
+		return aggregator
+
+	def test_write_read(self):
+		shared = self.get_shared_aggregator(num_slots=4, slot_size=4096)
+		shared.timing('stat', 10)
+		shared.timing('stat', 20, 0.5)
+		shared.incr('counter', 2)
+		shared.apdex('prefix', 0.1, False, (0.5, 2.0))
+		shared.apdex('prefix', 1.0, False, (0.5, 2.0))
+
+		aggregator = self.read(shared)
+		self.assertEqual(aggregator.histograms['stat'].get_summary()['count'], 3)
+		self.assertEqual(aggregator.histograms['stat'].get_summary()['upper'], 20)
+		self.assertEqual(aggregator.counters, {'counter': 2.0})
+		self.assertEqual(aggregator.apdex_counts, {'prefix': [1.0, 1.0, 0.0]})
+
+		self.assertEqual(self.read(shared).histograms, {})
+
+	def test_wrap_around(self):
+		shared = self.get_shared_aggregator(num_slots=1, slot_size=128)
+		for i in range(20):
+			shared.timing('stat%d' % i, i)
+			aggregator = self.read(shared)
+			self.assertEqual(list(aggregator.histograms), ['stat%d' % i])
+			self.assertEqual(aggregator.histograms['stat%d' % i].upper, i)
+
+		self.assertEqual(shared.dropped, 0)
+
+	def test_full_slot(self):
+		shared = self.get_shared_aggregator(num_slots=1, slot_size=128)
+		for i in range(10):
+			shared.timing('stat', i)
+
+		self.assertTrue(shared.dropped)
+		aggregator = self.read(shared)
+		self.assertEqual(aggregator.histograms['stat'].count, 10 - shared.dropped)
+
+	def test_layout_mismatch(self):
+		self.get_shared_aggregator(num_slots=4, slot_size=4096).open()
+		shared = carpy.shared.SharedAggregator(self.path, num_slots=8, slot_size=4096)
+		self.assertRaises(carpy.shared.SharedMemoryConfigError, shared.open)
+
+	def test_gauge(self):
+		shared = self.get_shared_aggregator(num_slots=4, slot_size=4096)
+		shared.gauge('gauge', 3)
+		self.assertEqual(self.read(shared).gauges, {'gauge': 3})
+
+		# The last value is sent until it is zero.
+		self.assertEqual(self.read(shared).gauges, {'gauge': 3})
+		shared.gauge('gauge', 0)
+		self.assertEqual(self.read(shared).gauges, {'gauge': 0})
+		self.assertEqual(self.read(shared).gauges, {})
+
+	def test_symlink(self):
+		target = os.path.join(self.directory, 'target')
+		os.symlink(target, self.path)
+		shared = carpy.shared.SharedAggregator(self.path, num_slots=4, slot_size=4096)
+		self.assertRaises(OSError, shared.open)
+		self.assertFalse(os.path.exists(target))
+
+	def test_public_file(self):
+		with open(self.path, 'wb'):
+			pass
+		os.chmod(self.path, 0o666)
+		shared = carpy.shared.SharedAggregator(self.path, num_slots=4, slot_size=4096)
+		self.assertRaises(carpy.shared.SharedMemoryConfigError, shared.open)
+		self.assertEqual(os.path.getsize(self.path), 0)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	def test_default_path(self):
+		with mock.patch('tempfile.gettempdir', return_value=self.directory):
+			path = carpy.shared.get_shared_memory_path()
+
+			self.assertEqual(os.path.basename(path), 'Test_App.shm')
+			self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777, 0o700)
+
+			os.chmod(os.path.dirname(path), 0o777)
+			self.assertRaises(carpy.shared.SharedMemoryConfigError, carpy.shared.get_shared_memory_path)
+
+	def test_flush(self):
+		shared = self.get_shared_aggregator(num_slots=4, slot_size=4096)
+		statsd_client = mock.MagicMock()
+		pipeline = statsd_client.pipeline.return_value.__enter__.return_value
+
+		shared.timing('stat', 10)
+		shared.incr('counter')
+		self.assertTrue(shared.elect())
+		shared.flush(statsd_client)
+
+		pipeline.incr.assert_any_call('stat.count', 1)
+		pipeline.incr.assert_any_call('counter', 1)
+		pipeline.gauge.assert_any_call('stat.mean', 10.0)
+
+	def test_concurrent_start(self):
+		shared = self.get_shared_aggregator(num_slots=4, slot_size=4096)
+		barrier = threading.Barrier(8)
+
+		def run():
+			barrier.wait()
+			shared.timing('stat', 1)
+
+		with mock.patch('carpy.shared.threading.Thread', wraps=threading.Thread) as thread_mock:
+			threads = [threading.Thread(target=run) for _ in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		self.assertEqual(len([c for c in thread_mock.call_args_list if c[1].get('name') == 'carpy-shared-aggregator']), 1)
+		self.assertEqual(shared._slot, 0)
+		self.assertEqual(self.read(shared).histograms['stat'].get_summary()['count'], 8)
+
+	def test_fork(self):
+		shared = self.get_shared_aggregator(num_slots=4, slot_size=4096)
+		shared.timing('parent', 1)
+
+		pid = os.fork()
+		if not pid:
+			status = 1
+			try:
+				shared.timing('child', 2)
+				if shared._pid == os.getpid() and shared._slot == 1:
+					status = 0
+			finally:
+				os._exit(status)
+
+		self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+		aggregator = self.read(shared)
+		self.assertEqual(sorted(aggregator.histograms), ['child', 'parent'])
+		self.assertEqual(shared._slot, 0)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'SENDER_MODE': 'shared'}, clear=True)
+	@mock.patch('carpy.transaction.get_statsd_client')
+	@mock.patch('carpy.transaction.get_shared_aggregator')
+	def test_transaction_shared_mode(self, get_shared_aggregator_mock, get_statsd_client_mock):
+		with carpy.transaction.Transaction('Test') as transaction:
+			pass
+
+		get_shared_aggregator_mock.return_value.timing.assert_called_once_with(transaction.get_stat_name(), mock.ANY, 1.0)
+		self.assertFalse(get_statsd_client_mock.called)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8125}, clear=True)
+	def test_statsd_client_after_fork(self):
+		carpy.statsd_client.get_statsd_client()
+		self.addCleanup(setattr, carpy.statsd_client, 'statsd_client_singleton', None)
+
+		pid = os.fork()
+		if not pid:
+			os._exit(0 if carpy.statsd_client.statsd_client_singleton is None else 1)
+
+		self.assertEqual(os.waitpid(pid, 0)[1], 0)
+		self.assertIsNotNone(carpy.statsd_client.statsd_client_singleton)
@@ -0,0 +1,99 @@
+from unittest import TestCase
+
+import carpy
+import carpy.aggregator
+import carpy.statsd_client
+import carpy.statsd_server
+import carpy.transaction
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class StatsdServerTest(TestCase):
+
+	def test_parse_packet(self):
+		stats, errors = carpy.statsd_server.parse_packet(
+			b'a.ok:1.500|ms\nb:2|c|@0.5\nc:-3|g\nd:x|s\ne:1|c:2|c\nbroken\nf:x|ms')
+
+		self.assertEqual(stats, [
+			('a.ok', 1.5, 'ms', 1.0),
+			('b', 2.0, 'c', 0.5),
+			('c', '-3', 'g', 1.0),
+			('d', 'x', 's', 1.0),
+			('e', 1.0, 'c', 1.0),
+			('e', 2.0, 'c', 1.0),
+		])
+		self.assertEqual(errors, 2)
+
+	def test_summarize(self):
+		histogram = carpy.aggregator.Histogram(100)
+		for value in range(1, 21):
+			histogram.add(value)
+
+		self.assertEqual(carpy.statsd_server.summarize(list(range(1, 21))), histogram.get_summary())
+		self.assertEqual(carpy.statsd_server.summarize([]), {'count': 0})
+
+	def test_summarize_without_numpy(self):
+		with mock.patch('carpy.statsd_server.numpy', None):
+			self.assertEqual(carpy.statsd_server.summarize([3, 1, 2], 6), {
+				'mean': 2.0,
+				'median': 2,
+				'upper': 3,
+				'upper_95': 3,
+				'lower': 1,
+				'count': 6,
+			})
+
+	def test_handle_packet(self):
+		server = carpy.statsd_server.StatsdServer()
+		self.addCleanup(server.close)
+
+		server.handle_packet(b't:10|ms|@0.5\nt:20|ms|@0.5\nc:1|c\ng:5|g\ng:+2|g\ns:a|s\ns:a|s\nx:1|y')
+
+		self.assertEqual(server.get_timer('t')['count'], 4)
+		self.assertEqual(server.get_timer('t')['mean'], 15.0)
+
+		summary = server.get_summary()
+		self.assertEqual(summary['counters'], {'c': 1.0})
+		self.assertEqual(summary['gauges'], {'g': 7.0})
+		self.assertEqual(summary['sets'], {'s': 1})
+		self.assertEqual(summary['packets'], 1)
+		self.assertEqual(summary['lines'], 8)
+		self.assertEqual(summary['bad_lines'], 1)
+
+		server.reset()
+		self.assertEqual(server.get_summary()['timers'], {})
+
+	def test_drop_rate(self):
+		server = carpy.statsd_server.StatsdServer(drop_rate=0.5, seed=1)
+		self.addCleanup(server.close)
+
+		for _ in range(1000):
+			server.handle_packet(b'c:1|c')
+
+		self.assertEqual(server.packets + server.dropped_packets, 1000)
+		self.assertEqual(server.counters['c'], server.packets)
+		self.assertTrue(400 < server.dropped_packets < 600)
+
+	def test_transaction_tree(self):
+		with carpy.statsd_server.StatsdServer() as server:
+			config = {'APP_NAME': 'Test App', 'STATSD_HOST': server.host, 'STATSD_PORT': server.port}
+			with mock.patch.dict('carpy.config', config, clear=True):
+				carpy.statsd_client.statsd_client_singleton = None
+				carpy.transaction.clear_stat_names_cache()
+				try:
+					for _ in range(10):
+						with carpy.transaction.Transaction('Test') as transaction:
+							with carpy.transaction.Transaction('Child', parent=transaction) as child:
+								pass
+				finally:
+					carpy.statsd_client.statsd_client_singleton = None
+
+			self.assertTrue(server.wait(lines=20))
+
+			self.assertEqual(server.get_timer(transaction.get_stat_name())['count'], 10)
+			self.assertEqual(server.get_timer(child.get_stat_name())['count'], 10)
+			self.assertEqual(server.bad_lines, 0)
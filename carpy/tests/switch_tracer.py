@@ -0,0 +1,74 @@
+import time
+from unittest import TestCase, skipIf
+
+import carpy
+import carpy.transaction
+
+try:
+	import greenlet
+	import carpy.switch_tracer
+except ImportError:
+	greenlet = None
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+@skipIf(greenlet is None, 'greenlet is not installed')
+class SwitchTracerTest(TestCase):
+
+	def setUp(self):
+		carpy.switch_tracer.install()
+		self.addCleanup(carpy.switch_tracer.uninstall)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_on_cpu_and_parked(self, send_tree_stats_mock):
+		main = greenlet.getcurrent()
+		transactions = []
+
+		def request():
+			with carpy.transaction.Transaction('Test') as transaction:
+				transactions.append(transaction)
+				self.assertIs(carpy.transaction.get_current_greenlet(), request_greenlet)
+				main.switch()
+				time.sleep(0.01)
+
+		request_greenlet = greenlet.greenlet(request)
+		request_greenlet.switch()
+		self.assertIsNone(carpy.transaction.get_current_greenlet())
+
+		# Other greenlets run while the request is parked.
+		time.sleep(0.05)
+		request_greenlet.switch()
+
+		transaction, = transactions
+		timings = dict(transaction.timings)
+		self.assertGreaterEqual(timings['parked'], 50)
+		self.assertGreaterEqual(timings['oncpu'], 10)
+		self.assertLess(timings['oncpu'], 50)
+		self.assertAlmostEqual(timings['oncpu'] + timings['parked'], transaction.duration * 1000, places=3)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_thread_transaction(self, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Test') as transaction:
+			pass
+
+		self.assertIsNone(transaction.on_cpu_time)
+		self.assertIsNone(transaction.timings)
+
+	def test_previous_trace_function(self):
+		carpy.switch_tracer.uninstall()
+		events = []
+		greenlet.settrace(lambda event, args: events.append(event))
+		try:
+			carpy.switch_tracer.install()
+			greenlet.greenlet(lambda: None).switch()
+			carpy.switch_tracer.uninstall()
+		finally:
+			greenlet.settrace(None)
+
+		self.assertIn('switch', events)
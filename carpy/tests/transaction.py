@@ -2,10 +2,12 @@ import gc
 import sys
 import threading
 import time
+import tracemalloc
 from unittest import TestCase
 
 import carpy
 import carpy.transaction
+import carpy.wrapper
 import carpy.statsd_client
 
 try:
@@ -16,13 +18,17 @@ except ImportError:
 
 class TranscationTest(TestCase):
 
+	def setUp(self):
+		carpy.transaction.clear_stat_names_cache()
+		carpy.transaction.current_transaction.set(None)
+
 	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8000}, clear=True)
 	@mock.patch('carpy.statsd_client.is_client_initialized', new_callable=mock.PropertyMock, return_value=False)
-	@mock.patch('carpy.statsd_client.statsd.StatsClient.timing')
+	@mock.patch('carpy.statsd_client.StatsClient.timing')
 	@mock.patch('carpy.transaction.time')
 	def test_transcation(self, time_mock, statsd_timing_mock, _):
-		time_start = time.time()
-		time_mock.time.return_value = time_start
+		time_start = time.perf_counter_ns()
+		time_mock.perf_counter_ns.return_value = time_start
 
 		transaction = carpy.transaction.Transaction(name='Test')
 		self.assertEqual(transaction.app_name, carpy.config['APP_NAME'])
@@ -34,11 +40,11 @@ class TranscationTest(TestCase):
 		self.assertEqual(transaction.start_time, time_start)
 		self.assertIs(carpy.transaction.transactions_cache[carpy.transaction.get_thread_id()], transaction)
 
-		time_end = time_start + 5
-		time_mock.time.return_value = time_end
+		time_end = time_start + 5 * 10**9
+		time_mock.perf_counter_ns.return_value = time_end
 
 		transaction.__exit__()
-		self.assertEqual(transaction.duration, time_end - time_start)
+		self.assertEqual(transaction.duration, 5.0)
 		self.assertEqual(statsd_timing_mock.call_count, 1)
 
 		del transaction
@@ -93,6 +99,30 @@ class TranscationTest(TestCase):
 		self.assertEqual(t1.get_stat_name(), 'carpy.Test App.test_host_name.test_name.err')
 		self.assertEqual(t2.get_stat_name(), 'carpy.Test App.test_host_name.test_name.children.test_name2.err')
 
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.transaction.socket')
+	def test_stat_names_cache(self, socket_mock):
+		socket_mock.gethostname.return_value = 'test.host.name'
+
+		for _ in range(3):
+			t1 = carpy.transaction.Transaction(name='test.name').__enter__()
+			t2 = carpy.transaction.Transaction(name='test.name2', parent=t1).__enter__()
+			self.assertEqual(t2.get_stat_name(), 'carpy.Test App.test_host_name.test_name.children.test_name2.ok')
+			t2.error()
+			self.assertEqual(t2.get_stat_name(), 'carpy.Test App.test_host_name.test_name.children.test_name2.err')
+
+		self.assertEqual(socket_mock.gethostname.call_count, 1)
+		self.assertEqual(list(carpy.transaction.stat_names_cache.keys()), [('Test App', ('test.name', 'test.name2'))])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.transaction.STAT_NAMES_CACHE_SIZE', 2)
+	def test_stat_names_cache_size(self):
+		for i in range(5):
+			carpy.transaction.Transaction(name='name%d' % i).get_stat_name()
+
+		self.assertEqual(len(carpy.transaction.stat_names_cache), 2)
+		self.assertTrue(('Test App', ('name4',)) in carpy.transaction.stat_names_cache)
+
 	def test_get_thread_id(self):
 		expected_thread_id = threading.current_thread().ident
 		self.assertEqual(carpy.transaction.get_thread_id(), expected_thread_id)
@@ -127,21 +157,221 @@ class TranscationTest(TestCase):
 
 	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8000}, clear=True)
 	@mock.patch('carpy.statsd_client.is_client_initialized', new_callable=mock.PropertyMock, return_value=False)
-	@mock.patch('carpy.statsd_client.statsd.StatsClient.timing')
+	@mock.patch('carpy.statsd_client.StatsClient.timing')
 	@mock.patch('carpy.transaction.time')
 	@mock.patch('carpy.transaction.socket')
 	def test_send_stats(self, socket_mock, time_mock, statsd_timing_mock, _):
-		time_start = time.time()
-		time_mock.time.return_value = time_start
+		time_start = time.perf_counter_ns()
+		time_mock.perf_counter_ns.return_value = time_start
 		socket_mock.gethostname.return_value = 'test.host.name'
 
 		duration = 5.0
 		duration_ms = 5000
 
 		with carpy.transaction.Transaction(name='Test'):
-			time_end = time_start + duration
-			time_mock.time.return_value = time_end
+			time_end = time_start + int(duration * 10**9)
+			time_mock.perf_counter_ns.return_value = time_end
 
 		self.assertEqual(statsd_timing_mock.call_count, 1)
-		statsd_timing_mock.assert_called_with('carpy.Test App.test_host_name.Test.ok', duration_ms)
+		statsd_timing_mock.assert_called_with('carpy.Test App.test_host_name.Test.ok', duration_ms, 1.0)
+
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8000, 'STATSD_MAX_UDP_SIZE': 512}, clear=True)
+	@mock.patch('carpy.statsd_client.is_client_initialized', new_callable=mock.PropertyMock, return_value=False)
+	@mock.patch('carpy.statsd_client.statsd.StatsClient._send')
+	def test_send_stats_batched(self, statsd_send_mock, _):
+		with carpy.transaction.Transaction(name='Test') as root:
+			for i in range(30):
+				with carpy.transaction.Transaction(name='Child%d' % i, parent=root):
+					pass
+
+			self.assertFalse(statsd_send_mock.called)
+
+		stats = []
+		for call in statsd_send_mock.call_args_list:
+			packet = call[0][0]
+			self.assertTrue(len(packet) < 512)
+			stats.extend(packet.split('\n'))
+
+		self.assertEqual(len(stats), 32)
+		self.assertTrue(statsd_send_mock.call_count < 32)
+		self.assertTrue(stats[-2].startswith(root.get_stat_name() + ':'))
+		self.assertTrue(stats[-1].startswith(root.get_stat_names()[2] + '.self:'))
 
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8000}, clear=True)
+	@mock.patch('carpy.statsd_client.is_client_initialized', new_callable=mock.PropertyMock, return_value=False)
+	@mock.patch('carpy.statsd_client.StatsClient._send')
+	@mock.patch('carpy.transaction.time')
+	@mock.patch('carpy.transaction.socket')
+	def test_nested_functions(self, socket_mock, time_mock, statsd_send_mock, _):
+		socket_mock.gethostname.return_value = 'host'
+		# Root, outer and inner start, inner, outer and root exit.
+		time_mock.perf_counter_ns.side_effect = [0, 1000000, 2000000, 5000000, 6000000, 10000000]
+
+		@carpy.wrapper.function_trace
+		def inner():
+			return carpy.transaction.get_transaction().name
+
+		@carpy.wrapper.function_trace
+		def outer():
+			return inner(), carpy.transaction.get_transaction().name
+
+		with mock.patch('carpy.wrapper.get_sampler'):
+			with carpy.transaction.Transaction(name='Test') as root:
+				self.assertEqual(outer(), ('inner', 'outer'))
+				self.assertIs(carpy.transaction.get_transaction(), root)
+
+		self.assertIsNone(carpy.transaction.get_transaction())
+
+		packet = statsd_send_mock.call_args[0][0]
+		self.assertEqual(sorted(packet.split('\n')), [
+			'carpy.Test App.host.Test.children.outer.children.inner.ok:3.000|ms',
+			'carpy.Test App.host.Test.children.outer.ok:5.000|ms',
+			'carpy.Test App.host.Test.children.outer.self:2.000|ms',
+			'carpy.Test App.host.Test.ok:10.000|ms',
+			'carpy.Test App.host.Test.self:5.000|ms',
+		])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8000, 'TRACE_CPU_TIME': True}, clear=True)
+	@mock.patch('carpy.statsd_client.is_client_initialized', new_callable=mock.PropertyMock, return_value=False)
+	@mock.patch('carpy.statsd_client.StatsClient._send')
+	@mock.patch('carpy.transaction.time')
+	@mock.patch('carpy.transaction.socket')
+	def test_send_precise_and_cpu_stats(self, socket_mock, time_mock, statsd_send_mock, _):
+		socket_mock.gethostname.return_value = 'host'
+		time_mock.perf_counter_ns.side_effect = [1000000, 1250000, 2000000, 3500000]
+		time_mock.thread_time_ns.side_effect = [0, 0, 200000, 1000000]
+
+		with carpy.transaction.Transaction(name='Test') as root:
+			with carpy.transaction.Transaction(name='Child', parent=root):
+				pass
+
+		packet = statsd_send_mock.call_args[0][0]
+		self.assertEqual(sorted(packet.split('\n')), [
+			'carpy.Test App.host.Test.children.Child.cpu:0.200|ms',
+			'carpy.Test App.host.Test.children.Child.ok:0.750|ms',
+			'carpy.Test App.host.Test.cpu:1.000|ms',
+			'carpy.Test App.host.Test.ok:2.500|ms',
+			'carpy.Test App.host.Test.self:1.750|ms',
+		])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_release_finished_children(self, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Root') as root:
+			with carpy.transaction.Transaction('Child', parent=root) as child:
+				with carpy.transaction.Transaction('Grandchild', parent=child):
+					pass
+				self.assertEqual(child.children, [])
+
+			self.assertEqual(root.children, [])
+			self.assertEqual(
+				[finished.stat_name for finished in root.finished],
+				[
+					'carpy.Test App.%s.Root.children.Child.children.Grandchild.ok' % carpy.transaction.get_hostname(),
+					'carpy.Test App.%s.Root.children.Child.ok' % carpy.transaction.get_hostname(),
+				]
+			)
+
+		send_tree_stats_mock.assert_called_once_with(root)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'RETAIN_TRANSACTION_TREE': True}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_retain_transaction_tree(self, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Root') as root:
+			with carpy.transaction.Transaction('Child', parent=root) as child:
+				pass
+
+		self.assertIs(root.finished, None)
+		self.assertEqual(root.children, [child])
+		self.assertEqual(list(root.get_all_transactions()), [child, root])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'MAX_FINISHED_CHILDREN': 10}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_send_finished_children_early(self, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Root') as root:
+			# Distinct names, repeated ones may be folded.
+			for i in range(25):
+				with carpy.transaction.Transaction('Child%d' % i, parent=root):
+					pass
+
+			self.assertEqual(send_tree_stats_mock.call_count, 2)
+			self.assertEqual(len(send_tree_stats_mock.call_args_list[0][0][0]), 10)
+			self.assertEqual(len(root.finished), 5)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	def test_fold_children_disabled(self, send_tree_stats_mock):
+		with carpy.transaction.Transaction('Root') as root:
+			for i in range(3):
+				with carpy.transaction.Transaction('Loop', parent=root):
+					pass
+
+			self.assertEqual([finished.count for finished in root.finished], [1, 1, 1])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'STATSD_PORT': 8000, 'FOLD_CHILDREN': True}, clear=True)
+	@mock.patch('carpy.statsd_client.is_client_initialized', new_callable=mock.PropertyMock, return_value=False)
+	@mock.patch('carpy.statsd_client.StatsClient._send')
+	@mock.patch('carpy.transaction.time')
+	@mock.patch('carpy.transaction.socket')
+	def test_fold_children(self, socket_mock, time_mock, statsd_send_mock, _):
+		socket_mock.gethostname.return_value = 'host'
+		# Root start, three loop children of 1, 3 and 2 ms, a failed one of
+		# 4 ms and the root exit.
+		time_mock.perf_counter_ns.side_effect = [
+			0,
+			0, 1000000,
+			1000000, 4000000,
+			4000000, 6000000,
+			6000000, 10000000,
+			20000000,
+		]
+
+		with carpy.transaction.Transaction(name='Test') as root:
+			for error in (False, False, False, True):
+				try:
+					with carpy.transaction.Transaction(name='Loop', parent=root):
+						if error:
+							raise ValueError()
+				except ValueError:
+					pass
+
+			self.assertEqual(len(root.finished), 2)
+			self.assertEqual(root.finished[0].count, 3)
+
+		lines = [line for call in statsd_send_mock.call_args_list for line in call[0][0].split('\n')]
+		self.assertEqual(sorted(lines), [
+			'carpy.Test App.host.Test.children.Loop.err.folded.count:1|c',
+			'carpy.Test App.host.Test.children.Loop.err.folded.max:4.000|ms',
+			'carpy.Test App.host.Test.children.Loop.err.folded.min:4.000|ms',
+			'carpy.Test App.host.Test.children.Loop.err.folded.total:4.000|ms',
+			'carpy.Test App.host.Test.children.Loop.ok.folded.count:3|c',
+			'carpy.Test App.host.Test.children.Loop.ok.folded.max:3.000|ms',
+			'carpy.Test App.host.Test.children.Loop.ok.folded.min:1.000|ms',
+			'carpy.Test App.host.Test.children.Loop.ok.folded.total:6.000|ms',
+			'carpy.Test App.host.Test.ok:20.000|ms',
+			'carpy.Test App.host.Test.self:10.000|ms',
+		])
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	def test_transaction_memory(self):
+		count = 1000
+
+		root = carpy.transaction.Transaction('Root').__enter__()
+		self.assertFalse(hasattr(root, '__dict__'))
+
+		tracemalloc.start()
+		try:
+			before = tracemalloc.get_traced_memory()[0]
+			children = [carpy.transaction.Transaction('Child', parent=root).__enter__() for _ in range(count)]
+			per_transaction = (tracemalloc.get_traced_memory()[0] - before) / float(count)
+		finally:
+			tracemalloc.stop()
+
+		# Reported with -s, e.g. python -m pytest -s carpy/tests/transaction.py
+		sys.stdout.write('\nmemory per open transaction: %d bytes\n' % per_transaction)
+		self.assertLess(per_transaction, 300)
+
+		for child in reversed(children):
+			child.__exit__()
+		self.assertEqual(root.children, [])
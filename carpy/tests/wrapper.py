@@ -1,7 +1,11 @@
+import asyncio
+import inspect
 import sys
+import types
 from unittest import TestCase
 
 import carpy
+import carpy.transaction
 
 try:
 	import mock
@@ -107,3 +111,170 @@ class WrapperTest(TestCase):
 
 		self.assertRaises(SpecificException, handler)
 		mock_is_error.assert_called_with(True)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch('carpy.wrapper.get_sampler')
+	def test_async_decorators(self, get_sampler_mock, send_tree_stats_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+
+		@carpy.wrapper.function_trace
+		async def fetch(delay):
+			await asyncio.sleep(delay)
+			return carpy.transaction.get_transaction().name
+
+		@carpy.wrapper.function_trace
+		async def stream():
+			for i in range(3):
+				await asyncio.sleep(0)
+				yield i
+
+		async def handler(delay):
+			result = await fetch(delay)
+			items = [item async for item in stream()]
+			return carpy.transaction.get_transaction().name, result, items
+
+		first_handler = carpy.wrapper.transaction_trace(handler, 'first')
+		second_handler = carpy.wrapper.transaction_trace(handler, 'second')
+
+		# the decorated functions are still coroutine functions
+		self.assertTrue(inspect.iscoroutinefunction(first_handler))
+		self.assertTrue(inspect.isasyncgenfunction(stream))
+
+		async def main():
+			return await asyncio.gather(first_handler(0.02), second_handler(0.01))
+
+		results = asyncio.run(main())
+
+		# get_transaction returns the innermost transaction, which is the root
+		# again after the children finished.
+		self.assertEqual(results, [('first', 'fetch', [0, 1, 2]), ('second', 'fetch', [0, 1, 2])])
+
+		roots = [call[0][0] for call in send_tree_stats_mock.call_args_list]
+		self.assertEqual(sorted(root.name for root in roots), ['first', 'second'])
+		for root in roots:
+			self.assertEqual(
+				sorted(finished.stat_name.split('.')[-2] for finished in root.finished),
+				['fetch', 'stream']
+			)
+			self.assertTrue(root.duration >= 0.01)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch('carpy.wrapper.get_sampler')
+	def test_async_generator_break(self, get_sampler_mock, send_tree_stats_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+
+		@carpy.wrapper.function_trace
+		async def gen():
+			for i in range(3):
+				yield i
+
+		@carpy.wrapper.function_trace
+		async def leaf():
+			return carpy.transaction.get_transaction().get_path()
+
+		@carpy.wrapper.transaction_trace
+		async def handler():
+			async for item in gen():
+				self.assertEqual(carpy.transaction.get_transaction().get_path(), ('handler',))
+				break
+			return carpy.transaction.get_transaction().get_path(), await leaf()
+
+		self.assertEqual(asyncio.run(handler()), (('handler',), ('handler', 'leaf')))
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost'}, clear=True)
+	@mock.patch('carpy.transaction.send_tree_stats')
+	@mock.patch('carpy.wrapper.get_sampler')
+	def test_async_error(self, get_sampler_mock, send_tree_stats_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+
+		@carpy.wrapper.transaction_trace
+		async def handler():
+			await asyncio.sleep(0)
+			raise SpecificException()
+
+		self.assertRaises(SpecificException, asyncio.run, handler())
+		self.assertTrue(send_tree_stats_mock.call_args[0][0].is_error)
+
+	def _create_module(self):
+		module = types.ModuleType('carpy_test_traced_module')
+		sys.modules[module.__name__] = module
+		self.addCleanup(sys.modules.pop, module.__name__)
+
+		exec(compile(
+			'def handler():\n'
+			'	return "result"\n'
+			'\n'
+			'class Handler(object):\n'
+			'	def get(self):\n'
+			'		return "result"\n',
+			module.__name__, 'exec'
+		), module.__dict__)
+
+		return module
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'ENABLED': False}, clear=True)
+	@mock.patch('carpy.wrapper.get_sampler')
+	@mock.patch('carpy.wrapper.Transaction')
+	def test_disabled_decorator(self, transaction_mock, get_sampler_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+		callbacks = []
+
+		# References taken while tracing is disabled, e.g. by other
+		# decorators, are traced once it is enabled.
+		def register(func):
+			callbacks.append(func)
+			return func
+
+		@register
+		@carpy.wrapper.transaction_trace
+		def handler():
+			return 'result'
+
+		self.assertEqual(callbacks[0](), 'result')
+		self.assertFalse(transaction_mock.called)
+
+		carpy.wrapper.enable()
+		self.assertEqual(callbacks[0](), 'result')
+		self.assertTrue(transaction_mock.called)
+
+		transaction_mock.reset_mock()
+		carpy.wrapper.disable('handler')
+		self.assertEqual(callbacks[0](), 'result')
+		self.assertFalse(transaction_mock.called)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost', 'ENABLED': False}, clear=True)
+	def test_disabled_wrapper(self):
+		module = self._create_module()
+		handler = module.handler
+
+		carpy.wrapper.function_trace_wrap(module, 'handler')
+		self.assertIs(module.handler, handler)
+
+		carpy.wrapper.enable()
+		self.assertIs(module.handler.__wrapped__, handler)
+
+		carpy.wrapper.disable('handler')
+		self.assertIs(module.handler, handler)
+
+		carpy.wrapper.enable('handler')
+		self.assertIs(module.handler.__wrapped__, handler)
+
+	@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App'}, clear=True)
+	@mock.patch('carpy.wrapper.get_transaction')
+	@mock.patch('carpy.wrapper.Transaction')
+	def test_missing_config(self, transaction_mock, get_transaction_mock):
+		@carpy.wrapper.function_trace
+		def function():
+			return 'result'
+
+		self.assertEqual(function(), 'result')
+		self.assertFalse(get_transaction_mock.called)
+
+		carpy.config['STATSD_HOST'] = 'localhost'
+		carpy.wrapper.refresh()
+
+		self.assertEqual(function(), 'result')
+		self.assertTrue(get_transaction_mock.called)
+		self.assertTrue(transaction_mock.called)
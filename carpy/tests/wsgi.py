@@ -0,0 +1,131 @@
+from unittest import TestCase
+
+import carpy
+import carpy.transaction
+import carpy.wsgi
+
+try:
+	import mock
+except ImportError:
+	import unittest.mock as mock
+
+
+class SpecificException(Exception):
+	pass
+
+
+def start_response(status, headers, exc_info=None):
+	pass
+
+
+class RouteNamerTest(TestCase):
+
+	def test_template_name(self):
+		self.assertEqual(carpy.wsgi.template_name('/'), 'index')
+		self.assertEqual(carpy.wsgi.template_name('/users/<int:id>/posts'), 'users_id_posts')
+
+	def test_match(self):
+		namer = carpy.wsgi.RouteNamer([
+			'/',
+			'/users/<id>',
+			'/users/new',
+			'/users/<id>/posts/<int:post_id>',
+			'/users/new/preview',
+		])
+		namer.add('/about', 'about_page')
+
+		self.assertEqual(namer.match('/'), 'index')
+		self.assertEqual(namer.match('/users/5'), 'users_id')
+		self.assertEqual(namer.match('/users/new'), 'users_new')
+		self.assertEqual(namer.match('/users/new/posts/3'), 'users_id_posts_post_id')
+		self.assertEqual(namer.match('/users/new/preview'), 'users_new_preview')
+		self.assertEqual(namer.match('/about/'), 'about_page')
+		self.assertIs(namer.match('/users/5/comments'), None)
+
+
+@mock.patch.dict('carpy.config', {'APP_NAME': 'Test App', 'STATSD_HOST': 'localhost'}, clear=True)
+@mock.patch('carpy.wsgi.get_sampler')
+@mock.patch('carpy.transaction.send_tree_stats')
+class MiddlewareTest(TestCase):
+
+	def call(self, middleware, path='/'):
+		response = middleware({'PATH_INFO': path}, start_response)
+		try:
+			return list(response)
+		finally:
+			if hasattr(response, 'close'):
+				response.close()
+
+	def test_streamed_response(self, send_tree_stats_mock, get_sampler_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+
+		def app(environ, start_response):
+			start_response('200 OK', [])
+			self.assertIs(carpy.transaction.get_transaction(), environ['carpy.transaction'])
+			yield b''
+			yield b'first'
+			self.assertFalse(send_tree_stats_mock.called)
+			yield b'second'
+
+		middleware = carpy.wsgi.CarpyMiddleware(app, routes=['/users/<id>'])
+		self.assertEqual(self.call(middleware, '/users/1'), [b'', b'first', b'second'])
+
+		transaction = send_tree_stats_mock.call_args[0][0]
+		self.assertEqual(transaction.name, 'users_id')
+		self.assertFalse(transaction.is_error)
+		self.assertTrue(0 < transaction.timings['ttfb'] <= transaction.duration * 1000)
+		self.assertIs(carpy.transaction.get_transaction(), None)
+
+	def test_default_name(self, send_tree_stats_mock, get_sampler_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+
+		def app(environ, start_response):
+			start_response('200 OK', [])
+			carpy.wsgi.set_transaction_name('renamed')
+			return [b'body']
+
+		self.call(carpy.wsgi.CarpyMiddleware(app, routes=['/users/<id>']), '/other')
+
+		transaction = send_tree_stats_mock.call_args[0][0]
+		self.assertEqual(transaction.name, 'renamed')
+		self.assertEqual(transaction.get_path(), ('renamed',))
+
+	def test_server_error(self, send_tree_stats_mock, get_sampler_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+
+		def app(environ, start_response):
+			start_response('500 Internal Server Error', [])
+			return [b'error']
+
+		self.call(carpy.wsgi.CarpyMiddleware(app))
+		self.assertTrue(send_tree_stats_mock.call_args[0][0].is_error)
+
+	def test_exception(self, send_tree_stats_mock, get_sampler_mock):
+		get_sampler_mock.return_value.sample.return_value = 1.0
+
+		def app(environ, start_response):
+			raise SpecificException()
+
+		def streaming_app(environ, start_response):
+			start_response('200 OK', [])
+			yield b'first'
+			raise SpecificException()
+
+		middleware = carpy.wsgi.CarpyMiddleware(app)
+		self.assertRaises(SpecificException, middleware, {}, start_response)
+		self.assertTrue(send_tree_stats_mock.call_args[0][0].is_error)
+
+		send_tree_stats_mock.reset_mock()
+		middleware = carpy.wsgi.CarpyMiddleware(streaming_app)
+		self.assertRaises(SpecificException, self.call, middleware)
+		self.assertTrue(send_tree_stats_mock.call_args[0][0].is_error)
+
+	def test_unsampled(self, send_tree_stats_mock, get_sampler_mock):
+		get_sampler_mock.return_value.sample.return_value = 0
+
+		def app(environ, start_response):
+			start_response('200 OK', [])
+			return [b'body']
+
+		self.assertEqual(self.call(carpy.wsgi.CarpyMiddleware(app)), [b'body'])
+		self.assertFalse(send_tree_stats_mock.called)
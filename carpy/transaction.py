@@ -1,5 +1,7 @@
-__all__ = ['Transaction', 'get_transaction']
+__all__ = ['Transaction', 'FinishedTransaction', 'get_transaction', 'incr', 'gauge']
 
+import contextvars
+import os
 import socket
 import sys
 import threading
@@ -8,10 +10,90 @@ import weakref
 
 import carpy
 
+from .aggregator import get_aggregator, get_apdex_thresholds
+from .cardinality import clear_cardinality_limiter, get_cardinality_limiter
+from .capture import get_transaction_store, is_capture_enabled, is_captured
+from .metrics import add_collector, get_metrics
+from .request_log import get_request_log, get_transaction_log
+from .sampling import get_sampler
+from .sender import get_sender
+from .shared import get_shared_aggregator
 from .statsd_client import get_statsd_client
 
 transactions_cache = weakref.WeakValueDictionary()
 
+# Innermost open transaction of the thread, greenlet or asyncio task. Unlike
+# transactions_cache, which holds root transactions, it follows the execution
+# across awaits.
+current_transaction = contextvars.ContextVar('carpy_transaction', default=None)
+
+
+class SwitchState(threading.local):
+	''' Current greenlet of the thread, maintained by carpy.switch_tracer on
+	every greenlet switch while it is installed in the thread.
+	'''
+	installed = False
+	greenlet = None
+	previous = None
+
+
+switch_state = SwitchState()
+
+# Maximum number of (ok, err) stat name pairs kept in stat_names_cache.
+STAT_NAMES_CACHE_SIZE = 10000
+
+# Maximum number of stat names of paths over the cardinality limit kept in
+# overflow_stat_names_cache. They are kept apart, so that a flood of new
+# names can not evict the names of the known paths.
+OVERFLOW_STAT_NAMES_CACHE_SIZE = 1000
+
+stat_names_cache = {}
+overflow_stat_names_cache = {}
+hostname = None
+
+# Indexes of the counts of transactions by name: open transactions, their
+# maximum since the generation, all the finished and failed transactions and
+# the generation in which the maximum was last reset.
+INFLIGHT = 0
+INFLIGHT_MAX = 1
+CALLS = 2
+ERRORS = 3
+GENERATION = 4
+
+
+class ThreadCounts(threading.local):
+	''' Counts of the transactions of the thread by the stat names cache key,
+	scaled by their sample rate. Only the thread writes them, so no lock is
+	taken per transaction, and collect_transaction_counts merges the counts
+	of all the threads.
+	'''
+	counts = None
+	owner = None
+
+
+class ThreadCountsOwner(object):
+	''' Object owned by a thread, which is released when the thread ends. '''
+
+	__slots__ = ('__weakref__',)
+
+
+thread_counts = ThreadCounts()
+
+# Counts of all the threads with a weak reference to their owner.
+all_thread_counts = []
+all_thread_counts_lock = threading.Lock()
+
+# Incremented on every collect, so that threads reset their maximum.
+counts_generation = 0
+
+# Open, finished and failed transactions of the threads which ended, the
+# finished and failed transactions which were already sent and the stat
+# prefixes whose gauges are sent. Used only by collect_transaction_counts.
+retired_counts = {}
+sent_counts = {}
+gauge_prefixes = set()
+collect_lock = threading.Lock()
+
 
 class Transaction(object):
 	''' Transaction collects stats during its execution. This stats are sent to
@@ -22,44 +104,188 @@ class Transaction(object):
 	__exit__ methods.
 	'''
 
-	app_name = None
-	start_time = None
-	duration = None
-	name = None
-	parent = None
-	is_error = None
-	children = None
+	__slots__ = (
+		'app_name',
+		'start_time',
+		'duration',
+		'name',
+		'parent',
+		'root',
+		'path',
+		'is_error',
+		'sample_rate',
+		'cpu_start_time',
+		'on_cpu_time',
+		'resume_time',
+		'timings',
+		'children',
+		'finished',
+		'context_token',
+		'log',
+		'thread_ident',
+		'greenlet',
+		'__weakref__',
+	)
 
-	def __init__(self, name, parent=None):
-		self.app_name = carpy.config['APP_NAME']
+	# Whether the transaction runs concurrently with its parent, e.g. in a
+	# thread pool. Its duration is then not subtracted from the exclusive
+	# time of the parent.
+	concurrent = False
 
-		self.start_time = 0.0
+	def __init__(self, name, parent=None, sample_rate=1.0, app_name=None):
+		self.app_name = app_name if app_name is not None else carpy.config['APP_NAME']
+
+		# Start time is in nanoseconds of a monotonic clock, duration is in
+		# seconds.
+		self.start_time = 0
 		self.duration = 0.0
+		self.cpu_start_time = None
+
+		# Nanoseconds the greenlet of the root transaction ran and when it
+		# was last switched to, if greenlet switches are traced.
+		self.on_cpu_time = None
+		self.resume_time = None
+
+		# Additional timings reported as sibling series of the ok/err stat.
+		self.timings = None
 
 		self.name = name
 		self.parent = parent
+		self.root = None
+
+		# Names of all the ancestors and the transaction itself, used as a key
+		# of the stat names cache. Children get it when they are attached.
+		self.path = (name,) if parent is None else None
 
 		self.is_error = False
 
-		self.children = []
+		# Rate at which the root transaction was sampled, children inherit it.
+		self.sample_rate = sample_rate
+
+		# Open children, or all the children if the whole tree is retained.
+		self.children = None
+
+		# Summaries of the finished children whose stats were not sent yet.
+		# Kept only on the root transaction and only if the whole tree is not
+		# retained.
+		if parent is None and not carpy.config.get('RETAIN_TRANSACTION_TREE'):
+			self.finished = FinishedTransactions(sample_rate)
+		else:
+			self.finished = None
+
+		self.context_token = None
+
+		# Thread and greenlet the root transaction runs in, so that the stack
+		# sampler can find its stack.
+		self.thread_ident = None
+		self.greenlet = None
+
+		# Finished transactions of the tree, kept on the root transaction if
+		# the request log or capturing of slow trees is enabled.
+		if parent is None and (carpy.config.get('REQUEST_LOG_PATH') or is_capture_enabled()):
+			self.log = get_transaction_log()
+		else:
+			self.log = None
 
 	def __enter__(self):
-		self.start_time = time.time()
+		if carpy.config.get('TRACE_CPU_TIME'):
+			self.cpu_start_time = time.thread_time_ns()
+
+		self.start_time = time.perf_counter_ns()
 
 		if self.parent is not None:
 			self.parent.add_child(self)
+			# Children restore their parent on exit instead of keeping a
+			# context token, which would cost memory per open transaction.
+			current_transaction.set(self)
+			if self.root.log is not None:
+				self.root.log.start(self)
 		else:
-			transactions_cache[get_thread_id()] = self
+			self.context_token = current_transaction.set(self)
+			self.thread_ident = threading.get_ident()
+			self.greenlet = get_current_greenlet()
+			if self.greenlet is not None:
+				transactions_cache[id(self.greenlet)] = self
+				if switch_state.installed:
+					self.on_cpu_time = 0
+			else:
+				transactions_cache[self.thread_ident] = self
+
+		add_inflight((self.app_name, self.get_path()), 1.0 / self.sample_rate)
 
 		return self
 
 	def __exit__(self, exc_type=None, exc_value=None, tb=None):
-		self.duration = time.time() - self.start_time
+		exit_time = time.perf_counter_ns()
+		self.duration = (exit_time - self.start_time) / 1e9
 
-		if exc_type: # if exception happens, exc_type is set to exception type
+		if self.cpu_start_time is not None:
+			cpu_duration = time.thread_time_ns() - self.cpu_start_time
+			self.add_timing('cpu', cpu_duration / 1e6)
+
+		if self.on_cpu_time is not None:
+			resume_time = self.resume_time if self.resume_time is not None else self.start_time
+			on_cpu_time = self.on_cpu_time + exit_time - resume_time
+			self.add_timing('oncpu', on_cpu_time / 1e6)
+			self.add_timing('parked', (exit_time - self.start_time - on_cpu_time) / 1e6)
+
+		# if exception happens, exc_type is set to exception type. Closing a
+		# generator is not an error.
+		is_error = self.is_error
+		if exc_type and exc_type is not GeneratorExit:
 			self.error()
+			is_error = True
 
-		self.send_stats()
+		if self.path is not None:
+			remove_inflight((self.app_name, self.path), 1.0 / self.sample_rate, is_error)
+
+		timings = self.timings
+		if timings is not None and 'self' in timings:
+			timings['self'] = max(timings['self'] + self.duration * 1000, 0.0)
+
+		# Children are sent together with the root transaction so that the
+		# whole tree fits in as few packets as possible.
+		if self.parent is not None:
+			root = self.root
+			if root is not None:
+				parent = self.parent
+				if not self.concurrent:
+					parent.add_child_time(self.duration)
+				if current_transaction.get() is self:
+					current_transaction.set(parent)
+
+				if root.log is not None:
+					root.log.add(self)
+				self.release()
+		else:
+			# Queued transactions stay alive, so they have to be removed from
+			# the cache explicitly.
+			thread_id = get_thread_id()
+			if transactions_cache.get(thread_id) is self:
+				transactions_cache.pop(thread_id, None)
+
+			self.reset_context()
+
+			self.send_stats()
+
+		sampler = get_sampler()
+		if sampler.overhead_budget is not None:
+			sampler.add_overhead(time.perf_counter_ns() - exit_time)
+
+	def reset_context(self):
+		''' Restores the current transaction of the context to the one that
+		was current before the transaction was entered.
+		'''
+		if self.context_token is None:
+			return
+
+		try:
+			current_transaction.reset(self.context_token)
+		except ValueError:
+			# Exited in a different context than it was entered in.
+			if current_transaction.get() is self:
+				current_transaction.set(None)
+		self.context_token = None
 
 	def add_child(self, transaction):
 		''' Adds a child transaction to the transaction.
@@ -70,8 +296,122 @@ class Transaction(object):
 		'''
 		if not transaction.parent:
 			transaction.parent = self
+		transaction.root = self.root or self
+		transaction.sample_rate = self.sample_rate
+		transaction.path = self.get_path() + (transaction.name,)
+
+		if self.children is None:
+			self.children = []
 		self.children.append(transaction)
 
+	def set_name(self, name):
+		''' Renames the transaction. Children which were already started keep
+		the stat names of the old name.
+
+		:param name:
+			New name of the transaction.
+		'''
+		old_path = self.path
+		self.name = name
+		if self.parent is None:
+			self.path = (name,)
+		elif self.path is not None:
+			self.path = self.path[:-1] + (name,)
+
+		# An open transaction is counted as in-flight under its new name.
+		if old_path is not None and self.start_time and not self.duration:
+			weight = 1.0 / self.sample_rate
+			remove_inflight((self.app_name, old_path), weight, False, calls=0)
+			add_inflight((self.app_name, self.path), weight)
+
+	def add_timing(self, name, delta):
+		''' Adds a timing which is reported as a sibling series of the
+		transaction's ok and err stats, e.g. `carpy.app.host.name.cpu`.
+
+		:param name:
+			Name of the series.
+		:param delta:
+			Timing in milliseconds.
+		'''
+		if self.timings is None:
+			self.timings = {}
+		self.timings[name] = delta
+
+	def incr(self, name, count=1):
+		''' Increments a custom counter of the transaction, e.g.
+		`carpy.app.host.name.cache_misses`. Counters are summed in-process
+		and sent every METRICS_INTERVAL seconds.
+
+		:param name:
+			Name of the counter.
+		:param count:
+			Value the counter is incremented by.
+		'''
+		get_metrics().incr('%s.%s' % (self.get_stat_names()[2], name), count, self.sample_rate)
+
+	def gauge(self, name, value):
+		''' Sets a custom gauge of the transaction. Its last value is sent
+		every METRICS_INTERVAL seconds.
+
+		:param name:
+			Name of the gauge.
+		:param value:
+			Value of the gauge.
+		'''
+		get_metrics().gauge('%s.%s' % (self.get_stat_names()[2], name), value)
+
+	def add_child_time(self, duration):
+		''' Subtracts the duration of a finished child from the exclusive
+		time of the transaction, which is reported as the `self` timing of
+		transactions with children.
+
+		:param duration:
+			Duration of the child in seconds.
+		'''
+		if self.timings is None:
+			self.timings = {}
+		self.timings['self'] = self.timings.get('self', 0.0) - duration * 1000
+
+	def get_timings(self):
+		''' Returns the additional timings with their stat names.
+
+		:returns:
+			List of (stat name, timing in milliseconds) tuples.
+		'''
+		if not self.timings:
+			return []
+
+		stat_prefix = self.get_stat_names()[2]
+		return [('%s.%s' % (stat_prefix, name), delta) for name, delta in self.timings.items()]
+
+	def release(self):
+		''' Replaces the finished child transaction in its parent with a
+		compact summary kept on the root transaction, unless the whole tree
+		is retained. If too many summaries pile up on the root, their stats
+		are sent before the root finishes.
+		'''
+		root = self.root
+		finished = root.finished
+		if finished is None:
+			return
+
+		# Unlike checking the last child and popping it, remove is atomic, so
+		# it is safe with children finishing in other threads.
+		children = self.parent.children
+		if children:
+			try:
+				children.remove(self)
+			except ValueError:
+				pass
+
+		# Summaries are folded only in the thread of the root, so that
+		# children finishing in pool threads do not need a lock.
+		finished.add(self, threading.get_ident() == root.thread_ident)
+
+		if len(finished) >= carpy.config.get('MAX_FINISHED_CHILDREN', 1000):
+			root.finished = FinishedTransactions(root.sample_rate)
+			send_tree_stats(finished)
+
 	def get_all_transactions(self):
 		''' Generator that yields the tree of all the parent and children
 		transactions in no particular order.
@@ -79,7 +419,7 @@ class Transaction(object):
 		:returns:
 			Yields the transaction.
 		'''
-		for child in self.children:
+		for child in self.children or ():
 			for trans in child.get_all_transactions():
 				yield trans
 
@@ -98,7 +438,7 @@ class Transaction(object):
 		:param name:
 			Part of the stat's name.
 		'''
-		return name.replace('.', '_') if name else ''
+		return sanitize_name(name)
 
 	def get_stat_name(self):
 		''' Returns the name of the stat which can be used when sending
@@ -107,52 +447,641 @@ class Transaction(object):
 		:returns:
 			Name of the stat.
 		'''
+		stat_names = self.get_stat_names()
+
+		return stat_names[1] if self.is_error else stat_names[0]
 
-		# These are parts of the stat name in reverse order so that we can
-		# append them instead of insert them. Premature optimization?
-		parts = []
+	def get_stat_names(self):
+		''' Returns the cached names of the transaction's stats.
 
-		transaction = self
-		while transaction:
-			parts.append(self.sanitize_name(transaction.name))
-			transaction = transaction.parent
-			if transaction:
-				parts.append('children')
+		:returns:
+			Tuple with the ok and err name of the stat, the common prefix of
+			all the stats of the transaction and the name of the overflow
+			counter or None.
+		'''
+		return get_stat_names(self.app_name, self.path or self.get_path())
 
-		parts.extend([
-			self.sanitize_name(socket.gethostname()),
-			self.sanitize_name(self.app_name),
-			'carpy',
-		])
+	def get_path(self):
+		''' Returns the names of all the ancestors and the transaction itself.
 
-		parts.reverse()
-		parts.append('err' if self.is_error else 'ok')
+		:returns:
+			Tuple of names, starting with the root transaction.
+		'''
+		if self.path is None:
+			parent_path = self.parent.get_path() if self.parent is not None else ()
+			return parent_path + (self.name,)
+
+		return self.path
+
+	def build_stat_names(self):
+		''' Builds the names of the transaction's stats and stores them to the
+		stat names cache.
+
+		:returns:
+			Tuple in the format of get_stat_names.
+		'''
+		return build_stat_names(self.app_name, self.get_path())
 
-		return '.'.join(parts)
+	def add_stats(self, statsd_client):
+		''' Adds stats of this transaction (without its children) to the
+		statsd client or pipeline.
+
+		:param statsd_client:
+			Statsd client or pipeline the stats are sent with.
+		'''
+		sample_rate = self.sample_rate
+		stat_names = self.get_stat_names()
+		statsd_client.timing(stat_names[1] if self.is_error else stat_names[0], self.duration * 1000, sample_rate)
+
+		if self.timings:
+			for stat_name, delta in self.get_timings():
+				statsd_client.timing(stat_name, delta, sample_rate)
+
+		if stat_names[3] is not None:
+			statsd_client.incr(stat_names[3], 1, sample_rate)
+
+	def add_tree_stats(self, statsd_client):
+		''' Adds stats of the complete transaction tree to the statsd client
+		or pipeline.
+
+		:param statsd_client:
+			Statsd client or pipeline the stats are sent with.
+		'''
+		if self.finished:
+			self.finished.add_tree_stats(statsd_client)
+
+		for transaction in self.get_all_transactions():
+			transaction.add_stats(statsd_client)
 
 	def send_stats(self):
-		''' Sends stats of the complete transaction to statsd'''
-		statsd_client = get_statsd_client()
+		''' Sends stats of the complete transaction tree to statsd, counts the
+		transaction for its Apdex score if thresholds are configured, writes
+		the tree to the request log if it is enabled and captures it if it
+		was slow or failed.
+		'''
+		send_tree_stats(self)
+
+		get_metrics().ensure_started()
+
+		if self.log is not None:
+			self.log.finish(self)
+			# A broken record must not fail the traced request.
+			try:
+				if carpy.config.get('REQUEST_LOG_PATH'):
+					get_request_log().write(self)
+				if is_capture_enabled() and is_captured(self):
+					get_transaction_store().add(self)
+			except Exception:
+				pass
+
+		apdex_thresholds = get_apdex_thresholds(self.name)
+		if apdex_thresholds is not None:
+			if carpy.config.get('SENDER_MODE') == 'shared':
+				aggregator = get_shared_aggregator()
+			else:
+				aggregator = get_aggregator()
+			aggregator.apdex(self.get_stat_names()[2], self.duration, self.is_error, apdex_thresholds, self.sample_rate)
+
+
+class FinishedTransaction(object):
+	''' Compact summary of a finished child transaction. It is kept on the root
+	transaction instead of the child until the stats are sent.
+
+	Repeated calls with the same stat name, e.g. in a loop, are folded into
+	one summary of their count, total, minimum and maximum duration.
+	'''
+
+	__slots__ = ('stat_name', 'count', 'duration', 'lower', 'upper', 'timings', 'overflow_stat')
+
+	def __init__(self, transaction):
+		stat_names = transaction.get_stat_names()
+		self.stat_name = stat_names[1] if transaction.is_error else stat_names[0]
+		self.count = 1
+
+		# Total duration of the folded transactions.
+		self.duration = self.lower = self.upper = transaction.duration
+
+		self.timings = transaction.get_timings() if transaction.timings else None
+		self.overflow_stat = stat_names[3]
+
+	def fold(self, transaction):
+		''' Adds another finished transaction with the same stat name to the
+		summary.
+		'''
+		duration = transaction.duration
+		self.count += 1
+		self.duration += duration
+		if duration < self.lower:
+			self.lower = duration
+		elif duration > self.upper:
+			self.upper = duration
+
+		if transaction.timings:
+			timings = dict(self.timings or ())
+			for stat_name, delta in transaction.get_timings():
+				timings[stat_name] = timings.get(stat_name, 0.0) + delta
+			self.timings = list(timings.items())
+
+	def add_stats(self, statsd_client, sample_rate=1.0, folded=False):
+		''' Adds stats of the finished transaction to the statsd client or
+		pipeline.
+
+		:param statsd_client:
+			Statsd client or pipeline the stats are sent with.
+		:param sample_rate:
+			Rate at which the root transaction was sampled.
+		:param folded:
+			Whether folding is enabled. Then the stats are sent as the folded
+			series even if only one transaction was summarized.
+		'''
+		count = self.count
+		if not folded:
+			statsd_client.timing(self.stat_name, self.duration * 1000, sample_rate)
+
+			if self.timings:
+				for stat_name, delta in self.timings:
+					statsd_client.timing(stat_name, delta, sample_rate)
+		else:
+			# Folded transactions are sent as their own series, so that they
+			# are not mixed with timers of single calls.
+			stat_prefix = self.stat_name + '.folded'
+			statsd_client.incr(stat_prefix + '.count', count, sample_rate)
+			statsd_client.timing(stat_prefix + '.total', self.duration * 1000, sample_rate)
+			statsd_client.timing(stat_prefix + '.min', self.lower * 1000, sample_rate)
+			statsd_client.timing(stat_prefix + '.max', self.upper * 1000, sample_rate)
+
+			if self.timings:
+				for stat_name, delta in self.timings:
+					statsd_client.timing(stat_name + '.folded.total', delta, sample_rate)
 
-		duration_ms = int(self.duration * 1000)
-		statsd_client.timing(self.get_stat_name(), duration_ms)
+		if self.overflow_stat is not None:
+			statsd_client.incr(self.overflow_stat, count, sample_rate)
+
+
+class FinishedTransactions(list):
+	''' List of finished transaction summaries which can be sent like a
+	transaction tree.
+	'''
+
+	__slots__ = ('sample_rate', 'folded')
+
+	def __init__(self, sample_rate=1.0):
+		super(FinishedTransactions, self).__init__()
+		self.sample_rate = sample_rate
+
+		# Summaries by stat name, None unless folding is enabled with
+		# FOLD_CHILDREN.
+		self.folded = {} if carpy.config.get('FOLD_CHILDREN') else None
+
+	def add(self, transaction, fold=True):
+		''' Adds the summary of the finished transaction, or folds it into
+		the summary of the transactions with the same stat name.
+
+		:param transaction:
+			Finished child transaction.
+		:param fold:
+			Whether the transaction may be folded.
+		'''
+		folded = self.folded
+		if folded is None or not fold:
+			self.append(FinishedTransaction(transaction))
+			return
+
+		stat_names = transaction.get_stat_names()
+		stat_name = stat_names[1] if transaction.is_error else stat_names[0]
+		summary = folded.get(stat_name)
+		if summary is None:
+			summary = folded[stat_name] = FinishedTransaction(transaction)
+			self.append(summary)
+		else:
+			summary.fold(transaction)
+
+	def add_tree_stats(self, statsd_client):
+		''' Adds stats of all the finished transactions to the statsd client
+		or pipeline.
+
+		:param statsd_client:
+			Statsd client or pipeline the stats are sent with.
+		'''
+		sample_rate = self.sample_rate
+		folded = self.folded is not None
+		for finished in self:
+			finished.add_stats(statsd_client, sample_rate, folded)
+
+
+def send_tree_stats(tree):
+	''' Sends stats of the transaction tree to statsd. Stats are packed into as
+	few multi-metric packets as the maximum UDP packet size allows.
+
+	If SENDER_MODE is set to 'background', the tree is only queued and sent
+	from the background sender thread. If it is set to 'aggregate', timings are
+	aggregated in-process and only their summaries are sent periodically. If
+	it is set to 'shared', timings are aggregated across all the processes of
+	the host in shared memory and sent by one of them.
+
+	:param tree:
+		Root transaction or finished transactions.
+	'''
+	sender_mode = carpy.config.get('SENDER_MODE')
+	if sender_mode == 'background':
+		get_sender().put(tree)
+		return
+	elif sender_mode == 'aggregate':
+		tree.add_tree_stats(get_aggregator())
+		return
+	elif sender_mode == 'shared':
+		tree.add_tree_stats(get_shared_aggregator())
+		return
+
+	statsd_client = get_statsd_client()
+
+	with statsd_client.pipeline() as pipeline:
+		tree.add_tree_stats(pipeline)
+
+
+def sanitize_name(name):
+	''' Sanitizes the component of the stat's name so that it can be sent
+	correctly to statsd.
+
+	:param name:
+		Part of the stat's name.
+	'''
+	return name.replace('.', '_') if name else ''
+
+
+def get_stat_names(app_name, path):
+	''' Returns the cached names of the stats of a transaction.
+
+	:param app_name:
+		Name of the application.
+	:param path:
+		Names of the transaction's ancestors and the transaction itself.
+	:returns:
+		Tuple with the ok and err name of the stat, the common prefix of all
+		the stats of the transaction and the name of the overflow counter or
+		None.
+	'''
+	stat_names = stat_names_cache.get((app_name, path))
+	if stat_names is None:
+		stat_names = overflow_stat_names_cache.get((app_name, path))
+		if stat_names is None:
+			stat_names = build_stat_names(app_name, path)
+
+	return stat_names
+
+
+def build_stat_names(app_name, path):
+	''' Builds the names of the stats of a transaction and stores them to the
+	stat names cache.
+
+	Names over the cardinality limit are replaced with `_other`, such paths
+	are stored to the overflow stat names cache.
+
+	:param app_name:
+		Name of the application.
+	:param path:
+		Names of the transaction's ancestors and the transaction itself.
+	:returns:
+		Tuple with the ok and err name of the stat, the common prefix of all
+		the stats of the transaction and the name of the overflow counter if
+		a name was replaced, None otherwise.
+	'''
+	parts = [
+		'carpy',
+		sanitize_name(app_name),
+		sanitize_name(get_hostname()),
+	]
+
+	limited_path, overflow_index = path, None
+	cardinality_limiter = get_cardinality_limiter()
+	if cardinality_limiter is not None:
+		limited_path, overflow_index = cardinality_limiter.limit_path(app_name, path)
+
+	for name in limited_path:
+		parts.append(sanitize_name(name))
+		parts.append('children')
+	parts.pop()
+
+	overflow_stat = None
+	if overflow_index is not None:
+		overflow_stat = '.'.join(parts[:3 + 2 * overflow_index] + ['_overflow'])
+
+	prefix = '.'.join(parts)
+	stat_names = (prefix + '.ok', prefix + '.err', prefix, overflow_stat)
+
+	if overflow_index is None:
+		_cache_stat_names(stat_names_cache, STAT_NAMES_CACHE_SIZE, (app_name, path), stat_names)
+	else:
+		_cache_stat_names(overflow_stat_names_cache, OVERFLOW_STAT_NAMES_CACHE_SIZE, (app_name, path), stat_names)
+
+	return stat_names
+
+
+def _cache_stat_names(cache, size, key, stat_names):
+	''' Stores the stat names to the cache, the oldest ones are dropped if it
+	is full.
+	'''
+	if len(cache) >= size:
+		try:
+			cache.pop(next(iter(cache)), None)
+		except (StopIteration, RuntimeError):
+			pass
+	cache[key] = stat_names
+
+
+def get_hostname():
+	''' Returns the hostname of the machine. It is resolved only once.
+	'''
+	global hostname
+
+	if hostname is None:
+		hostname = socket.gethostname()
+
+	return hostname
+
+
+def clear_stat_names_cache():
+	''' Clears the cached stat names, hostname and the names known to the
+	cardinality limiter. Useful in tests or when APP_NAME changes.
+	'''
+	global hostname
+
+	hostname = None
+	stat_names_cache.clear()
+	overflow_stat_names_cache.clear()
+	clear_cardinality_limiter()
 
 
 def get_thread_id():
 	''' Returns the thread ID of the current thread or greenlet ID if running
 	in greenlet.
 	'''
+	current_greenlet = get_current_greenlet()
+	if current_greenlet is not None:
+		return id(current_greenlet)
+
+	return threading.current_thread().ident
+
+
+def get_current_greenlet():
+	''' Returns the current greenlet or None if not running in a greenlet
+	other than the main one.
+	'''
+	if switch_state.installed:
+		return switch_state.greenlet
+
 	greenlet = sys.modules.get('greenlet')
 	if greenlet:
 		current_greenlet = greenlet.getcurrent()
 		if current_greenlet is not None and current_greenlet.parent:
-			return id(current_greenlet)
+			return current_greenlet
 
-	return threading.current_thread().ident
+	return None
 
 
 def get_transaction():
-	''' Returns current transaction from cache.
+	''' Returns current transaction of the thread, greenlet or asyncio task.
+	'''
+
+	return current_transaction.get()
+
+
+def incr(name, count=1):
+	''' Increments a custom counter of the current transaction. Nothing is
+	counted outside of a transaction, e.g. in a request which was not sampled.
+
+	:param name:
+		Name of the counter.
+	:param count:
+		Value the counter is incremented by.
+	'''
+	transaction = current_transaction.get()
+	if transaction is not None:
+		transaction.incr(name, count)
+
+
+def gauge(name, value):
+	''' Sets a custom gauge of the current transaction. Nothing is set
+	outside of a transaction.
+
+	:param name:
+		Name of the gauge.
+	:param value:
+		Value of the gauge.
+	'''
+	transaction = current_transaction.get()
+	if transaction is not None:
+		transaction.gauge(name, value)
+
+
+def get_thread_counts():
+	''' Returns the transaction counts of the current thread. '''
+	counts = thread_counts.counts
+	if counts is None:
+		counts = thread_counts.counts = {}
+		owner = thread_counts.owner = ThreadCountsOwner()
+		with all_thread_counts_lock:
+			all_thread_counts.append((weakref.ref(owner), counts))
+
+	return counts
+
+
+def add_inflight(key, weight):
+	''' Counts the transaction as in-flight.
+
+	:param key:
+		Tuple of the application name and path of the transaction.
+	:param weight:
+		Inverse of the sample rate of the transaction.
+	'''
+	counts = thread_counts.counts
+	if counts is None:
+		counts = get_thread_counts()
+
+	key_counts = counts.get(key)
+	if key_counts is None:
+		key_counts = counts[key] = [0.0, 0.0, 0.0, 0.0, counts_generation]
+
+	inflight = key_counts[INFLIGHT] = key_counts[INFLIGHT] + weight
+	if key_counts[GENERATION] != counts_generation:
+		key_counts[GENERATION] = counts_generation
+		key_counts[INFLIGHT_MAX] = inflight
+	elif inflight > key_counts[INFLIGHT_MAX]:
+		key_counts[INFLIGHT_MAX] = inflight
+
+
+def remove_inflight(key, weight, is_error, calls=1):
+	''' Counts the in-flight transaction as finished. It may finish in
+	another thread than it started in, only the sum of the threads counts.
+
+	:param key:
+		Tuple of the application name and path of the transaction.
+	:param weight:
+		Inverse of the sample rate of the transaction.
+	:param is_error:
+		Whether the transaction failed.
+	:param calls:
+		Number of calls the transaction is counted as.
+	'''
+	counts = thread_counts.counts
+	if counts is None:
+		counts = get_thread_counts()
+
+	key_counts = counts.get(key)
+	if key_counts is None:
+		key_counts = counts[key] = [0.0, 0.0, 0.0, 0.0, counts_generation]
+
+	if key_counts[GENERATION] != counts_generation:
+		key_counts[GENERATION] = counts_generation
+		key_counts[INFLIGHT_MAX] = key_counts[INFLIGHT]
+
+	key_counts[INFLIGHT] -= weight
+	key_counts[CALLS] += calls * weight
+	if is_error:
+		key_counts[ERRORS] += weight
+
+
+def merge_thread_counts():
+	''' Merges the transaction counts of all the threads. The maxima of the
+	threads are summed, so with transactions of the same name in several
+	threads the result is an upper bound. The caller has to hold
+	collect_lock.
+
+	:returns:
+		dict of lists of the open, maximum open, finished and failed
+		transactions by the stat names cache key.
+	'''
+	global counts_generation
+
+	generation = counts_generation
+	counts_generation += 1
+
+	with all_thread_counts_lock:
+		threads = list(all_thread_counts)
+
+	# Threads which ended before, their transactions may still be open.
+	merged = {}
+	for key, (inflight, calls, errors) in retired_counts.items():
+		merged[key] = [inflight, inflight, calls, errors]
+
+	for entry in threads:
+		owner, counts = entry
+		# Checked before the copy, an ended thread wrote all its counts.
+		ended = owner() is None
+
+		# The thread may add keys meanwhile.
+		counts = counts.copy()
+		for key, key_counts in counts.items():
+			inflight, inflight_max, calls, errors, key_generation = key_counts
+			if key_generation < generation:
+				# No transaction started or finished since the last collect.
+				inflight_max = inflight
+
+			total = merged.get(key)
+			if total is None:
+				merged[key] = [inflight, inflight_max, calls, errors]
+			else:
+				total[INFLIGHT] += inflight
+				total[INFLIGHT_MAX] += inflight_max
+				total[CALLS] += calls
+				total[ERRORS] += errors
+
+		if ended:
+			# Nothing writes the counts of an ended thread anymore.
+			with all_thread_counts_lock:
+				all_thread_counts.remove(entry)
+			for key, (inflight, _, calls, errors, _) in counts.items():
+				retired = retired_counts.setdefault(key, [0.0, 0.0, 0.0])
+				retired[0] += inflight
+				retired[1] += calls
+				retired[2] += errors
+
+	return merged
+
+
+def collect_transaction_counts(metrics):
+	''' Records the `inflight` and `inflight_max` gauges and the `calls` and
+	`errors` counters of the transactions since the last flush, summed by
+	stat name, so that names over the cardinality limit share `_other`.
+	Names with no open transactions and no calls since the last flush stop
+	being sent.
+
+	If SENDER_MODE is 'shared', they are recorded to the shared aggregator,
+	which sums them over all the processes of the host.
+
+	:param metrics:
+		Metrics the stats are recorded to.
 	'''
+	shared = get_shared_aggregator() if carpy.config.get('SENDER_MODE') == 'shared' else None
+	recorder = shared or metrics
+
+	with collect_lock:
+		merged = merge_thread_counts()
+
+		by_prefix = {}
+		for key, (inflight, inflight_max, calls, errors) in merged.items():
+			sent_calls, sent_errors = sent_counts.get(key, (0.0, 0.0))
+			sent_counts[key] = (calls, errors)
+
+			stat_prefix = get_stat_names(*key)[2]
+			total = by_prefix.get(stat_prefix)
+			if total is None:
+				by_prefix[stat_prefix] = [inflight, inflight_max, calls - sent_calls, errors - sent_errors]
+			else:
+				total[INFLIGHT] += inflight
+				total[INFLIGHT_MAX] += inflight_max
+				total[CALLS] += calls - sent_calls
+				total[ERRORS] += errors - sent_errors
+
+		# Counts of ended threads are kept only while they are needed.
+		for key, (inflight, calls, errors) in list(retired_counts.items()):
+			if abs(inflight) < 1e-6:
+				del retired_counts[key]
+				sent_calls, sent_errors = sent_counts[key]
+				sent_counts[key] = (sent_calls - calls, sent_errors - errors)
+
+		for stat_prefix, (inflight, inflight_max, calls, errors) in by_prefix.items():
+			if inflight < 1e-6 and calls < 1e-6:
+				if stat_prefix in gauge_prefixes:
+					gauge_prefixes.discard(stat_prefix)
+					if shared is not None:
+						# The shared aggregator stops sending gauges which
+						# are zero in all the processes.
+						shared.gauge(stat_prefix + '.inflight', 0)
+						shared.gauge(stat_prefix + '.inflight_max', 0)
+					else:
+						metrics.remove_gauge(stat_prefix + '.inflight')
+						metrics.remove_gauge(stat_prefix + '.inflight_max')
+				continue
+
+			gauge_prefixes.add(stat_prefix)
+			recorder.gauge(stat_prefix + '.inflight', int(round(inflight)))
+			recorder.gauge(stat_prefix + '.inflight_max', int(round(inflight_max)))
+			if calls >= 0.5:
+				recorder.incr(stat_prefix + '.calls', int(round(calls)))
+			if errors >= 0.5:
+				recorder.incr(stat_prefix + '.errors', int(round(errors)))
+
+
+def reset_transaction_counts():
+	''' Drops the transaction counts of all the threads. '''
+	global thread_counts, all_thread_counts_lock, collect_lock
+
+	thread_counts = ThreadCounts()
+	all_thread_counts_lock = threading.Lock()
+	collect_lock = threading.Lock()
+	del all_thread_counts[:]
+	retired_counts.clear()
+	sent_counts.clear()
+	gauge_prefixes.clear()
+
+
+add_collector(collect_transaction_counts)
+
+
+def _after_fork_in_child():
+	# Transactions open in the parent process never finish in the child.
+	reset_transaction_counts()
+
 
-	return transactions_cache.get(get_thread_id())
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,18 +1,182 @@
-__all__ = ['transaction_trace', 'function_trace', 'transaction_trace_wrap', 'function_trace_wrap']
+__all__ = [
+	'transaction_trace',
+	'function_trace',
+	'transaction_trace_wrap',
+	'function_trace_wrap',
+	'enable',
+	'disable',
+	'refresh',
+	'is_enabled',
+]
 
+import inspect
+import weakref
 from functools import wraps
 
+import carpy
+
+from .sampling import get_sampler
+from .statsd_client import is_backend_configured
 from .transaction import Transaction, get_transaction
+from .transaction import current_transaction as transaction_context
+
+# All the traced functions, so that their state can be refreshed when tracing
+# is enabled or disabled at runtime.
+traced_functions = weakref.WeakSet()
+
+# Functions wrapped with transaction_trace_wrap or function_trace_wrap, whose
+# attribute on the parent module or class is rebound between the wrapper and
+# the original function.
+bound_functions = []
+
+
+class TracedFunction(object):
+	''' Function wrapped by one of the trace decorators with the state of
+	its tracing.
+	'''
+
+	__slots__ = ('func', 'wrapper', 'name', 'func_parent', 'func_attr', 'enabled', '__weakref__')
+
+	def __init__(self, func, name):
+		self.func = func
+		self.wrapper = None
+		self.name = name
+
+		self.func_parent = None
+		self.func_attr = None
+
+		# None until the first call after the state was refreshed.
+		self.enabled = None
+
+	def resolve(self):
+		''' Resolves whether the function is traced from the config.
+
+		:returns:
+			bool. `True` if the function is traced.
+		'''
+		self.enabled = is_enabled(self.name)
+		return self.enabled
+
+	def bind(self):
+		''' Binds the wrapper, or the original function if tracing is
+		disabled, to the attribute of the parent module or class.
+		'''
+		func = self.func if is_disabled(self.name) else self.wrapper
+		setattr(self.func_parent, self.func_attr, func)
+
+
+def is_disabled(name):
+	''' Returns true if tracing is explicitly disabled, globally with the
+	ENABLED config or for the name with the DISABLED_TRACES config.
+
+	:param name:
+		Name of the transaction.
+	'''
+	return not carpy.config.get('ENABLED', True) or name in (carpy.config.get('DISABLED_TRACES') or ())
+
+
+def is_enabled(name):
+	''' Returns true if the transaction is traced. Tracing is disabled if it
+	is explicitly disabled or if APP_NAME or the host of the backend, e.g.
+	STATSD_HOST, are not configured.
+
+	:param name:
+		Name of the transaction.
+	'''
+	return (
+		not is_disabled(name) and
+		bool(carpy.config.get('APP_NAME')) and
+		is_backend_configured()
+	)
+
+
+def refresh():
+	''' Applies the current config to all the traced functions. Call it after
+	the config changes at runtime.
+	'''
+	for traced in list(traced_functions):
+		traced.enabled = None
+
+	for traced in bound_functions:
+		traced.bind()
+
+
+def enable(name=None):
+	''' Enables tracing at runtime.
+
+	:param name:
+		Name of the transaction. If not set, tracing is enabled globally.
+	'''
+	if name is None:
+		carpy.config['ENABLED'] = True
+	else:
+		carpy.config['DISABLED_TRACES'] = set(carpy.config.get('DISABLED_TRACES') or ()) - set([name])
+	refresh()
+
+
+def disable(name=None):
+	''' Disables tracing at runtime. Functions wrapped with
+	transaction_trace_wrap and function_trace_wrap are rebound to the original
+	functions, decorated functions only check the flag.
+
+	:param name:
+		Name of the transaction. If not set, tracing is disabled globally.
+	'''
+	if name is None:
+		carpy.config['ENABLED'] = False
+	else:
+		carpy.config['DISABLED_TRACES'] = set(carpy.config.get('DISABLED_TRACES') or ()) | set([name])
+	refresh()
+
+
+def _register(traced, wrapper):
+	''' Registers the decorated function.
+
+	The wrapper is returned even if tracing is disabled, since references to
+	the decorated function, e.g. by other decorators or imports, can not be
+	rebound when tracing is enabled. While disabled it only checks a flag.
+
+	:returns:
+		The wrapper.
+	'''
+	traced.wrapper = wrapper
+	traced_functions.add(traced)
+	return wrapper
 
 
 def transaction_trace(func, func_name=None):
 	''' Transaction trace decorator.
 	Wrap request handler to trace the request.
+	Requests are sampled with the sample rate configured for the transaction.
+	Coroutine functions and async generators are traced until they finish.
 	'''
+	traced = TracedFunction(func, func_name or func.__name__)
+	return _register(traced, _transaction_trace(traced))
+
+
+def _transaction_trace(traced):
+	func = traced.func
+
+	if inspect.iscoroutinefunction(func):
+		return _async_transaction_trace(traced)
+	if inspect.isasyncgenfunction(func):
+		return _async_gen_transaction_trace(traced)
+
+	func_name = traced.name
+
 	@wraps(func)
 	def wrapper(*args, **kwargs):
-		new_func_name = func_name or func.__name__
-		with Transaction(name=new_func_name):
+		enabled = traced.enabled
+		if enabled is None:
+			enabled = traced.resolve()
+		if not enabled:
+			return func(*args, **kwargs)
+
+		sample_rate = get_sampler().sample(func_name)
+		if not sample_rate:
+			return func(*args, **kwargs)
+
+		with Transaction(name=func_name, sample_rate=sample_rate):
 			return func(*args, **kwargs)
 	return wrapper
 
@@ -22,20 +186,145 @@ def function_trace(func, func_name=None):
 	Wrap functions or methods you want to trace in a request.
 	Transaction has to be started higher in a stack either with
 	transaction_trace or transaction_trace_wrap.
+	Coroutine functions and async generators are traced until they finish.
 	'''
+	traced = TracedFunction(func, func_name or func.__name__)
+	return _register(traced, _function_trace(traced))
+
+
+def _function_trace(traced):
+	func = traced.func
+
+	if inspect.iscoroutinefunction(func):
+		return _async_function_trace(traced)
+	if inspect.isasyncgenfunction(func):
+		return _async_gen_function_trace(traced)
+
+	func_name = traced.name
+
 	@wraps(func)
 	def wrapper(*args, **kwargs):
+		enabled = traced.enabled
+		if enabled is None:
+			enabled = traced.resolve()
+		if not enabled:
+			return func(*args, **kwargs)
+
 		current_transaction = get_transaction()
 		if not current_transaction:
 			return func(*args, **kwargs)
 
-		new_func_name = func_name or func.__name__
-		with Transaction(name=new_func_name, parent=current_transaction):
+		with Transaction(name=func_name, parent=current_transaction):
 			return func(*args, **kwargs)
 	return wrapper
 
 
-def transaction_trace_wrap(func_parent, func_name):
+def _async_transaction_trace(traced):
+	func = traced.func
+	func_name = traced.name
+
+	@wraps(func)
+	async def wrapper(*args, **kwargs):
+		enabled = traced.enabled
+		if enabled is None:
+			enabled = traced.resolve()
+		if not enabled:
+			return await func(*args, **kwargs)
+
+		sample_rate = get_sampler().sample(func_name)
+		if not sample_rate:
+			return await func(*args, **kwargs)
+
+		with Transaction(name=func_name, sample_rate=sample_rate):
+			return await func(*args, **kwargs)
+	return wrapper
+
+
+def _async_gen_transaction_trace(traced):
+	func = traced.func
+	func_name = traced.name
+
+	@wraps(func)
+	async def wrapper(*args, **kwargs):
+		enabled = traced.enabled
+		if enabled is None:
+			enabled = traced.resolve()
+		if not enabled:
+			async for item in func(*args, **kwargs):
+				yield item
+			return
+
+		sample_rate = get_sampler().sample(func_name)
+		if not sample_rate:
+			async for item in func(*args, **kwargs):
+				yield item
+			return
+
+		previous = transaction_context.get()
+		with Transaction(name=func_name, sample_rate=sample_rate) as transaction:
+			async for item in func(*args, **kwargs):
+				# The consumer may stop iterating and leave the generator to
+				# be closed in another context, so the transaction is current
+				# only while the generator runs.
+				transaction_context.set(previous)
+				yield item
+				transaction_context.set(transaction)
+	return wrapper
+
+
+def _async_function_trace(traced):
+	func = traced.func
+	func_name = traced.name
+
+	@wraps(func)
+	async def wrapper(*args, **kwargs):
+		enabled = traced.enabled
+		if enabled is None:
+			enabled = traced.resolve()
+		if not enabled:
+			return await func(*args, **kwargs)
+
+		current_transaction = get_transaction()
+		if not current_transaction:
+			return await func(*args, **kwargs)
+
+		with Transaction(name=func_name, parent=current_transaction):
+			return await func(*args, **kwargs)
+	return wrapper
+
+
+def _async_gen_function_trace(traced):
+	func = traced.func
+	func_name = traced.name
+
+	@wraps(func)
+	async def wrapper(*args, **kwargs):
+		enabled = traced.enabled
+		if enabled is None:
+			enabled = traced.resolve()
+		if not enabled:
+			async for item in func(*args, **kwargs):
+				yield item
+			return
+
+		current_transaction = get_transaction()
+		if not current_transaction:
+			async for item in func(*args, **kwargs):
+				yield item
+			return
+
+		with Transaction(name=func_name, parent=current_transaction) as transaction:
+			async for item in func(*args, **kwargs):
+				# The consumer may stop iterating and leave the generator to
+				# be closed in another context, so the transaction is current
+				# only while the generator runs.
+				transaction_context.set(current_transaction)
+				yield item
+				transaction_context.set(transaction)
+	return wrapper
+
+
+def transaction_trace_wrap(func_parent, func_name, trace_name=None):
 	''' Transaction trace wrapper.
 	Wrap request handler to trace the request.
 
@@ -43,12 +332,14 @@ def transaction_trace_wrap(func_parent, func_name):
 		Parent module or class of the function
 	:param func_name
 		Name of the function you want to wrap
+	:param trace_name
+		Name of the transaction, defaults to func_name
 	'''
-	func = getattr(func_parent, func_name)
-	setattr(func_parent, func_name, transaction_trace(func, func_name))
+	traced = TracedFunction(getattr(func_parent, func_name), trace_name or func_name)
+	_register_bound(traced, _transaction_trace(traced), func_parent, func_name)
 
 
-def function_trace_wrap(func_parent, func_name):
+def function_trace_wrap(func_parent, func_name, trace_name=None):
 	''' Function trace wrapper.
 	Wrap functions or methods you want to trace in a request.
 	Transaction has to be started higher in a stack either with
@@ -58,7 +349,22 @@ def function_trace_wrap(func_parent, func_name):
 		Parent module or class of the function
 	:param func_name
 		Name of the function you want to wrap
+	:param trace_name
+		Name of the transaction, defaults to func_name
 	'''
-	func = getattr(func_parent, func_name)
-	setattr(func_parent, func_name, function_trace(func, func_name))
+	traced = TracedFunction(getattr(func_parent, func_name), trace_name or func_name)
+	_register_bound(traced, _function_trace(traced), func_parent, func_name)
+
+
+def _register_bound(traced, wrapper, func_parent, func_attr):
+	''' Registers the wrapped function and binds the wrapper, or the original
+	function if tracing is explicitly disabled, to the parent.
+	'''
+	traced.wrapper = wrapper
+	traced.func_parent = func_parent
+	traced.func_attr = func_attr
+
+	traced_functions.add(traced)
+	bound_functions.append(traced)
 
+	traced.bind()
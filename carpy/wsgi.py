@@ -0,0 +1,201 @@
+__all__ = ['CarpyMiddleware', 'RouteNamer', 'set_transaction_name', 'template_name']
+
+import sys
+import time
+
+from .sampling import get_sampler
+from .transaction import Transaction, get_transaction
+from .wrapper import is_enabled
+
+
+WILDCARD = object()
+END = object()
+
+
+def template_name(template):
+	''' Returns the transaction name of the URL rule template, e.g.
+	`users_id_posts` for `/users/<int:id>/posts`.
+
+	:param template:
+		URL rule template with the variable parts in angle brackets.
+	'''
+	parts = []
+	for segment in template.strip('/').split('/'):
+		if segment.startswith('<') and segment.endswith('>'):
+			segment = segment[1:-1].rsplit(':', 1)[-1]
+		if segment:
+			parts.append(segment)
+
+	return '_'.join(parts) or 'index'
+
+
+class RouteNamer(object):
+	''' Names requests by the URL rule templates they match.
+
+	Templates are compiled into a tree of path segments once, so naming a
+	request costs a dict lookup per path segment and no regular expressions.
+	Variable segments (`<id>`, `<int:id>`) match any single segment.
+	'''
+
+	def __init__(self, templates=()):
+		self.tree = {}
+		for template in templates:
+			self.add(template)
+
+	def add(self, template, name=None):
+		''' Adds the URL rule template.
+
+		:param template:
+			URL rule template, e.g. `/users/<int:id>`.
+		:param name:
+			Transaction name of the template. Defaults to
+			template_name(template).
+		'''
+		node = self.tree
+		for segment in template.strip('/').split('/'):
+			if segment.startswith('<') and segment.endswith('>'):
+				segment = WILDCARD
+			node = node.setdefault(segment, {})
+
+		node[END] = name or template_name(template)
+
+	def match(self, path):
+		''' Returns the transaction name of the path or None if no template
+		matches it.
+
+		:param path:
+			Path of the request, e.g. PATH_INFO.
+		'''
+		return self._match(self.tree, path.strip('/').split('/'), 0)
+
+	def _match(self, node, segments, index):
+		if index == len(segments):
+			return node.get(END)
+
+		# Static segments take precedence over variable ones.
+		child = node.get(segments[index])
+		if child is not None:
+			name = self._match(child, segments, index + 1)
+			if name is not None:
+				return name
+
+		child = node.get(WILDCARD)
+		if child is not None:
+			return self._match(child, segments, index + 1)
+
+		return None
+
+
+class CarpyMiddleware(object):
+	''' WSGI middleware which traces every request as a root transaction.
+
+	The transaction is finished when the server closes the response iterable,
+	so streamed responses are timed until the whole body is sent. Time to the
+	first non-empty chunk of the body is reported as a `ttfb` timer next to the
+	transaction's ok/err timer.
+
+	Requests are named, in this order, by name_func, by the first of the
+	routes templates which matches PATH_INFO or by the default name. The
+	application can rename the request with set_transaction_name().
+	'''
+
+	def __init__(self, app, name='wsgi', routes=None, name_func=None):
+		'''
+		:param app:
+			WSGI application.
+		:param name:
+			Default transaction name.
+		:param routes:
+			URL rule templates, e.g. `[rule.rule for rule in
+			flask_app.url_map.iter_rules()]`.
+		:param name_func:
+			Function which gets the WSGI environ and returns the transaction
+			name.
+		'''
+		self.app = app
+		self.name = name
+		self.route_namer = RouteNamer(routes) if routes else None
+		self.name_func = name_func
+
+	def get_transaction_name(self, environ):
+		''' Returns the transaction name of the request. '''
+		if self.name_func is not None:
+			return self.name_func(environ)
+
+		if self.route_namer is not None:
+			name = self.route_namer.match(environ.get('PATH_INFO', ''))
+			if name is not None:
+				return name
+
+		return self.name
+
+	def __call__(self, environ, start_response):
+		name = self.get_transaction_name(environ)
+
+		if not is_enabled(name):
+			return self.app(environ, start_response)
+
+		sample_rate = get_sampler().sample(name)
+		if not sample_rate:
+			return self.app(environ, start_response)
+
+		transaction = Transaction(name=name, sample_rate=sample_rate).__enter__()
+		environ['carpy.transaction'] = transaction
+
+		def traced_start_response(status, headers, exc_info=None):
+			if status[:1] == '5':
+				transaction.error()
+			return start_response(status, headers, exc_info)
+
+		try:
+			response = self.app(environ, traced_start_response)
+		except BaseException:
+			transaction.__exit__(*sys.exc_info())
+			raise
+
+		return TracedResponse(response, transaction)
+
+
+class TracedResponse(object):
+	''' Response iterable which records the time to the first byte and
+	finishes the transaction when the server closes it.
+	'''
+
+	def __init__(self, response, transaction):
+		self.response = response
+		self.transaction = transaction
+
+	def __iter__(self):
+		transaction = self.transaction
+		first_byte = False
+
+		try:
+			for chunk in self.response:
+				if not first_byte and chunk:
+					first_byte = True
+					transaction.add_timing('ttfb', (time.perf_counter_ns() - transaction.start_time) / 1e6)
+				yield chunk
+		except Exception:
+			transaction.error()
+			raise
+
+	def close(self):
+		transaction, self.transaction = self.transaction, None
+		try:
+			if hasattr(self.response, 'close'):
+				self.response.close()
+		finally:
+			if transaction is not None:
+				transaction.__exit__()
+
+
+def set_transaction_name(name):
+	''' Renames the current root transaction, e.g. with the URL rule matched
+	by the framework. Call it before any child transactions are started.
+
+	:param name:
+		New name of the transaction.
+	'''
+	transaction = get_transaction()
+	if transaction is not None:
+		(transaction.root or transaction).set_name(name)
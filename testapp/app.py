@@ -1,3 +1,4 @@
+import os
 import time
 import random
 import sys
@@ -8,8 +9,10 @@ import carpy
 
 
 carpy.config['APP_NAME'] = 'TestApp'
-carpy.config['STATSD_HOST'] = 'ovh01'
-carpy.config['STATSD_PORT'] = 8125
+# Run `python -m carpy.statsd_server` and set STATSD_HOST=127.0.0.1 to test
+# without a statsd server.
+carpy.config['STATSD_HOST'] = os.environ.get('STATSD_HOST', 'ovh01')
+carpy.config['STATSD_PORT'] = int(os.environ.get('STATSD_PORT', 8125))
 
 app = Flask(__name__)
 